@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import shutil
+import datetime
+import argparse
+import tempfile
+
+import numpy as np
+
+import Lib
+from ParseData.Database import DB, SNAPSHOT_TABLES, TRIDE_HOURLY_COLUMNS, WEATHER_FIELD_LIST
+from ParseData.Snapshot import SnapshotWriter
+
+
+# Benchmarks the DB query and feature paths against deterministic synthetic data. The data is written as a
+# columnar snapshot and read through DB(snapshotFolder=...), so no MySQL server or competition data is needed.
+# Results are printed (or written with --output) as JSON and can be compared with an earlier run using
+# --compare.
+
+BENCHMARK_START_TIME = datetime.datetime(2012, 5, 1)
+BOSTON = (42.355, -71.06)
+
+DEFAULT_CONFIG = {
+	'seed': 0,
+	'days': 14,
+	'numPOIs': 5,
+	'numPickups': 200000,
+	'numDropoffs': 200000,
+	'numEvents': 500,
+	'numTweets': 50000,
+	'numStations': 40,
+	'numCalls': 2000,        # Calls per query benchmark
+	'loadDataDays': 3,       # Days covered by the (slow) per-hour loadData benchmark
+}
+
+
+# Synthetic data generation
+def randomTimes(rng, days, size, step=60):
+	return [BENCHMARK_START_TIME + datetime.timedelta(seconds=int(seconds)) for seconds in step * rng.randint(0, days * 86400 // step, size)]
+
+# Coordinates clustered around the POIs, with some uniform background. Rounded to the 6 decimals MySQL stores.
+def randomLocations(rng, POIs, size, spread=0.002, background=0.2):
+	centers = np.array(POIs)[rng.randint(0, len(POIs), size)]
+	locations = centers + rng.normal(0, spread, (size, 2))
+	isBackground = rng.rand(size) < background
+	locations[isBackground] = np.array(BOSTON) + rng.uniform(-0.03, 0.03, (isBackground.sum(), 2))
+	return np.round(locations, 6)
+
+def writeRows(writer, table, columns, rows):
+	rows = list(rows)
+	writer.writeTable(table, columns, ([row.get(name) for name, kind in columns] for row in rows), len(rows))
+
+def generateData(folder, config):
+	rng = np.random.RandomState(config['seed'])
+	days = config['days']
+	POIs = [tuple(location) for location in np.round(np.array(BOSTON) + rng.uniform(-0.02, 0.02, (config['numPOIs'], 2)), 6)]
+	writer = SnapshotWriter(folder)
+
+	for table, size in (('taxipickup', config['numPickups']), ('taxidropoff', config['numDropoffs'])):
+		locations = randomLocations(rng, POIs, size)
+		times = randomTimes(rng, days, size)
+		writeRows(writer, table, SNAPSHOT_TABLES[table][1], ({'trip_id': i, 'time': times[i], 'address': 'Street %i' % (i % 500), 'latitude': locations[i][0], 'longitude': locations[i][1]} for i in xrange(size)))
+
+	# Hourly observations from a day before to a day after the range, with some nulls
+	weathers = []
+	for hour in xrange(-24, (days + 1) * 24):
+		weather = dict((field, float(rng.normal(50, 20))) for field in WEATHER_FIELD_LIST)
+		for field in ('precipm', 'windchilli', 'heatindexi'):
+			if rng.rand() < 0.5:
+				weather[field] = None
+		for field in ('fog', 'rain', 'snow', 'hail', 'thunder', 'tornado'):
+			weather[field] = rng.rand() < 0.1
+		weather['time'] = BENCHMARK_START_TIME + datetime.timedelta(hours=hour, minutes=54)
+		weather['conds'] = ['Clear', 'Rain', 'Overcast'][rng.randint(3)]
+		weathers.append(weather)
+	writeRows(writer, 'weather', SNAPSHOT_TABLES['weather'][1], weathers)
+
+	locations = randomLocations(rng, POIs, config['numEvents'])
+	startTimes = randomTimes(rng, days, config['numEvents'], step=1800)
+	writeRows(writer, 'event', SNAPSHOT_TABLES['event'][1], ({'event_id': i, 'name': 'Event %i' % i, 'start_time': startTimes[i],
+		'end_time': startTimes[i] + datetime.timedelta(hours=int(rng.randint(1, 5))), 'latitude': locations[i][0], 'longitude': locations[i][1],
+		'type': 'Music', 'is_time_accurate': rng.rand() < 0.8, 'is_time_inferred': False} for i in xrange(config['numEvents'])))
+
+	locations = randomLocations(rng, POIs, config['numTweets'])
+	times = randomTimes(rng, days, config['numTweets'], step=1)
+	isGeotagged = rng.rand(config['numTweets']) < 0.6
+	writeRows(writer, 'tweet', SNAPSHOT_TABLES['tweet'][1], ({'created_at': times[i], 'latitude': locations[i][0] if isGeotagged[i] else None,
+		'longitude': locations[i][1] if isGeotagged[i] else None, 'mentions_taxi': rng.rand() < 0.2, 'tweet_id': i, 'user_id': i % 1000} for i in xrange(config['numTweets'])))
+
+	# Two stops per station, plus as many bus stops that are not stations
+	locations = randomLocations(rng, POIs, 4 * config['numStations'], spread=0.01)
+	writeRows(writer, 'stop', SNAPSHOT_TABLES['stop'][1], ({'loc_id': i, 'station': 'Station %i' % (i // 2), 'is_station': i < 2 * config['numStations'],
+		'latitude': locations[i][0], 'longitude': locations[i][1], 'line': 'Red'} for i in xrange(4 * config['numStations'])))
+
+	TRides = []
+	for station in xrange(config['numStations']):
+		for hour in xrange(days * 24):
+			origin, destination = rng.poisson(30, 2)
+			TRides.append({'station': 'Station %i' % station, 'time': BENCHMARK_START_TIME + datetime.timedelta(hours=hour), 'origin': int(origin), 'destination': int(destination)})
+	writeRows(writer, 'tride_hourly', TRIDE_HOURLY_COLUMNS, TRides)
+	writer.close()
+
+	# Test windows to exclude from training, in the format of the competition's test files
+	testFilename = os.path.join(folder, 'test.txt')
+	with open(testFilename, 'w') as f:
+		for i, (latitude, longitude) in enumerate(POIs):
+			for start in randomTimes(rng, days - 1, 3, step=3600):
+				f.write('%i,%s,%s,%s,%s\n' % (i, start.strftime('%Y-%m-%d %H:%M'), (start + datetime.timedelta(hours=2)).strftime('%Y-%m-%d %H:%M'), latitude, longitude))
+
+	return POIs, testFilename
+
+
+# Timing
+def timeCalls(func, argsList):
+	latencies = []
+	for args in argsList:
+		start = time.time()
+		func(*args)
+		latencies.append(time.time() - start)
+	latencies = np.array(latencies)
+	return {
+		'calls': len(latencies),
+		'total': float(latencies.sum()),
+		'mean': float(latencies.mean()),
+		'p50': float(np.percentile(latencies, 50)),
+		'p95': float(np.percentile(latencies, 95)),
+		'max': float(latencies.max()),
+	}
+
+def runBenchmarks(folder, config):
+	rng = np.random.RandomState(config['seed'] + 1)
+	results = {}
+
+	start = time.time()
+	POIs, testFilename = generateData(folder, config)
+	results['generateData'] = {'calls': 1, 'total': time.time() - start}
+	Lib.REMOVED_TIMES = Lib.getRemovedTimes([testFilename])
+
+	start = time.time()
+	with DB(queryCacheFilename=':memory:', snapshotFolder=folder) as db:
+		results['openDB'] = {'calls': 1, 'total': time.time() - start}
+
+		numCalls = config['numCalls']
+		hours = [BENCHMARK_START_TIME + datetime.timedelta(hours=int(hour)) for hour in rng.randint(6, (config['days'] - 1) * 24, numCalls)]
+		POIChoices = [POIs[i] for i in rng.randint(0, len(POIs), numCalls)]
+
+		results['getNumPickupsNearLocation'] = timeCalls(db.getNumPickupsNearLocation, [(latitude, longitude, hour, hour + datetime.timedelta(hours=1)) for (latitude, longitude), hour in zip(POIChoices, hours)])
+		results['getWeather'] = timeCalls(db.getWeather, [(hour + datetime.timedelta(minutes=int(minutes)),) for hour, minutes in zip(hours, rng.randint(0, 60, numCalls))])
+		results['afterNumEvents'] = timeCalls(db.afterNumEvents, [(latitude, longitude, hour, int(hoursAfter)) for (latitude, longitude), hour, hoursAfter in zip(POIChoices, hours, rng.randint(0, 4, numCalls))])
+		results['getNumTRidesFromXClosestStations'] = timeCalls(db.getNumTRidesFromXClosestStations, [(latitude, longitude, hour, hour + datetime.timedelta(hours=1), int(x)) for (latitude, longitude), hour, x in zip(POIChoices, hours, rng.randint(1, 4, numCalls))])
+		results['generateAllFeatures'] = timeCalls(Lib.generateAllFeatures, [(db, latitude, longitude, hour) for (latitude, longitude), hour in zip(POIChoices, hours)][:numCalls // 10])
+
+		loadDataStart = BENCHMARK_START_TIME + datetime.timedelta(days=1)
+		loadDataEnd = loadDataStart + datetime.timedelta(days=config['loadDataDays'])
+		results['loadData'] = timeCalls(Lib.loadData, [(db, latitude, longitude, Lib.generateAllFeatures, loadDataStart, loadDataEnd) for latitude, longitude in POIs])
+		results['loadDataBatched'] = timeCalls(Lib.loadDataBatched, [(db, latitude, longitude, loadDataStart, BENCHMARK_START_TIME + datetime.timedelta(days=config['days'] - 1)) for latitude, longitude in POIs])
+
+	return results
+
+# Prints the change in mean latency against an earlier run's output
+def compareResults(results, previousResults):
+	for name in sorted(results):
+		if name not in previousResults:
+			continue
+		current, previous = results[name], previousResults[name]
+		currentMean = current['total'] / current['calls']
+		previousMean = previous['total'] / previous['calls']
+		print '%-35s %12.6fs -> %12.6fs  (%.2fx)' % (name, previousMean, currentMean, previousMean / currentMean if currentMean > 0 else float('inf'))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the DB query and feature paths on synthetic data')
+	parser.add_argument('--scale', type=float, default=1.0, help='Multiplies the number of pickups, dropoffs, events and tweets')
+	parser.add_argument('--days', type=int, default=DEFAULT_CONFIG['days'])
+	parser.add_argument('--calls', type=int, default=DEFAULT_CONFIG['numCalls'])
+	parser.add_argument('--seed', type=int, default=DEFAULT_CONFIG['seed'])
+	parser.add_argument('--folder', help='Where to write the synthetic snapshot (a temporary folder by default)')
+	parser.add_argument('--output', help='File to write the JSON results to')
+	parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+	args = parser.parse_args()
+
+	config = dict(DEFAULT_CONFIG)
+	for key in ('numPickups', 'numDropoffs', 'numEvents', 'numTweets'):
+		config[key] = int(config[key] * args.scale)
+	config['days'] = args.days
+	config['numCalls'] = args.calls
+	config['seed'] = args.seed
+
+	folder = args.folder if args.folder != None else tempfile.mkdtemp(prefix='bigdata_benchmark_')
+	try:
+		results = runBenchmarks(folder, config)
+	finally:
+		if args.folder == None:
+			shutil.rmtree(folder)
+
+	output = json.dumps({'config': config, 'results': results}, indent=2, sort_keys=True)
+	if args.output != None:
+		with open(args.output, 'w') as f:
+			f.write(output)
+	else:
+		print output
+
+	if args.compare != None:
+		with open(args.compare) as f:
+			compareResults(results, json.load(f)['results'])
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+from ParseData.Config import DATA_FOLDER
+
+
+FEATURE_STORE_FOLDER = os.path.join(DATA_FOLDER, 'features')
+
+
+# Persists feature vectors and labels per location and hour. Each namespace (a feature set, its version and
+# the identity of the data, see Lib.getFeatureStore) is a folder holding one .npz file per location with the
+# sorted hour start times in epoch seconds, the feature matrix and the labels. Labels that were never computed
+# (e.g. for the test windows) are NaN. Files are cached in memory once read.
+class FeatureStore:
+	def __init__(self, namespace, folder=FEATURE_STORE_FOLDER):
+		self.folder = os.path.join(folder, namespace)
+		self.locations = {}
+
+	def getFilename(self, latitude, longitude):
+		return os.path.join(self.folder, '%.6f_%.6f.npz' % (latitude, longitude))
+
+	# Returns the (seconds, x, y) arrays stored for a location, or None if there are none
+	def load(self, latitude, longitude):
+		if (latitude, longitude) not in self.locations:
+			filename = self.getFilename(latitude, longitude)
+			if os.path.exists(filename):
+				with np.load(filename) as data:
+					self.locations[(latitude, longitude)] = (data['seconds'], data['x'], data['y'])
+			else:
+				self.locations[(latitude, longitude)] = None
+		return self.locations[(latitude, longitude)]
+
+	# Looks up the given hour start times. Returns (found, x, y) where found is a boolean mask over seconds and
+	# x and y hold the stored rows for the found ones, in order.
+	def get(self, latitude, longitude, seconds):
+		seconds = np.asarray(seconds, dtype=np.int64)
+		stored = self.load(latitude, longitude)
+		if stored == None or len(stored[0]) == 0:
+			return np.zeros(len(seconds), dtype=bool), None, None
+		storedSeconds, x, y = stored
+		indices = np.clip(np.searchsorted(storedSeconds, seconds), 0, len(storedSeconds) - 1)
+		found = storedSeconds[indices] == seconds
+		return found, x[indices[found]], y[indices[found]]
+
+	# The (latitude, longitude) of every location with stored rows
+	def getLocations(self):
+		locations = set(location for location, stored in self.locations.iteritems() if stored != None)
+		if os.path.isdir(self.folder):
+			for filename in os.listdir(self.folder):
+				if filename.endswith('.npz') and not filename.endswith('.tmp.npz'):
+					latitude, longitude = filename[:-len('.npz')].split('_')
+					locations.add((float(latitude), float(longitude)))
+		return sorted(locations)
+
+	# The hour start times stored for a location
+	def getSeconds(self, latitude, longitude):
+		stored = self.load(latitude, longitude)
+		return stored[0] if stored != None else np.zeros(0, dtype=np.int64)
+
+	# Drops the rows of a location at the given hour start times, so they are computed again
+	def remove(self, latitude, longitude, seconds):
+		stored = self.load(latitude, longitude)
+		if stored == None or len(seconds) == 0:
+			return
+		isKept = ~np.in1d(stored[0], seconds)
+		self.write(latitude, longitude, stored[0][isKept], stored[1][isKept], stored[2][isKept])
+
+	# Adds or replaces rows for a location and writes its file
+	def put(self, latitude, longitude, seconds, x, y):
+		seconds = np.asarray(seconds, dtype=np.int64)
+		x = np.asarray(x, dtype=np.float64).reshape(len(seconds), -1)
+		y = np.asarray(y, dtype=np.float64)
+		stored = self.load(latitude, longitude)
+		if stored != None and len(stored[0]) > 0:
+			isReplaced = np.in1d(stored[0], seconds)
+			seconds = np.concatenate((stored[0][~isReplaced], seconds))
+			x = np.concatenate((stored[1][~isReplaced], x))
+			y = np.concatenate((stored[2][~isReplaced], y))
+		order = np.argsort(seconds, kind='mergesort')
+		self.write(latitude, longitude, seconds[order], x[order], y[order])
+
+	# Replaces the rows of a location, which must be sorted by time
+	def write(self, latitude, longitude, seconds, x, y):
+		self.locations[(latitude, longitude)] = (seconds, x, y)
+
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		# Write to a temporary file first so an interrupted run never leaves a truncated one
+		filename = self.getFilename(latitude, longitude)
+		temporaryFilename = filename + '.tmp.npz'
+		np.savez(temporaryFilename, seconds=seconds, x=x, y=y)
+		if os.path.exists(filename):
+			os.remove(filename)
+		os.rename(temporaryFilename, filename)
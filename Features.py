@@ -0,0 +1,201 @@
+import datetime
+
+import numpy as np
+
+from ParseData.Database import TaxiPickup, TaxiDropoff, Weather
+from ParseData.Index import toEpochSeconds, fromEpochSeconds, windowCounts
+
+
+# A single input of the models. source is a key of SOURCES, window is the [start, end] range of hours
+# relative to the hour being predicted (both inclusive, like the DB count queries), radius is in meters and
+# parameter is whatever else the source needs: the calendar or weather field, the kind of event count or the
+# number of closest stations.
+class Feature:
+	def __init__(self, name, source, window=(0, 0), radius=250, parameter=None):
+		if source not in SOURCES:
+			raise ValueError('Unknown feature source %s' % source)
+		self.name = name
+		self.source = source
+		self.window = window
+		self.radius = radius
+		self.parameter = parameter
+
+	def __repr__(self):
+		return 'Feature(%r, %r, window=%r, radius=%r, parameter=%r)' % (self.name, self.source, self.window, self.radius, self.parameter)
+
+
+# Where features get their values. A source fetches its data once per location for a range of times covering
+# the windows of all the features being evaluated, with fetch(db, latitude, longitude, startTime, endTime, key),
+# then evaluates each feature for every hour from that data with evaluate(data, seconds, feature), which
+# returns the feature's values for each of the given epoch times as an array. Features of a source with equal
+# keys share a fetch.
+class Source:
+	# Sources that read the same values everywhere are evaluated once for all locations
+	dependsOnLocation = True
+
+	def getKey(self, feature):
+		return feature.radius
+
+	# The values of features, which share this source and key, for numHours consecutive hours from startTime at
+	# each of locations, as a [location, hour, feature] array. By default each location is fetched on its own.
+	def evaluateHourly(self, db, features, locations, startTime, numHours):
+		times = [startTime + datetime.timedelta(hours=hour) for hour in xrange(numHours)]
+		if not self.dependsOnLocation:
+			values = evaluateFeatures(db, features, locations[0][0], locations[0][1], times)
+			return np.repeat(values[np.newaxis], len(locations), axis=0)
+		return np.array([evaluateFeatures(db, features, latitude, longitude, times) for latitude, longitude in locations])
+
+# The day of the week (parameter 'weekday', Monday is 0) or hour of the day (parameter 'hour'). Reads nothing.
+class CalendarSource(Source):
+	dependsOnLocation = False
+
+	def getKey(self, feature):
+		return None
+
+	def fetch(self, db, latitude, longitude, startTime, endTime, key):
+		return None
+
+	def evaluate(self, data, seconds, feature):
+		seconds = seconds + 3600 * feature.window[0]
+		if feature.parameter == 'weekday':
+			return (seconds // 86400 + 3) % 7  # 1970-01-01 was a Thursday
+		return (seconds // 3600) % 24
+
+# The weather field named by parameter from the observation nearest to the start of the window, as
+# DB.getWeather finds it. Weather does not depend on location.
+class WeatherSource(Source):
+	dependsOnLocation = False
+
+	def getKey(self, feature):
+		return None
+
+	def fetch(self, db, latitude, longitude, startTime, endTime, key):
+		return db.getWeatherTimelineForRange(startTime, endTime)
+
+	def evaluate(self, timeline, seconds, feature):
+		nearest = timeline.getNearestIndices(seconds + 3600 * feature.window[0])
+		if np.any(nearest == -1):
+			raise Weather.DoesNotExist('Missing weather observations between %s and %s' % (fromEpochSeconds(seconds.min()), fromEpochSeconds(seconds.max())))
+		return timeline.getColumn(feature.parameter)[nearest]
+
+# Counts of timestamped rows within radius in the window. getTimes(db, latitude, longitude, startTime, endTime,
+# radius) returns the epoch times of the rows in a range. If given, getHourlyMatrix(db, locations, startTime,
+# numHours, radius) returns the hourly counts at every location at once like DB.getHourlyCountMatrix, and
+# hourly evaluation derives every window from it.
+class CountSource(Source):
+	def __init__(self, getTimes, getHourlyMatrix=None, dependsOnLocation=True):
+		self.getTimes = getTimes
+		self.getHourlyMatrix = getHourlyMatrix
+		self.dependsOnLocation = dependsOnLocation
+
+	def evaluateHourly(self, db, features, locations, startTime, numHours):
+		if self.getHourlyMatrix == None:
+			return Source.evaluateHourly(self, db, features, locations, startTime, numHours)
+		# The matrix starts at the earliest window start, so hour 0 sits at index -firstHours
+		firstHours = min(feature.window[0] for feature in features)
+		lastHours = max(feature.window[1] for feature in features)
+		bins, boundaries = self.getHourlyMatrix(db, locations, startTime + datetime.timedelta(hours=firstHours), numHours + lastHours - firstHours, features[0].radius)
+		return np.dstack([windowCounts(bins, boundaries, -firstHours, feature.window[0], feature.window[1], numHours) for feature in features])
+
+	def fetch(self, db, latitude, longitude, startTime, endTime, radius):
+		return np.sort(self.getTimes(db, latitude, longitude, startTime, endTime, radius))
+
+	def evaluate(self, times, seconds, feature):
+		starts = np.searchsorted(times, seconds + 3600 * feature.window[0], side='left')
+		ends = np.searchsorted(times, seconds + 3600 * feature.window[1], side='right')
+		return ends - starts
+
+# Accurately timed events within radius. With parameter 'ended' counts the events that ended in the window,
+# like DB.afterNumEvents, and with 'during' those in progress at the start of the window, like
+# DB.duringNumEvents.
+class EventSource(Source):
+	def fetch(self, db, latitude, longitude, startTime, endTime, radius):
+		starts, ends = db.getEventsNearLocation(latitude, longitude, startTime, endTime, radius)
+		return starts, ends, np.sort(ends)
+
+	def evaluate(self, events, seconds, feature):
+		starts, ends, sortedEnds = events
+		windowStarts = seconds + 3600 * feature.window[0]
+		if feature.parameter == 'ended':
+			return np.searchsorted(sortedEnds, seconds + 3600 * feature.window[1], side='right') - np.searchsorted(sortedEnds, windowStarts, side='left')
+		return ((starts[np.newaxis, :] < windowStarts[:, np.newaxis]) & (ends[np.newaxis, :] > windowStarts[:, np.newaxis])).sum(axis=1)
+
+# T rides from (label 'origin') or to (label 'destination') the parameter closest stations in the window, like
+# DB.getNumTRidesFromXClosestStations and DB.getNumTRidesToXClosestStations
+class TRideSource(Source):
+	def __init__(self, label):
+		self.label = label
+
+	def getKey(self, feature):
+		return feature.parameter
+
+	def fetch(self, db, latitude, longitude, startTime, endTime, x):
+		return db.getXClosestStations(latitude, longitude, x, True), db.getTRideCube()
+
+	def evaluate(self, stationsAndCube, seconds, feature):
+		stations, cube = stationsAndCube
+		startSeconds = seconds + 3600 * feature.window[0]
+		endSeconds = seconds + 3600 * feature.window[1]
+		counts = np.zeros(len(seconds), dtype=np.int64)
+		for station in stations:
+			counts += cube.getNumRidesArray(station, startSeconds, endSeconds, self.label)
+		return counts
+
+SOURCES = {
+	'calendar': CalendarSource(),
+	'weather': WeatherSource(),
+	'pickups': CountSource(
+		lambda db, latitude, longitude, startTime, endTime, radius: db.getTaxiTimesNearLocation(TaxiPickup, db.pickupIndex, latitude, longitude, startTime, endTime, db.metersToCoordDist(radius)),
+		lambda db, locations, startTime, numHours, radius: db.getHourlyPickupMatrix(locations, startTime, numHours, db.metersToCoordDist(radius))),
+	'dropoffs': CountSource(
+		lambda db, latitude, longitude, startTime, endTime, radius: db.getTaxiTimesNearLocation(TaxiDropoff, db.dropoffIndex, latitude, longitude, startTime, endTime, db.metersToCoordDist(radius)),
+		lambda db, locations, startTime, numHours, radius: db.getHourlyDropoffMatrix(locations, startTime, numHours, db.metersToCoordDist(radius))),
+	'tweets': CountSource(
+		lambda db, latitude, longitude, startTime, endTime, radius: db.getTweetTimesNearLocation(latitude, longitude, startTime, endTime, radius),
+		lambda db, locations, startTime, numHours, radius: db.getHourlyTweetMatrix(locations, startTime, numHours, radius)),
+	'taxiTweets': CountSource(lambda db, latitude, longitude, startTime, endTime, radius: db.getTweetTimesNearLocation(latitude, longitude, startTime, endTime, radius, mentionsTaxi=True)),
+	'allTaxiTweets': CountSource(lambda db, latitude, longitude, startTime, endTime, radius: db.getTaxiTweetTimes(startTime, endTime), dependsOnLocation=False),
+	'events': EventSource(),
+	'TRidesFrom': TRideSource('origin'),
+	'TRidesTo': TRideSource('destination'),
+}
+
+
+# The columns of features grouped by source and key, as a sorted list of ((sourceName, key), columns)
+def groupFeatures(features):
+	groups = {}
+	for column, feature in enumerate(features):
+		groups.setdefault((feature.source, SOURCES[feature.source].getKey(feature)), []).append(column)
+	return sorted(groups.iteritems())
+
+# Evaluates features at a location for each of times. The features are grouped by source (and key), and each
+# group's data is fetched once for the range spanned by all of its windows around all of the times, so the
+# number of queries depends on the sources used, not on the number of features or times. Returns a
+# len(times) x len(features) float array.
+def evaluateFeatures(db, features, latitude, longitude, times):
+	values = np.zeros((len(times), len(features)), dtype=np.float64)
+	if len(times) == 0:
+		return values
+	seconds = np.array([toEpochSeconds(time) for time in times], dtype=np.int64)
+
+	for (sourceName, key), columns in groupFeatures(features):
+		source = SOURCES[sourceName]
+		startHours = min(features[column].window[0] for column in columns)
+		endHours = max(features[column].window[1] for column in columns)
+		startTime = fromEpochSeconds(seconds.min() + 3600 * startHours)
+		endTime = fromEpochSeconds(seconds.max() + 3600 * endHours)
+		data = source.fetch(db, latitude, longitude, startTime, endTime, key)
+		for column in columns:
+			values[:, column] = source.evaluate(data, seconds, features[column])
+	return values
+
+# evaluateFeatures for numHours consecutive hours from startTime at each of locations, as a
+# [location, hour, feature] float array. Each group of features is evaluated for all the locations together,
+# so the count sources with hourly matrices need one query per group rather than one per location.
+def evaluateFeaturesHourly(db, features, locations, startTime, numHours):
+	values = np.zeros((len(locations), numHours, len(features)), dtype=np.float64)
+	if len(locations) == 0 or numHours == 0:
+		return values
+	for (sourceName, key), columns in groupFeatures(features):
+		values[:, :, columns] = SOURCES[sourceName].evaluateHourly(db, [features[column] for column in columns], locations, startTime, numHours)
+	return values
@@ -1,9 +1,15 @@
 import csv
 import os
+import bisect
 import datetime
 import math
 
+import numpy as np
+
 from ParseData.Config import DATA_FOLDER
+from ParseData.Index import toEpochSeconds
+from FeatureStore import FeatureStore
+from Features import Feature, evaluateFeatures, evaluateFeaturesHourly
 
 
 TEST_DATASET_INITIAL_FILENAME = os.path.join(DATA_FOLDER, 'test1.txt')
@@ -16,6 +22,22 @@ END_TIME = datetime.datetime(2012, 12, 1)
 START_TIME = datetime.datetime(2012, 5, 1, 3)
 END_TIME = datetime.datetime(2012, 7, 1)
 
+# Keep computed feature vectors in the feature store and only compute the missing ones
+USE_FEATURE_STORE = False
+
+# Feature generators whose output is kept in the feature store. Bump a version whenever the features it
+# generates change so the stored vectors are recomputed.
+FEATURE_SET_VERSIONS = {
+	'generateAllFeatures': 1,
+	'generateAllFeaturesExceptWeather': 1,
+}
+
+
+# Parses the 'YYYY-MM-DD HH:MM' times of the test datasets without strptime where possible
+def parseTestTime(timeStr):
+	if len(timeStr) == 16:
+		return datetime.datetime(int(timeStr[0:4]), int(timeStr[5:7]), int(timeStr[8:10]), int(timeStr[11:13]), int(timeStr[14:16]))
+	return datetime.datetime.strptime(timeStr, '%Y-%m-%d %H:%M')
 
 def loadTestDataset(filename=TEST_DATASET_INITIAL_FILENAME):
 	# Read the data
@@ -24,26 +46,69 @@ def loadTestDataset(filename=TEST_DATASET_INITIAL_FILENAME):
 	# Convert to Python ints and datetimes
 	for i in xrange(len(testDataset)):
 		testDataset[i]['id'] = int(testDataset[i]['id'])
-		testDataset[i]['start'] = datetime.datetime.strptime(testDataset[i]['start'], '%Y-%m-%d %H:%M')
-		testDataset[i]['end'] = datetime.datetime.strptime(testDataset[i]['end'], '%Y-%m-%d %H:%M')
+		testDataset[i]['start'] = parseTestTime(testDataset[i]['start'])
+		testDataset[i]['end'] = parseTestTime(testDataset[i]['end'])
 		testDataset[i]['lat'] = float(testDataset[i]['lat'])
 		testDataset[i]['long'] = float(testDataset[i]['long'])
 	return testDataset
 
-def getRemovedTimes():
-	initialTestDataset = loadTestDataset(filename=TEST_DATASET_INITIAL_FILENAME)
-	finalTestDataset = loadTestDataset(filename=TEST_DATASET_FINAL_FILENAME)
-
-	removedTimes = set()
-	for dataset in (initialTestDataset, finalTestDataset):
-		for time in dataset:
-			currentTime = time['start'] - datetime.timedelta(hours=1)
-			endTime = time['end'] + datetime.timedelta(hours=1)
-			while currentTime < endTime:
-				removedTimes.add((currentTime, time['lat'], time['long']))
-				currentTime += datetime.timedelta(hours=1)
-
-	return removedTimes
+# Groups the samples of a test dataset by location. Returns a dict from (latitude, longitude) to the samples
+# there, in file order.
+def groupTestDataset(testDataset):
+	samplesByLocation = {}
+	for sample in testDataset:
+		samplesByLocation.setdefault((sample['lat'], sample['long']), []).append(sample)
+	return samplesByLocation
+
+# The hours excluded from training at each location: every hour from an hour before to an hour after each test
+# window. They are kept per (latitude, longitude) as sorted, merged [start, end) intervals of epoch seconds.
+# Intervals are grouped by their offset into the hour, and a time only matches intervals on the same hourly
+# grid, exactly like the hour-by-hour expansion this replaces.
+class RemovedTimes:
+	def __init__(self, windows):
+		intervals = {}
+		for latitude, longitude, start, end in windows:
+			intervals.setdefault((latitude, longitude), {}).setdefault(start % 3600, []).append((start, end))
+
+		self.intervals = {}
+		for location, phases in intervals.iteritems():
+			self.intervals[location] = {}
+			for phase, phaseIntervals in phases.iteritems():
+				merged = []
+				for start, end in sorted(phaseIntervals):
+					if len(merged) > 0 and start <= merged[-1][1]:
+						merged[-1][1] = max(merged[-1][1], end)
+					else:
+						merged.append([start, end])
+				self.intervals[location][phase] = (np.array([start for start, end in merged], dtype=np.int64), np.array([end for start, end in merged], dtype=np.int64))
+
+	@classmethod
+	def fromTestDatasets(cls, filenames):
+		hour = datetime.timedelta(hours=1)
+		return cls((window['lat'], window['long'], toEpochSeconds(window['start'] - hour), toEpochSeconds(window['end'] + hour))
+			for filename in filenames for window in loadTestDataset(filename))
+
+	def contains(self, time, latitude, longitude):
+		seconds = toEpochSeconds(time)
+		phases = self.intervals.get((latitude, longitude))
+		if phases == None or seconds % 3600 not in phases:
+			return False
+		starts, ends = phases[seconds % 3600]
+		index = bisect.bisect_right(starts, seconds) - 1
+		return index >= 0 and seconds < ends[index]
+
+	# Boolean mask of the removed hours among numHours hours from startTime
+	def getMask(self, latitude, longitude, startTime, numHours):
+		seconds = toEpochSeconds(startTime) + 3600 * np.arange(numHours, dtype=np.int64)
+		phases = self.intervals.get((latitude, longitude), {})
+		if toEpochSeconds(startTime) % 3600 not in phases:
+			return np.zeros(numHours, dtype=bool)
+		starts, ends = phases[toEpochSeconds(startTime) % 3600]
+		indices = np.searchsorted(starts, seconds, side='right') - 1
+		return (indices >= 0) & (seconds < ends[np.maximum(indices, 0)])
+
+def getRemovedTimes(filenames=(TEST_DATASET_INITIAL_FILENAME, TEST_DATASET_FINAL_FILENAME)):
+	return RemovedTimes.fromTestDatasets(filenames)
 
 def getPointsOfInterest():
 	with open(POINTS_OF_INTEREST_FILENAME) as f:
@@ -54,155 +119,231 @@ def getPointsOfInterest():
 			POIs.append(point)
 	return POIs
 
+# Loaded on first use so importing Lib doesn't read the test datasets
+REMOVED_TIMES = None
+
+def getRemovedTimesOnce():
+	global REMOVED_TIMES
+	if REMOVED_TIMES == None:
+		REMOVED_TIMES = getRemovedTimes()
+	return REMOVED_TIMES
+
 def isRemovedTime(time, latitude, longitude):
-	return (time, latitude, longitude) in REMOVED_TIMES
+	return getRemovedTimesOnce().contains(time, latitude, longitude)
+
+# The number of pickups between the current hour and 2 hours after it, which the models predict
+LABEL = Feature('numPickups', 'pickups', (0, 2))
+
+# The feature store for generateX, or None if it has no entry in FEATURE_SET_VERSIONS. Stores are namespaced by
+# the DB's data identity too, so each database or snapshot has its own and ingesting more data starts a new one.
+FEATURE_STORES = {}
+def getFeatureStore(db, generateX):
+	return getNamedFeatureStore(db, generateX.__name__)
+
+def getNamedFeatureStore(db, name):
+	if not USE_FEATURE_STORE or name not in FEATURE_SET_VERSIONS:
+		return None
+	namespace = '%s.v%i.%s' % (name, FEATURE_SET_VERSIONS[name], db.getDataIdentity())
+	if namespace not in FEATURE_STORES:
+		FEATURE_STORES[namespace] = FeatureStore(namespace)
+	return FEATURE_STORES[namespace]
+
+# Mask of the rows at a location (by hour start time) that any of features, which all read the same source,
+# computes from the rows of that source at the epoch times, latitudes and longitudes: those within the
+# feature's radius and window
+def getStaleMask(db, features, latitude, longitude, rowSeconds, times, latitudes, longitudes):
+	isStale = np.zeros(len(rowSeconds), dtype=bool)
+	distances = np.sqrt((latitudes - latitude) ** 2 + (longitudes - longitude) ** 2)
+	for feature in features:
+		nearTimes = np.sort(times[distances <= db.metersToCoordDist(feature.radius)])
+		if len(nearTimes) > 0:
+			isStale |= np.searchsorted(nearTimes, rowSeconds + 3600 * feature.window[1], side='right') > np.searchsorted(nearTimes, rowSeconds + 3600 * feature.window[0], side='left')
+	return isStale
+
+# Drops the rows computed from rows of source appended at the epoch times, latitudes and longitudes (see
+# DB.appendTaxiDicts) from every feature store, at every stored location, so they are computed again.
+# Generators without a feature set can't tell which of their rows read source, so all of theirs are dropped.
+def removeStaleFeatures(db, source, times, latitudes, longitudes):
+	for name in sorted(FEATURE_SET_VERSIONS):
+		featureStore = getNamedFeatureStore(db, name)
+		if featureStore == None:
+			continue
+		features = [feature for feature in FEATURE_SETS.get(name, []) + [LABEL] if feature.source == source]
+		for latitude, longitude in featureStore.getLocations():
+			storedSeconds = featureStore.getSeconds(latitude, longitude)
+			if name not in FEATURE_SETS:
+				featureStore.remove(latitude, longitude, storedSeconds)
+			else:
+				featureStore.remove(latitude, longitude, storedSeconds[getStaleMask(db, features, latitude, longitude, storedSeconds, times, latitudes, longitudes)])
+
+# Feature vectors from generateX for each of times at a location and, with withLabels, their labels. Returns
+# NumPy arrays (x, y) with y None without labels. Vectors and labels already in the feature store are read
+# from it, the missing ones are computed and added to it.
+def loadFeatures(db, latitude, longitude, generateX, times, withLabels=True):
+	seconds = np.array([toEpochSeconds(time) for time in times], dtype=np.int64)
+	featureStore = getFeatureStore(db, generateX)
+	inputs = [None] * len(times)
+	outputs = [np.nan] * len(times)
+	if featureStore != None:
+		found, storedInputs, storedOutputs = featureStore.get(latitude, longitude, seconds)
+		for i, storedInput, storedOutput in zip(np.flatnonzero(found), storedInputs if storedInputs is not None else [], storedOutputs if storedOutputs is not None else []):
+			inputs[i] = storedInput
+			outputs[i] = storedOutput
+
+	# Feature sets are evaluated for all the missing times at once, other generators one time at a time
+	missingInputs = [i for i in xrange(len(times)) if inputs[i] is None]
+	features = FEATURE_SETS.get(generateX.__name__)
+	if features != None:
+		values = evaluateFeatures(db, features, latitude, longitude, [times[i] for i in missingInputs])
+	else:
+		values = [generateX(db, latitude, longitude, times[i]) for i in missingInputs]
+	for i, value in zip(missingInputs, values):
+		inputs[i] = value
+
+	missingOutputs = [i for i in xrange(len(times)) if np.isnan(outputs[i])] if withLabels else []
+	for i, value in zip(missingOutputs, evaluateFeatures(db, [LABEL], latitude, longitude, [times[i] for i in missingOutputs])[:, 0]):
+		outputs[i] = value
+	computed = sorted(set(missingInputs) | set(missingOutputs))
+
+	if featureStore != None and len(computed) > 0:
+		featureStore.put(latitude, longitude, seconds[computed], [inputs[i] for i in computed], [outputs[i] for i in computed])
+
+	inputs = np.array(inputs, dtype=np.float64) if len(times) > 0 else np.zeros((0, 0))
+	return inputs, np.array(outputs) if withLabels else None
 
 # Returns an x, y tuple representing the input and output
 #
 # Outputs are the number of pickups between currentTime and 2 hours from currentTime
 def loadData(db, latitude, longitude, generateX, startTime=START_TIME, endTime=END_TIME, includeFunc=None):
-	inputs = []
-	outputs = []
+	times = []
 	currentTime = startTime
 	if includeFunc == None:
 		includeFunc = lambda db, latitude, longitude, currentTime: True
 	while currentTime < endTime:
 		if not isRemovedTime(currentTime, latitude, longitude) and includeFunc(db, latitude, longitude, currentTime):
-			# Populate the inputs
-			inputs.append(generateX(db, latitude, longitude, currentTime))
-
-			# Calculate the number of pickups for the current hour
-			numPickups = db.getNumPickupsNearLocation(latitude, longitude, currentTime, currentTime + datetime.timedelta(hours=2))
-			outputs.append(numPickups)
-
+			times.append(currentTime)
 		currentTime += datetime.timedelta(hours=1)
-	return inputs, outputs
-
-REMOVED_TIMES = getRemovedTimes()
-
 
-# Convenience method for populating inputs
-# Inputs are the following:
-#   Day of the week
-#   Current time
-#   Current Weather (tempi, precipm, hum, wspdi, windchilli, heatindexi, conds, fog, rain, snow, hail, thunder, tornado)
-#   Number of pickups between 2 and 1 hour before the currentTime
-#   Number of pickups between 3 and 4 hours after the currentTime
-# TODO:
-#   - Mixture Model?
-#   - Use conds instead of rain
-#   - Use different models for each of fog, rain, snow, etc.
-weekdays = [[math.sin(x * 2.0 * math.pi / 7.0), math.cos(x * 2.0 * math.pi / 7.0)] for x in xrange(7)]
-times = [[math.sin(x * 2.0 * math.pi / 24.0), math.cos(x * 2.0 * math.pi / 24.0)] for x in xrange(24)]
-def generateAllFeatures(db, latitude, longitude, time):
+	# Generators of a single number (like Plots.generateHour) give plain numbers rather than tuples
+	inputs, outputs = loadFeatures(db, latitude, longitude, generateX, times)
+	return [tuple(inputVector) if np.ndim(inputVector) > 0 else inputVector.item() for inputVector in inputs], [int(output) for output in outputs]
+
+# Batched equivalent of loadData(db, latitude, longitude, generateAllFeatures). Returns NumPy arrays (x, y).
+def loadDataBatched(db, latitude, longitude, startTime=START_TIME, endTime=END_TIME):
+	return loadAllDataBatched(db, [(latitude, longitude)], startTime, endTime)[0]
+
+# loadDataBatched for each of locations, a list of (latitude, longitude) such as
+# [(POI['LAT'], POI['LONG']) for POI in getPointsOfInterest()]. Returns a list of (x, y) tuples in the order
+# of locations. The rows are ALL_FEATURES and LABEL, like generateAllFeatures', so they share its feature store:
+# locations whose every hour is stored are read from it, the others are evaluated together with
+# evaluateFeaturesHourly and stored. With withSeconds the tuples are (x, y, seconds), seconds being the epoch
+# start time of each row's hour.
+def loadAllDataBatched(db, locations, startTime=START_TIME, endTime=END_TIME, withSeconds=False):
+	numHours = int(math.ceil((endTime - startTime).total_seconds() / 3600.0))
+	seconds = toEpochSeconds(startTime) + 3600 * np.arange(numHours, dtype=np.int64)
+	featureStore = getFeatureStore(db, generateAllFeatures)
+
+	stored = {}
+	if featureStore != None:
+		for latitude, longitude in locations:
+			found, inputs, outputs = featureStore.get(latitude, longitude, seconds)
+			if found.all() and not np.isnan(outputs).any():
+				stored[(latitude, longitude)] = (inputs, outputs)
+
+	missing = [location for location in locations if location not in stored]
+	if len(missing) > 0:
+		values = evaluateFeaturesHourly(db, ALL_FEATURES + [LABEL], missing, startTime, numHours)
+		inputs, outputs = values[:, :, :-1], values[:, :, -1]
+		for i, (latitude, longitude) in enumerate(missing):
+			stored[(latitude, longitude)] = (inputs[i], outputs[i])
+			if featureStore != None:
+				featureStore.put(latitude, longitude, seconds, inputs[i], outputs[i])
+
+	data = []
+	for latitude, longitude in locations:
+		inputs, outputs = stored[(latitude, longitude)]
+		included = ~getRemovedTimesOnce().getMask(latitude, longitude, startTime, numHours)
+		if withSeconds:
+			data.append((inputs[included], outputs[included].astype(np.int64), seconds[included]))
+		else:
+			data.append((inputs[included], outputs[included].astype(np.int64)))
+	return data
+
+
+# The inputs of generateAllFeatures. Each reads one of Features.SOURCES, and features sharing a source are
+# computed from a single fetch, so adding one costs no extra queries.
+ALL_FEATURES = [
 	# Day of the week and time of day
-	timeFeatures = [time.weekday(), time.hour]
-	# timeFeatures = weekdays[time.weekday()] + times[time.hour]
-	
-	# Weather
-	weather = db.getWeather(time)
-	precip = weather.precipm
-	if precip == None:
-		precip = 0.0
-	windchill = weather.windchilli
-	if windchill == None:
-		windchill = 0.0
-	heatindex = weather.heatindexi
-	if heatindex == None:
-		heatindex = 0.0
-	# Maybe remove: weather.wspdi
-	weatherFeatures = [float(weather.tempi), float(weather.wspdi), float(windchill), float(heatindex), int(weather.rain), int(weather.thunder)]
+	Feature('weekday', 'calendar', parameter='weekday'),
+	Feature('hour', 'calendar', parameter='hour'),
+
+	# Weather. Maybe remove: wspdi
+	Feature('tempi', 'weather', parameter='tempi'),
+	Feature('wspdi', 'weather', parameter='wspdi'),
+	Feature('windchilli', 'weather', parameter='windchilli'),
+	Feature('heatindexi', 'weather', parameter='heatindexi'),
+	Feature('rain', 'weather', parameter='rain'),
+	Feature('thunder', 'weather', parameter='thunder'),
+
+	# Pickups and dropoffs near the given timeframe
+	Feature('numPickupsBefore', 'pickups', (-2, -1)),
+	Feature('numPickupsAfter', 'pickups', (3, 4)),
+	Feature('numDropoffsBefore1', 'dropoffs', (-1, 0)),
+	Feature('numDropoffsBefore2', 'dropoffs', (-2, -1)),
+	Feature('numDropoffsDuring', 'dropoffs', (0, 1)),
+	Feature('numDropoffsAfter', 'dropoffs', (1, 2)),
+
+	# Not used for now
+	# Feature('afterNumEvents1', 'events', (-1, 0), parameter='ended'),
+	# Feature('duringNumEvents1', 'events', (-1, -1), parameter='during'),
+	# Feature('nearLoc', 'tweets', (0, 2), radius=250),
+	# Feature('nearLocMentioningTaxi', 'taxiTweets', (0, 2), radius=250),
+	# Feature('mentioningTaxi', 'allTaxiTweets', (0, 2)),
+	# Feature('TRidesToDuring', 'TRidesTo', (0, 1), parameter=3),
+	# Feature('TRidesFromDuring', 'TRidesFrom', (0, 1), parameter=3),
+]
+
+# The inputs of generateAllFeaturesExceptWeather
+ALL_FEATURES_EXCEPT_WEATHER = [
+	# Day of the week and time of day
+	Feature('weekday', 'calendar', parameter='weekday'),
+	Feature('hour', 'calendar', parameter='hour'),
 
 	# Pickups near the given timeframe
-	numPickupsBefore = db.getNumPickupsNearLocation(latitude, longitude, time - datetime.timedelta(hours=2), time - datetime.timedelta(hours=1))
-	numPickupsAfter = db.getNumPickupsNearLocation(latitude, longitude, time + datetime.timedelta(hours=3), time + datetime.timedelta(hours=4))
-
-	numDropoffsBefore1 = db.getNumDropoffsNearLocation(latitude, longitude, time - datetime.timedelta(hours=1), time)
-	numDropoffsBefore2 = db.getNumDropoffsNearLocation(latitude, longitude, time - datetime.timedelta(hours=2), time - datetime.timedelta(hours=1))
-	numDropoffsDuring = db.getNumDropoffsNearLocation(latitude, longitude, time, time + datetime.timedelta(hours=1))
-	numDropoffsAfter = db.getNumDropoffsNearLocation(latitude, longitude, time + datetime.timedelta(hours=1), time + datetime.timedelta(hours=2))
-	pickupFeatures = [numPickupsBefore, numPickupsAfter, numDropoffsBefore1, numDropoffsBefore2, numDropoffsDuring, numDropoffsAfter]
-
-	# Events
-	afterNumEvents = [db.afterNumEvents(latitude, longitude, time, i) for i in xrange(4)]
-	duringNumEvents = [db.duringNumEvents(latitude, longitude, time - datetime.timedelta(hours=i)) for i in xrange(-4, 4)]
-
-	eventFeatures = afterNumEvents + duringNumEvents
-
-	# Tweets
-	# TODO: try 1-hour interval
-	# nearLoc = db.getNumTweetsNearLocation(latitude, longitude, time, time+datetime.timedelta(hours=2), distInMeters=250)
-	# nearLocMentioningTaxi = db.getNumTweetsNearLocationMentioningTaxi(latitude, longitude, time, time+datetime.timedelta(hours=2), distInMeters=250)
-	# mentioningTaxi = db.getNumTweetsMentioningTaxi(time, time+datetime.timedelta(hours=2))
-	# tweetFeatures = [nearLoc, nearLocMentioningTaxi, mentioningTaxi]
-
-	# T Ride features
-	TFeatures = []
-	# TFeatures.extend([db.getNumTRidesToXClosestStations(latitude, longitude, time + datetime.timedelta(hours=hours), time + datetime.timedelta(hours=hours+1), 2) for hours in xrange(3)])
-	# TFeatures.append(db.getNumTRidesToXClosestStations(latitude, longitude, time - datetime.timedelta(hours=1), time, 3))
-	# TFeatures.append(db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=1), 3))
-	# TFeatures.append(db.getNumTRidesFromXClosestStations(latitude, longitude, time - datetime.timedelta(hours=1), time, 3))
-	# TFeatures.append(db.getNumTRidesFromXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=1), 3))
-
-	# Generate the vector
-	# inputVector = tuple(timeFeatures + weatherFeatures + pickupFeatures + eventFeatures + tweetFeatures)
-	inputVector = tuple(timeFeatures + weatherFeatures + pickupFeatures)# + eventFeatures)# + tweetFeatures + TFeatures)
-	if any(inp == None for inp in inputVector):
-		print 'Some input is None:', inputVector
-	return inputVector
+	Feature('numPickupsBefore', 'pickups', (-2, -1)),
+	Feature('numPickupsAfter', 'pickups', (3, 4)),
+] + [
+	# T Rides
+	Feature('TRidesTo%i' % hours, 'TRidesTo', (hours, hours + 1), parameter=2) for hours in xrange(3)
+] + [
+	Feature('TRidesFrom%i_%i' % (x, start), 'TRidesFrom', (start, start + 1), parameter=x) for x in xrange(1, 4) for start in [-1, -2, 0, 1, 2]
+]
 
+# Hours after a row's hour read by its features or label, so the last hour with all of its data observed
+LOOK_AHEAD_HOURS = max(feature.window[1] for feature in ALL_FEATURES + [LABEL])
+
+# The features generated by each feature generator, by name, so whole ranges can be evaluated at once by
+# evaluateFeatures
+FEATURE_SETS = {
+	'generateAllFeatures': ALL_FEATURES,
+	'generateAllFeaturesExceptWeather': ALL_FEATURES_EXCEPT_WEATHER,
+}
 
 # Convenience method for populating inputs
 # Inputs are the following:
 #   Day of the week
 #   Current time
-#   Current Weather (tempi, precipm, hum, wspdi, windchilli, heatindexi, conds, fog, rain, snow, hail, thunder, tornado)
+#   Current Weather (tempi, wspdi, windchilli, heatindexi, rain, thunder)
 #   Number of pickups between 2 and 1 hour before the currentTime
 #   Number of pickups between 3 and 4 hours after the currentTime
+#   Number of dropoffs in each hour from 2 hours before to 2 hours after the currentTime
 # TODO:
 #   - Mixture Model?
 #   - Use conds instead of rain
 #   - Use different models for each of fog, rain, snow, etc.
-def generateAllFeaturesExceptWeather(db, latitude, longitude, time):
-	# Day of the week and time of day
-	timeFeatures = [time.weekday(), time.hour]
-	timeFeatures2 = weekdays[time.weekday()] + times[time.hour]
-
-	# Events
-	afterNumEvents = [db.afterNumEvents(latitude, longitude, time, i) for i in xrange(4)]
-	duringNumEvents = [db.duringNumEvents(latitude, longitude, time - datetime.timedelta(hours=i)) for i in xrange(-4, 4)]
-
-	eventFeatures = afterNumEvents + duringNumEvents
-
-	# Pickups near the given timeframe
-	numPickupsBefore = db.getNumPickupsNearLocation(latitude, longitude, time - datetime.timedelta(hours=2), time - datetime.timedelta(hours=1))
-	numPickupsAfter = db.getNumPickupsNearLocation(latitude, longitude, time + datetime.timedelta(hours=3), time + datetime.timedelta(hours=4))
-	pickupFeatures = [numPickupsBefore, numPickupsAfter]
+def generateAllFeatures(db, latitude, longitude, time):
+	return tuple(evaluateFeatures(db, ALL_FEATURES, latitude, longitude, [time])[0])
 
-	# T Rides
-	TFeatures = []
-	TFeatures.extend([db.getNumTRidesToXClosestStations(latitude, longitude, time + datetime.timedelta(hours=hours), time + datetime.timedelta(hours=hours+1), 2) for hours in xrange(3)])
-	for x in xrange(1,4):
-		TFeatures.extend([db.getNumTRidesFromXClosestStations(latitude, longitude, time - datetime.timedelta(hours=hours+1), time - datetime.timedelta(hours=hours), x) for hours in xrange(2)])
-		TFeatures.extend([db.getNumTRidesFromXClosestStations(latitude, longitude, time + datetime.timedelta(hours=hours), time + datetime.timedelta(hours=hours+1), x) for hours in xrange(3)])
-	# numTRides1 = [db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=hours), 1) for hours in xrange(-2,3)]
-	# numTRides2 = [db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=hours), 2) for hours in xrange(-2,3)]
-	# numTRides3 = [db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=hours), 3) for hours in xrange(-2,3)]
-	# numTRides4 = [db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=hours), 4) for hours in xrange(-2,3)]
-	# numTRides1 = db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=0), 1)
-	# numTRides2 = db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=0), 2)
-	# numTRides3 = db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=0), 3)
-	# numTRides4 = db.getNumTRidesToXClosestStations(latitude, longitude, time, time + datetime.timedelta(hours=0), 4)
-	# TFeatures = numTRides1 + numTRides2 + numTRides3 + numTRides4
-
-	# Tweets
-	nearLoc = db.getNumTweetsNearLocation(latitude, longitude, time, time+datetime.timedelta(hours=2), distInMeters=250)
-	nearLocMentioningTaxi = db.getNumTweetsNearLocationMentioningTaxi(latitude, longitude, time, time+datetime.timedelta(hours=2), distInMeters=250)
-	mentioningTaxi = db.getNumTweetsMentioningTaxi(time, time+datetime.timedelta(hours=2))
-	tweetFeatures = [nearLoc, nearLocMentioningTaxi, mentioningTaxi]
-
-	# Generate the vector
-	inputVector = tuple(timeFeatures + pickupFeatures + TFeatures)
-	if any(inp == None for inp in inputVector):
-		print 'Some input is None:', inputVector
-	return inputVector
+# Like generateAllFeatures, with T rides from and to the closest stations instead of weather and dropoffs
+def generateAllFeaturesExceptWeather(db, latitude, longitude, time):
+	return tuple(evaluateFeatures(db, ALL_FEATURES_EXCEPT_WEATHER, latitude, longitude, [time])[0])
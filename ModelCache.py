@@ -0,0 +1,117 @@
+import os
+import re
+import sys
+import hashlib
+import cPickle as pickle
+
+import numpy as np
+import sklearn
+
+from ParseData.Config import DATA_FOLDER
+
+
+MODEL_CACHE_FOLDER = os.path.join(DATA_FOLDER, 'models')
+
+# Bump whenever the way pipelines are fitted changes in a way the fingerprint does not capture
+MODEL_CACHE_VERSION = 1
+
+
+# A stable representation of a parameter value. Functions (like SelectKBest's score_func) are named rather
+# than repr'd since their repr holds an address, and nested estimators are left out since their parameters
+# are listed separately by get_params(deep=True).
+def getParameterString(value):
+	if hasattr(value, 'get_params'):
+		return type(value).__name__
+	if callable(value) and hasattr(value, '__name__'):
+		return '%s.%s' % (getattr(value, '__module__', None), value.__name__)
+	return repr(value)
+
+# Whether value is a list of (name, estimator) pairs, like a Pipeline's steps. Their repr holds the repr of
+# every parameter, addresses included, and each of those parameters is listed separately anyway.
+def isEstimatorList(value):
+	return isinstance(value, list) and all(isinstance(item, tuple) and len(item) == 2 and hasattr(item[1], 'get_params') for item in value)
+
+# The 'name=value' lines of the parameters that identify an unfitted pipeline, sorted by name
+def getParameterLines(pipeline):
+	lines = []
+	for name, value in sorted(pipeline.get_params(deep=True).iteritems()):
+		# The number of threads does not change the fit
+		if name.endswith('n_jobs') or isEstimatorList(value):
+			continue
+		lines.append('%s=%s' % (name, getParameterString(value)))
+	return lines
+
+# Identifies a fitted pipeline: a SHA-1 of the training data, the factory that made the pipeline, the
+# parameters of the unfitted pipeline and the scikit-learn version the pickle is tied to. The number of threads
+# is left out, so a pipeline fitted in a worker process is reused by a serial run.
+def getFingerprint(x, y, generatePipeline, pipeline):
+	x = np.ascontiguousarray(x, dtype=np.float64)
+	y = np.ascontiguousarray(y, dtype=np.float64)
+	fingerprint = hashlib.sha1()
+	fingerprint.update('%i %s %s\n' % (MODEL_CACHE_VERSION, sklearn.__version__, generatePipeline.__name__))
+	fingerprint.update('%r %r\n' % (x.shape, y.shape))
+	fingerprint.update(x.tostring())
+	fingerprint.update(y.tostring())
+	for line in getParameterLines(pipeline):
+		fingerprint.update(line + '\n')
+	return fingerprint.hexdigest()
+
+
+# Fitted pipelines pickled per POI along with the fingerprint they were fitted for. A pipeline is only
+# returned for the fingerprint it was saved with, so a POI whose training data, features or estimator changed
+# is refitted and overwritten.
+class ModelCache:
+	def __init__(self, folder=MODEL_CACHE_FOLDER):
+		self.folder = folder
+
+	def getFilename(self, latitude, longitude):
+		return os.path.join(self.folder, '%.6f_%.6f.p' % (latitude, longitude))
+
+	# Returns the pipeline fitted for fingerprint, or None
+	def load(self, latitude, longitude, fingerprint):
+		filename = self.getFilename(latitude, longitude)
+		if not os.path.exists(filename):
+			return None
+		with open(filename, 'rb') as f:
+			savedFingerprint = pickle.load(f)
+			if savedFingerprint != fingerprint:
+				return None
+			return pickle.load(f)
+
+	def save(self, latitude, longitude, fingerprint, pipeline):
+		if not os.path.isdir(self.folder):
+			os.makedirs(self.folder)
+		# The fingerprint is pickled first so mismatches are found without unpickling the pipeline. Write to a
+		# temporary file first so an interrupted run never leaves a truncated one.
+		filename = self.getFilename(latitude, longitude)
+		with open(filename + '.tmp', 'wb') as f:
+			pickle.dump(fingerprint, f, pickle.HIGHEST_PROTOCOL)
+			pickle.dump(pipeline, f, pickle.HIGHEST_PROTOCOL)
+		if os.path.exists(filename):
+			os.remove(filename)
+		os.rename(filename + '.tmp', filename)
+
+
+# Checks that every pipeline factory of SVM gets the same fingerprint for two fresh pipelines on the same data,
+# and that no parameter is represented by something that differs between processes, like an address
+if __name__ == '__main__':
+	import SVM
+
+	x = np.random.RandomState(0).rand(100, 14)
+	y = np.arange(100)
+	failed = False
+	for name in sorted(dir(SVM)):
+		generatePipeline = getattr(SVM, name)
+		if not name.startswith('generate') or not name.endswith('Pipeline') or not callable(generatePipeline):
+			continue
+		# Some factories use estimators that only exist in some scikit-learn versions
+		try:
+			generatePipeline(x)
+		except (AttributeError, ImportError) as e:
+			print '%-40s skipped: %s' % (name, e)
+			continue
+		addresses = [line for line in getParameterLines(generatePipeline(x)) if re.search(r' at 0x[0-9a-fA-F]+', line)]
+		isStable = getFingerprint(x, y, generatePipeline, generatePipeline(x)) == getFingerprint(x, y, generatePipeline, generatePipeline(x))
+		print '%-40s %s' % (name, 'ok' if isStable and len(addresses) == 0 else 'UNSTABLE %s' % addresses)
+		failed |= not isStable or len(addresses) > 0
+	sys.exit(1 if failed else 0)
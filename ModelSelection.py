@@ -0,0 +1,165 @@
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+import SVM
+from ParseData.Database import DB
+from Lib import loadAllDataBatched, getPointsOfInterest, LOOK_AHEAD_HOURS
+
+
+# Compares pipeline factories and hyperparameters on every POI. The feature matrices are loaded once, then
+# each (POI, candidate) pair is cross-validated in a worker process on time-ordered folds, and the scores and
+# the time spent fitting and predicting are reported per POI and per candidate.
+
+# Pipeline factories from SVM and the values to try for each of their parameters, as named by
+# Pipeline.set_params. Every combination of values is a candidate.
+MODEL_GRID = [
+	(SVM.generateRandomForestPipeline, {'rf__n_estimators': [50, 100], 'rf__min_samples_split': [2, 5]}),
+	(SVM.generateExtraTreesPipeline, {'et__n_estimators': [50, 100]}),
+	(SVM.generateGradientBoostingPipeline, {'grb__n_estimators': [100], 'grb__max_depth': [3, 5]}),
+	(SVM.generateAdaBoostPipeline, {'ada__n_estimators': [50]}),
+	(SVM.generateKNearestNeighborsPipeline, {'knn__n_neighbors': [10, 25, 50]}),
+	(SVM.generateSVRPipeline, {'svr__C': [1.0, 10.0]}),
+	(SVM.generatePLSRegressionPipeline, {'pls__n_components': [2]}),
+]
+
+NUM_FOLDS = 4
+
+# Training rows are at least this many hours before the first row a fold tests, since a row's features and
+# label read up to this far ahead and would otherwise overlap the test rows' labels
+GAP_HOURS = LOOK_AHEAD_HOURS
+
+
+# Every (generatePipeline, params) combination of a grid
+def getCandidates(grid=MODEL_GRID):
+	candidates = []
+	for generatePipeline, values in grid:
+		names = sorted(values)
+		for combination in itertools.product(*[values[name] for name in names]):
+			candidates.append((generatePipeline, dict(zip(names, combination))))
+	return candidates
+
+# Splits rows into numFolds time-ordered folds. The rows are sorted by time and cut into numFolds + 1 blocks
+# of equal size. Each fold tests one block after the first and trains on the rows more than gapHours before
+# it, so a model is never trained on the future. The hours removed around the test windows are not in the
+# rows to begin with, so a block may span such a gap but never trains on it. Returns (train, test) index
+# arrays, leaving out folds with no training rows.
+def getTimeSeriesFolds(seconds, numFolds=NUM_FOLDS, gapHours=GAP_HOURS):
+	blocks = np.array_split(np.argsort(seconds, kind='mergesort'), numFolds + 1)
+	folds = []
+	for test in blocks[1:]:
+		if len(test) == 0:
+			continue
+		train = np.flatnonzero(seconds < seconds[test].min() - 3600 * gapHours)
+		if len(train) > 0:
+			folds.append((train, test))
+	return folds
+
+
+# The (x, y, seconds) of each POI, set in each worker process by initWorker so it is only sent once
+POI_DATA = None
+
+def initWorker(data):
+	global POI_DATA
+	POI_DATA = data
+
+# Cross-validates one candidate on one POI. Runs in a worker process.
+def evaluateCandidate(args):
+	POIIndex, (generatePipeline, params), numFolds = args
+	x, y, seconds = POI_DATA[POIIndex]
+	result = {'POI': POIIndex, 'pipeline': generatePipeline.__name__, 'params': params, 'folds': 0, 'fitTime': 0.0, 'predictTime': 0.0}
+	errors = []
+	try:
+		for train, test in getTimeSeriesFolds(seconds, numFolds):
+			pipeline = generatePipeline(x[train])
+			# The candidates already run in parallel, so estimators are kept to a single thread
+			pipeline.set_params(**dict((name, 1) for name in pipeline.get_params() if name.endswith('__n_jobs')))
+			pipeline.set_params(**params)
+
+			start = time.time()
+			pipeline.fit(x[train], y[train])
+			result['fitTime'] += time.time() - start
+
+			start = time.time()
+			predictions = np.maximum(np.asarray(pipeline.predict(x[test]), dtype=np.float64).reshape(len(test)), 0)
+			result['predictTime'] += time.time() - start
+
+			errors.append(predictions - y[test])
+			result['folds'] += 1
+	# Any failure of a candidate (bad parameters, LinAlgError...) is recorded so the others still get reported
+	except Exception as e:
+		result['error'] = '%s: %s' % (type(e).__name__, e)
+
+	errors = np.concatenate(errors) if len(errors) > 0 else np.zeros(0)
+	result['rmse'] = float(np.sqrt(np.mean(errors ** 2))) if len(errors) > 0 and 'error' not in result else float('nan')
+	result['mae'] = float(np.mean(np.abs(errors))) if len(errors) > 0 and 'error' not in result else float('nan')
+	return result
+
+# Evaluates every candidate on every POI over numProcesses worker processes. Returns one result per
+# (POI, candidate) pair.
+def runModelSelection(data, candidates, numFolds=NUM_FOLDS, numProcesses=SVM.NUM_PROCESSES):
+	tasks = [(POIIndex, candidate, numFolds) for POIIndex in xrange(len(data)) for candidate in candidates]
+	if numProcesses == 1:
+		initWorker(data)
+		return map(evaluateCandidate, tasks)
+	pool = multiprocessing.Pool(numProcesses, initWorker, (data,))
+	try:
+		return pool.map(evaluateCandidate, tasks, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+
+# Sorts by rmse, failed candidates (NaN) last
+def getSortKey(rmse):
+	return (np.isnan(rmse), rmse)
+
+def getCandidateName(result):
+	return '%s(%s)' % (result['pipeline'], ', '.join('%s=%r' % item for item in sorted(result['params'].iteritems())))
+
+# Prints the results per POI, then per candidate averaged over the POIs, best first
+def printResults(results, POIs):
+	print '%-70s %10s %10s %10s %10s' % ('POI / candidate', 'rmse', 'mae', 'fit (s)', 'predict (s)')
+	for POIIndex, POI in enumerate(POIs):
+		print POI.get('NAME', POIIndex)
+		for result in sorted((result for result in results if result['POI'] == POIIndex), key=lambda result: getSortKey(result['rmse'])):
+			print '  %-68s %10.3f %10.3f %10.2f %10.2f%s' % (getCandidateName(result), result['rmse'], result['mae'], result['fitTime'], result['predictTime'], '  ' + result['error'] if 'error' in result else '')
+
+	summaries = {}
+	for result in results:
+		summary = summaries.setdefault(getCandidateName(result), {'rmse': [], 'mae': [], 'fitTime': 0.0, 'predictTime': 0.0})
+		summary['rmse'].append(result['rmse'])
+		summary['mae'].append(result['mae'])
+		summary['fitTime'] += result['fitTime']
+		summary['predictTime'] += result['predictTime']
+	print
+	print '%-70s %10s %10s %10s %10s' % ('Candidate (mean over POIs)', 'rmse', 'mae', 'fit (s)', 'predict (s)')
+	for name, summary in sorted(summaries.iteritems(), key=lambda item: getSortKey(np.mean(item[1]['rmse']))):
+		print '%-70s %10.3f %10.3f %10.2f %10.2f' % (name, np.mean(summary['rmse']), np.mean(summary['mae']), summary['fitTime'], summary['predictTime'])
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Cross-validate the pipeline factories of MODEL_GRID on every POI')
+	parser.add_argument('--processes', type=int, default=SVM.NUM_PROCESSES)
+	parser.add_argument('--folds', type=int, default=NUM_FOLDS)
+	parser.add_argument('--output', help='File to write the JSON results to')
+	args = parser.parse_args()
+
+	POIs = getPointsOfInterest()
+	start = time.time()
+	with DB() as db:
+		data = loadAllDataBatched(db, [(POI['LAT'], POI['LONG']) for POI in POIs], withSeconds=True)
+	print 'Loading data took %s seconds' % (time.time() - start)
+
+	start = time.time()
+	results = runModelSelection(data, getCandidates(), args.folds, args.processes)
+	print 'Model selection took %s seconds' % (time.time() - start)
+	printResults(results, POIs)
+
+	if args.output != None:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
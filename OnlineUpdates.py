@@ -0,0 +1,191 @@
+import os
+import csv
+import time
+import argparse
+
+import numpy as np
+
+import SVM
+from ModelCache import ModelCache, getFingerprint, MODEL_CACHE_FOLDER
+from ParseData.Database import DB
+from ParseData.Index import toEpochSeconds, fromEpochSeconds
+from Lib import loadAllDataBatched, loadFeatures, removeStaleFeatures, getStaleMask, getRemovedTimesOnce, getPointsOfInterest, generateAllFeatures, ALL_FEATURES, LABEL, LOOK_AHEAD_HOURS, START_TIME, END_TIME
+
+
+# Trees replaced per update in a forest: the oldest are dropped and as many are grown on the updated rows
+REFRESHED_ESTIMATORS = 10
+
+# Stages a gradient boosting model may grow to through updates before it is refitted from scratch
+MAX_BOOSTING_STAGES = 300
+
+# Seconds between checks of the followed files for new rows
+POLL_SECONDS = 5
+
+# Updated pipelines are only approximately what fitting on their rows would give, so they are kept apart from
+# the fitted ones SVM loads from MODEL_CACHE_FOLDER
+ONLINE_MODEL_CACHE_FOLDER = os.path.join(MODEL_CACHE_FOLDER, 'online')
+
+# The source of the features (and label) computed from each table that can be appended to
+TABLE_SOURCES = {'taxipickup': 'pickups', 'taxidropoff': 'dropoffs'}
+
+
+# Updates a fitted pipeline with changed rows instead of refitting it. The steps before the estimator (scalers,
+# selectors) are kept as fitted. Estimators with partial_fit learn from the updated rows, forests replace their
+# REFRESHED_ESTIMATORS oldest trees with trees grown on all the rows, and other warm-startable ensembles
+# (gradient boosting) grow REFRESHED_ESTIMATORS more stages on them, up to MAX_BOOSTING_STAGES. Returns False
+# when the pipeline has to be refitted from scratch instead.
+def updatePipeline(pipeline, x, y, isUpdated):
+	estimator = pipeline.steps[-1][1]
+	transform = lambda x: reduce(lambda x, step: step[1].transform(x), pipeline.steps[:-1], x)
+	if hasattr(estimator, 'partial_fit'):
+		if isUpdated.any():
+			estimator.partial_fit(transform(x[isUpdated]), y[isUpdated])
+		return True
+	if hasattr(estimator, 'warm_start') and hasattr(estimator, 'n_estimators'):
+		if isinstance(getattr(estimator, 'estimators_', None), list):
+			estimator.estimators_ = estimator.estimators_[REFRESHED_ESTIMATORS:]
+		elif estimator.n_estimators + REFRESHED_ESTIMATORS > MAX_BOOSTING_STAGES:
+			return False
+		else:
+			estimator.set_params(n_estimators=estimator.n_estimators + REFRESHED_ESTIMATORS)
+		estimator.set_params(warm_start=True)
+		estimator.fit(transform(x), y)
+		return True
+	return False
+
+
+# Keeps a fitted pipeline per POI up to date as pickups and dropoffs arrive. The training rows of every POI are
+# kept in memory. New rows are appended to the DB and the feature store rows that read them are dropped. Only
+# the hours whose features or label read a new row, and the hours the training range grew by, are computed
+# again and merged into the rows in memory, and the pipelines are updated with updatePipeline. An hour becomes
+# a training row once every window of its features and label has been observed in both tables.
+class OnlineUpdater:
+	def __init__(self, db, POIs, generatePipeline=SVM.GENERATE_PIPELINE, startTime=START_TIME, endTime=END_TIME):
+		self.db = db
+		self.locations = [(POI['LAT'], POI['LONG']) for POI in POIs]
+		self.generatePipeline = generatePipeline
+		self.startTime = startTime
+		self.endTime = endTime
+		self.modelCache = ModelCache(ONLINE_MODEL_CACHE_FOLDER) if SVM.USE_MODEL_CACHE else None
+		self.observedSeconds = dict((tableName, db.getLatestTaxiSeconds(tableName) or 0) for tableName in TABLE_SOURCES)
+
+		# (x, y, seconds) of each POI, seconds being the start time of each row's hour
+		self.data = dict(zip(self.locations, loadAllDataBatched(db, self.locations, startTime, endTime, withSeconds=True)))
+		self.pipelines = {}
+		for location in self.locations:
+			x, y, rowSeconds = self.data[location]
+			pipeline = None
+			if self.modelCache != None:
+				pipeline = self.modelCache.load(location[0], location[1], getFingerprint(x, y, generatePipeline, generatePipeline(x)))
+			self.pipelines[location] = pipeline if pipeline != None else SVM.fitPipelineOnData(location[0], location[1], generatePipeline, x, y)
+
+	def addPickups(self, pickupDicts):
+		return self.addTaxiDicts(pickupDicts, 'taxipickup')
+
+	def addDropoffs(self, dropoffDicts):
+		return self.addTaxiDicts(dropoffDicts, 'taxidropoff')
+
+	# Appends the rows and updates what depends on them. Returns the POIs whose pipelines were updated.
+	def addTaxiDicts(self, taxiDicts, tableName):
+		times, latitudes, longitudes = self.db.appendTaxiDicts(taxiDicts, tableName)
+		if len(times) == 0:
+			return []
+		source = TABLE_SOURCES[tableName]
+		removeStaleFeatures(self.db, source, times, latitudes, longitudes)
+		features = [feature for feature in ALL_FEATURES + [LABEL] if feature.source == source]
+
+		# The range only grows up to what both tables have been observed until, so no row is computed from a
+		# table that is behind
+		previousEndTime = self.endTime
+		self.observedSeconds[tableName] = max(self.observedSeconds[tableName], int(times.max()))
+		lastHour = (min(self.observedSeconds.values()) - 3600 * LOOK_AHEAD_HOURS) // 3600 * 3600
+		self.endTime = max(self.endTime, fromEpochSeconds(lastHour + 3600))
+		numNewHours = int((toEpochSeconds(self.endTime) - toEpochSeconds(previousEndTime)) // 3600)
+
+		updated = []
+		for location in self.locations:
+			latitude, longitude = location
+			x, y, rowSeconds = self.data[location]
+			isStale = getStaleMask(self.db, features, latitude, longitude, rowSeconds, times, latitudes, longitudes)
+			newSeconds = toEpochSeconds(previousEndTime) + 3600 * np.arange(numNewHours, dtype=np.int64)
+			newSeconds = newSeconds[~getRemovedTimesOnce().getMask(latitude, longitude, previousEndTime, numNewHours)]
+			if not isStale.any() and len(newSeconds) == 0:
+				continue
+
+			# Compute the stale and new rows only, then replace the stale ones and append the new ones
+			changedSeconds = np.concatenate((rowSeconds[isStale], newSeconds))
+			changedX, changedY = loadFeatures(self.db, latitude, longitude, generateAllFeatures, [fromEpochSeconds(seconds) for seconds in changedSeconds])
+			changedY = changedY.astype(np.int64)
+			x, y = x.copy(), y.copy()
+			x[isStale], y[isStale] = changedX[:isStale.sum()], changedY[:isStale.sum()]
+			if len(newSeconds) > 0:
+				x = np.concatenate((x, changedX[isStale.sum():])) if len(x) > 0 else changedX[isStale.sum():]
+				y = np.concatenate((y, changedY[isStale.sum():]))
+				rowSeconds = np.concatenate((rowSeconds, newSeconds))
+			self.data[location] = (x, y, rowSeconds)
+
+			self.updatePOI(location, x, y, np.concatenate((isStale, np.ones(len(newSeconds), dtype=bool))))
+			updated.append(location)
+		return updated
+
+	# Updates a POI's pipeline, refitting it if it cannot be updated, and saves it to the online model cache
+	# under the fingerprint of the updated rows so a later run starts from it
+	def updatePOI(self, location, x, y, isUpdated):
+		pipeline = self.pipelines[location]
+		start = time.time()
+		if not updatePipeline(pipeline, x, y, isUpdated):
+			pipeline = self.generatePipeline(x)
+			pipeline.fit(x, y)
+			self.pipelines[location] = pipeline
+		print 'Updated POI %s with %i changed rows in %.3f seconds' % (location, np.count_nonzero(isUpdated), time.time() - start)
+		if self.modelCache != None:
+			self.modelCache.save(location[0], location[1], getFingerprint(x, y, self.generatePipeline, self.generatePipeline(x)), pipeline)
+
+
+# Reads the rows appended to a CSV file since the last call. Lines are only read once complete. Without
+# fieldnames the first line is the header.
+class CSVFollower:
+	def __init__(self, filename, fieldnames=None):
+		self.filename = filename
+		self.fieldnames = fieldnames
+		self.offset = 0
+
+	def readNew(self):
+		if not os.path.exists(self.filename):
+			return []
+		with open(self.filename) as f:
+			f.seek(self.offset)
+			data = f.read()
+		lines = data.split('\n')[:-1]
+		self.offset += sum(len(line) + 1 for line in lines)
+		if self.fieldnames == None and len(lines) > 0:
+			self.fieldnames = next(csv.reader(lines[:1]))
+			lines = lines[1:]
+		return list(csv.DictReader(lines, fieldnames=self.fieldnames))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Keep the per-POI pipelines updated from pickup and dropoff files as rows are appended to them')
+	parser.add_argument('--pickups', help='Pickups CSV to follow, without a header like pickups_train.csv')
+	parser.add_argument('--dropoffs', help='Dropoffs CSV to follow, with a header like dropoffs.csv')
+	args = parser.parse_args()
+
+	followers = []
+	if args.pickups != None:
+		followers.append((CSVFollower(args.pickups, ['ID', 'DROPOFF_TIME', 'DROPOFF_ADDRESS', 'DROPOFF_LONG', 'DROPOFF_LAT']), 'taxipickup'))
+	if args.dropoffs != None:
+		followers.append((CSVFollower(args.dropoffs), 'taxidropoff'))
+
+	with DB() as db:
+		updater = OnlineUpdater(db, getPointsOfInterest())
+		# Only rows appended from now on are new
+		for follower, tableName in followers:
+			follower.readNew()
+		while True:
+			for follower, tableName in followers:
+				taxiDicts = follower.readNew()
+				if len(taxiDicts) > 0:
+					start = time.time()
+					updated = updater.addTaxiDicts(taxiDicts, tableName)
+					print 'Added %i rows to %s and updated %i POIs in %.3f seconds' % (len(taxiDicts), tableName, len(updated), time.time() - start)
+			time.sleep(POLL_SECONDS)
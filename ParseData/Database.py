@@ -1,21 +1,202 @@
+import os
+import json
+import math
+import hashlib
 import datetime
 import time
-import cPickle as pickle
+import itertools
+import functools
+from timeit import default_timer
 from HTMLParser import HTMLParser
 
-from peewee import MySQLDatabase, Model, fn
+import numpy as np
+
+from peewee import MySQLDatabase, SqliteDatabase, Proxy, Model, SQL, fn
 from peewee import CharField, DateTimeField, DateField, IntegerField, BooleanField, TextField, DecimalField, BigIntegerField
 
-database = MySQLDatabase('big_data', host='localhost', port=3306, user='root', passwd='')
+from Index import PointIndex, EventIndex, WeatherTimeline, fillWeatherDefaults, toEpochSeconds, binHourly
+from QueryCache import QueryCache, QUERY_CACHE_FILENAME
+from Instrumentation import Instrumentation, INSTRUMENT
+from Snapshot import Snapshot, SnapshotWriter, META_FILENAME
+from TRideCube import TRideCube, TRIDE_CUBE_FILENAME
+from Config import DATA_FOLDER
+
+# Bound to the backend's database when a DB is entered, see DIALECTS
+database = Proxy()
+
+# 'mysql' for the shared server, 'sqlite' for an embedded file that needs no server or network round trips
+DATABASE_BACKEND = 'mysql'
+SQLITE_FILENAME = os.path.join(DATA_FOLDER, 'big_data.db')
 
 WEATHER_FIELD_LIST = ['heatindexm', 'windchillm', 'wdird', 'windchilli', 'hail', 'heatindexi', 'wgusti', 'thunder', 'pressurei', 'snow', 'pressurem', 'fog', 'vism', 'wgustm', 'tornado', 'hum', 'tempi', 'tempm', 'dewptm', 'rain', 'dewpti', 'precipm', 'wspdi', 'wspdm', 'visi']
 
-PICKUPS_CACHE_FILENAME = 'query_cache.p'
+# Build the in-memory pickup/dropoff indexes when entering the DB by default
+USE_TAXI_INDEX = False
+
+# Answer event queries from an in-memory index, loaded on first use. The event table is small.
+USE_EVENT_INDEX = True
+
+# Answer weather queries from the whole weather table loaded into memory on first use
+USE_WEATHER_TIMELINE = True
+
+# 0.00224946357 = 250 meters
+TAXI_DIST = 0.00224946357
+
+TAXI_FIELDS = ['trip_id', 'time', 'address', 'longitude', 'latitude']
 
 # Database must use utf8mb4 for smileys and other such nonesense
 # ALTER DATABASE hn CHARACTER SET = utf8mb4 COLLATE = utf8mb4_unicode_ci;
 
 
+# Source files are identified in the ingestion ledger by their size and the SHA-1 of their first bytes
+INGESTION_CHECKSUM_BYTES = 1 << 24
+
+# Records inserted per transaction when ingesting a file, progress is recorded after each
+RECORDS_PER_CHECKPOINT = 100000
+
+# Tables given a POINT column with a SPATIAL INDEX by DB.addSpatialColumns, so radius queries only visit the
+# rows in the bounding box of the circle. Points are (longitude, latitude), rows without coordinates (tweets
+# that are not geotagged) get (0, 0) since indexed columns cannot be null.
+SPATIAL_TABLES = ['taxipickup', 'taxidropoff', 'event', 'tweet', 'stop']
+SPATIAL_COLUMN = 'location'
+POINT_SQL = 'COALESCE(POINT(longitude, latitude), POINT(0, 0))'
+
+# Added to the half-width of the bounding boxes so rounding never excludes a row the exact check would keep
+BOX_PADDING = 1e-6
+
+# SQLite has no POW, which getDist needs. Nulls (tweets without coordinates) give null like in MySQL.
+def sqlitePow(base, exponent):
+	if base == None or exponent == None:
+		return None
+	return math.pow(base, exponent)
+
+class SQLiteDatabase(SqliteDatabase):
+	def _add_conn_hooks(self, conn):
+		SqliteDatabase._add_conn_hooks(self, conn)
+		conn.create_function('pow', 2, sqlitePow)
+
+# The SQL that differs between backends. Everything else goes through peewee, which handles both. Each dialect
+# defines createDatabase(filename), getDatabaseName(filename) identifying the database it connects to,
+# timeDiff(a, b), secondsSince(column) and integerDivide(a, b), and those
+# whose addSpatialColumn returns True also define withinBox(lat, lon, dist) and withinJoinBoxSQL(table,
+# locations).
+class Dialect:
+	placeholder = '%s'
+
+	# Most parameters allowed in one query, or None for no limit
+	maxParameters = None
+
+	def __init__(self):
+		# The SPATIAL_TABLES that have their spatial column, found on connecting
+		self.spatialTables = set()
+
+	def onConnect(self, database):
+		pass
+
+	def insertSQL(self, table, fields, numRows):
+		row = '(%s)' % ','.join([self.placeholder] * len(fields))
+		return 'INSERT INTO %s (%s) VALUES %s' % (table, ','.join(fields), ','.join([row] * numRows))
+
+	# Adds the spatial column and index to table, returning whether the backend supports them
+	def addSpatialColumn(self, database, table):
+		return False
+
+	# Number of rows of numFields parameters that fit in one query next to numOtherParameters, or None if any
+	# number does
+	def getRowsPerQuery(self, numFields, numOtherParameters=0):
+		return None if self.maxParameters == None else max((self.maxParameters - numOtherParameters) // numFields, 1)
+
+class MySQLDialect(Dialect):
+	def createDatabase(self, filename):
+		return MySQLDatabase('big_data', host='localhost', port=3306, user='root', passwd='')
+
+	def getDatabaseName(self, filename):
+		return 'mysql://localhost:3306/big_data'
+
+	# The type of the spatial columns, found on connecting
+	spatialColumnType = 'POINT NOT NULL'
+
+	def onConnect(self, database):
+		database.execute_sql('SET NAMES utf8mb4;')  # Necessary for some emojis
+		cursor = database.execute_sql('SELECT TABLE_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = %s', (SPATIAL_COLUMN,))
+		self.spatialTables = set(table for (table,) in cursor.fetchall() if table in SPATIAL_TABLES)
+
+		# MySQL 8 ignores the spatial index of a column that is not restricted to one SRID. The points are built
+		# without one, so they are in SRID 0. MySQL 5.7 and MariaDB have no SRID attribute.
+		version = database.execute_sql('SELECT VERSION()').fetchone()[0]
+		if 'MariaDB' not in version and int(version.split('.')[0]) >= 8:
+			self.spatialColumnType = 'POINT NOT NULL SRID 0'
+			cursor = database.execute_sql('SELECT TABLE_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = %s AND SRS_ID IS NULL', (SPATIAL_COLUMN,))
+			for (table,) in cursor.fetchall():
+				if table in self.spatialTables:
+					print 'Restricting the spatial column of %s to SRID 0' % table
+					database.execute_sql('ALTER TABLE %s MODIFY %s %s' % (table, SPATIAL_COLUMN, self.spatialColumnType))
+
+	# Spatial indexes on InnoDB tables need MySQL 5.7
+	def addSpatialColumn(self, database, table):
+		print 'Adding spatial index to %s' % table
+		database.execute_sql('ALTER TABLE %s ADD COLUMN %s POINT NULL' % (table, SPATIAL_COLUMN))
+		database.execute_sql('UPDATE %s SET %s = %s' % (table, SPATIAL_COLUMN, POINT_SQL))
+		database.execute_sql('ALTER TABLE %s MODIFY %s %s, ADD SPATIAL INDEX (%s)' % (table, SPATIAL_COLUMN, self.spatialColumnType, SPATIAL_COLUMN))
+		return True
+
+	# A peewee condition restricting the rows of a spatial table to the box within dist of (lat, lon)
+	def withinBox(self, lat, lon, dist):
+		dist += BOX_PADDING
+		box = 'POLYGON((%r %r, %r %r, %r %r, %r %r, %r %r))' % (lon - dist, lat - dist, lon + dist, lat - dist, lon + dist, lat + dist, lon - dist, lat + dist, lon - dist, lat - dist)
+		return SQL('MBRContains(ST_GeomFromText(%%s), %s)' % SPATIAL_COLUMN, box)
+
+	# SQL restricting the rows of the spatial table aliased table to the box around each row of the table
+	# aliased locations, with 4 placeholders for the half-width of the box
+	def withinJoinBoxSQL(self, table, locations):
+		return ('MBRContains(ST_MakeEnvelope(POINT(%(l)s.longitude - %%s, %(l)s.latitude - %%s), POINT(%(l)s.longitude + %%s, %(l)s.latitude + %%s)), %(t)s.%(column)s)' %
+			{'l': locations, 't': table, 'column': SPATIAL_COLUMN})
+
+	# Tables with a spatial column get it from the row's own coordinates, which MySQL allows VALUES to refer to
+	def insertSQL(self, table, fields, numRows):
+		if table not in self.spatialTables:
+			return Dialect.insertSQL(self, table, fields, numRows)
+		row = '(%s,%s)' % (','.join([self.placeholder] * len(fields)), POINT_SQL)
+		return 'INSERT INTO %s (%s,%s) VALUES %s' % (table, ','.join(fields), SPATIAL_COLUMN, ','.join([row] * numRows))
+
+	# An expression ordering like the difference a - b between two datetimes. The unit is backend-specific.
+	def timeDiff(self, a, b):
+		return fn.TIMEDIFF(a, b)
+
+	# SQL for the whole seconds from a datetime parameter to column
+	def secondsSince(self, column):
+		return 'TIMESTAMPDIFF(SECOND, %%s, %s)' % column
+
+	# SQL for the integer quotient of two non-negative integer expressions
+	def integerDivide(self, a, b):
+		return '(%s DIV %s)' % (a, b)
+
+# Uses write-ahead logging so readers (e.g. parallel training processes) do not block on a writer
+class SQLiteDialect(Dialect):
+	placeholder = '?'
+	maxParameters = 999
+
+	def createDatabase(self, filename):
+		return SQLiteDatabase(filename, pragmas=[('journal_mode', 'wal'), ('synchronous', 'normal')])
+
+	def getDatabaseName(self, filename):
+		return 'sqlite://%s' % os.path.abspath(filename)
+
+	def timeDiff(self, a, b):
+		return fn.julianday(a) - fn.julianday(b)
+
+	def secondsSince(self, column):
+		return "(CAST(strftime('%%s', %s) AS INTEGER) - CAST(strftime('%%s', ?) AS INTEGER))" % column
+
+	def integerDivide(self, a, b):
+		return '(%s / %s)' % (a, b)
+
+DIALECTS = {
+	'mysql': MySQLDialect(),
+	'sqlite': SQLiteDialect(),
+}
+
+
 # Model definitions
 class BaseModel(Model):
 	class Meta:
@@ -89,7 +270,7 @@ class Tweet(BaseModel):
 	text = CharField(max_length=255, null=True)
 	longitude = DecimalField(max_digits=9, decimal_places=6, null=True)  # Range: (-180, 180)
 	latitude = DecimalField(max_digits=9, decimal_places=6, null=True)   # Range: (-90, 90)
-	created_at = DateTimeField(formats='%Y-%m-%d %H:%M:%S', null=True, index=True)
+	created_at = DateTimeField(formats=['%Y-%m-%d %H:%M:%S'], null=True, index=True)
 	#TODO: entities
 	favorited = BooleanField(null=True)
 	tweet_id = BigIntegerField(null=True)
@@ -105,16 +286,16 @@ class TRide(BaseModel):
 	origin = CharField(max_length=50, index=True)
 	destination = CharField(max_length=50, index=True)
 	trips = IntegerField()
-	date = DateField(formats='%Y-%m-%d', index=True)
-	datetime = DateTimeField(formats='%Y-%m-%d %H:%M:%S.000', index=True)
-	next_trip_date = DateTimeField(formats='%Y-%m-%d %H:%M:%S.000', index=True)
+	date = DateField(formats=['%Y-%m-%d'], index=True)
+	datetime = DateTimeField(formats=['%Y-%m-%d %H:%M:%S.000'], index=True)
+	next_trip_date = DateTimeField(formats=['%Y-%m-%d %H:%M:%S.000'], index=True)
 
 class BusRide(BaseModel):
 	device_id = IntegerField()
 	ticket_type = CharField(max_length=255)
 	device_class_id = IntegerField()
-	date = DateField(formats='%Y-%m-%d', index=True)
-	datetime = DateTimeField(formats='%Y-%m-%d %H:%M:%S.000', index=True)
+	date = DateField(formats=['%Y-%m-%d'], index=True)
+	datetime = DateTimeField(formats=['%Y-%m-%d %H:%M:%S.000'], index=True)
 	route_station = CharField(max_length=50, index=True)
 
 class Stop(BaseModel):
@@ -134,49 +315,305 @@ class Stop(BaseModel):
 	heading = IntegerField()
 	loc_type = CharField(max_length=30)
 
+# The ingestion ledger: how many records of each source file have been inserted. See DB.startIngestion.
+class IngestedFile(BaseModel):
+	filename = CharField(max_length=255, unique=True)   # Base name, the source files' names are unique
+	size = BigIntegerField()                            # Bytes when last seen
+	checksum = CharField(max_length=40)                 # SHA-1 of the first INGESTION_CHECKSUM_BYTES bytes
+	num_records = BigIntegerField()
+	is_complete = BooleanField()
+	updated_at = DateTimeField()
+
+
+# SHA-1 hex digest of the first numBytes bytes of filename
+def getFileChecksum(filename, numBytes):
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		while numBytes > 0:
+			data = f.read(min(numBytes, 1 << 20))
+			if data == '':
+				break
+			sha1.update(data)
+			numBytes -= len(data)
+	return sha1.hexdigest()
+
+# Yields successive lists of up to size items from iterable without materializing it
+def chunked(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if len(chunk) == 0:
+			return
+		yield chunk
+
+
+# Tables and columns exported to columnar snapshots, see Snapshot.py
+SNAPSHOT_TABLES = {
+	'taxipickup': (TaxiPickup, [('trip_id', 'int'), ('time', 'time'), ('address', 'string'), ('latitude', 'coord'), ('longitude', 'coord')]),
+	'taxidropoff': (TaxiDropoff, [('trip_id', 'int'), ('time', 'time'), ('address', 'string'), ('latitude', 'coord'), ('longitude', 'coord')]),
+	'weather': (Weather, [('time', 'time')] + [(field, 'float') for field in WEATHER_FIELD_LIST if field not in ('fog', 'rain', 'snow', 'hail', 'thunder', 'tornado')] +
+		[(field, 'bool') for field in ('fog', 'rain', 'snow', 'hail', 'thunder', 'tornado')] + [(field, 'string') for field in ('conds', 'icon', 'metar', 'wdire')]),
+	'event': (Event, [('event_id', 'int'), ('name', 'string'), ('start_time', 'time'), ('end_time', 'time'), ('address', 'string'), ('latitude', 'coord'), ('longitude', 'coord'),
+		('type', 'string'), ('is_time_accurate', 'bool'), ('is_time_inferred', 'bool')]),
+	'tweet': (Tweet, [('created_at', 'time'), ('latitude', 'coord'), ('longitude', 'coord'), ('mentions_taxi', 'bool'), ('tweet_id', 'int'), ('user_id', 'int'),
+		('place_id', 'string'), ('source', 'string')]),
+	'stop': (Stop, [('loc_id', 'int'), ('station', 'string'), ('is_station', 'bool'), ('latitude', 'coord'), ('longitude', 'coord'), ('line', 'string')]),
+}
+
+# Hourly T ride counts per station (the TRideCube cells)
+TRIDE_HOURLY_COLUMNS = [('station', 'string'), ('time', 'time'), ('origin', 'int'), ('destination', 'int')]
+
+
+# Tweets are converted outside the DB class so worker processes can do it without a connection. The HTML
+# parser and month table are built once per process rather than once per tweet.
+HTML_PARSER = HTMLParser()
+MONTHS = dict((month, i + 1) for i, month in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+TWEET_FIELDS = ['text', 'mentions_taxi', 'longitude', 'latitude', 'created_at', 'favorited', 'tweet_id', 'place_id', 'retweet_count', 'source', 'user_id']
+
+# Converts Twitter's created_at ("Mon May 14 23:59:59 +0000 2012") to MySQL's format without strptime
+def parseTweetTime(created_at):
+	try:
+		weekday, month, day, clock, offset, year = created_at.split(' ')
+		return '%s-%02i-%02i %s' % (year, MONTHS[month], int(day), clock)
+	except (ValueError, KeyError):
+		t = time.strptime(created_at.replace('+0000', ''), '%a %b %d %H:%M:%S %Y')
+		return time.strftime('%Y-%m-%d %H:%M:%S', t)
+
+def tweetDictToSQLStrings(tweetDict):
+	SQLDict = {}
+
+	# Populate the tweetDict. Use the get method to ensure no KeyErrors are raised
+	text = tweetDict.get('text')
+	if text == None:
+		SQLDict['text'] = None
+		SQLDict['mentions_taxi'] = False
+	else:
+		SQLDict['text'] = HTML_PARSER.unescape(text)
+		text = SQLDict['text'].lower()
+		SQLDict['mentions_taxi'] = 'taxi' in text or 'cab' in text
+
+	coords = tweetDict.get('coordinates')
+	if coords == None or coords == 'None':
+		SQLDict['longitude'] = None
+		SQLDict['latitude'] = None
+	else:
+		SQLDict['longitude'] = coords.get('coordinates')[0]
+		SQLDict['latitude'] = coords.get('coordinates')[1]
+
+	created_at = tweetDict.get('created_at')
+	if created_at == None:
+		SQLDict['created_at'] = None
+	else:
+		SQLDict['created_at'] = parseTweetTime(created_at)
+
+	SQLDict['favorited'] = tweetDict.get('favorited')
+
+	SQLDict['tweet_id'] = tweetDict.get('id')
+
+	place = tweetDict.get('place')
+	if place == None or place == 'None':
+		SQLDict['place_id'] = None
+	else:
+		SQLDict['place_id'] = place.get('id')
+
+	SQLDict['retweet_count'] = tweetDict.get('retweet_count')
+
+	SQLDict['source'] = tweetDict.get('source')
+
+	user = tweetDict.get('user')
+	if user == None:
+		SQLDict['user_id'] = None
+	else:
+		SQLDict['user_id'] = user.get('id')
+
+	return SQLDict
+
+# The values of tweetDictToSQLStrings as a tuple in the order of TWEET_FIELDS
+def tweetDictToSQLRow(tweetDict):
+	SQLDict = tweetDictToSQLStrings(tweetDict)
+	return tuple(SQLDict[field] for field in TWEET_FIELDS)
+
+
+# Parses the time of a row converted by DB.pickupDictToSQLRow or DB.dropoffDictToSQLRow
+def parseTaxiTime(timeStr):
+	for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+		try:
+			return datetime.datetime.strptime(timeStr, format)
+		except ValueError:
+			pass
+	raise ValueError('Unknown taxi time format: %s' % timeStr)
+
+
+# Decorator recording the latency of a DB method when instrumentation is on. Put it above @cached so the
+# time includes cache lookups.
+def timed(func):
+	@functools.wraps(func)
+	def _timed(self, *args, **kwargs):
+		if self.instrumentation == None:
+			return func(self, *args, **kwargs)
+		start = default_timer()
+		try:
+			return func(self, *args, **kwargs)
+		finally:
+			self.instrumentation.record(func.__name__, default_timer() - start)
+
+	return _timed
 
 # Decorator to cache database queries
 def cached(func):
+	@functools.wraps(func)
 	def _cached(self, *args, **kwargs):
 		if self.queryCache == None:
 			self.loadQueryCache()
 
 		key = (func.__name__, args, tuple(sorted(kwargs.items())))
-		if key not in self.queryCache:
+		if self.instrumentation == None:
+			found, result = self.queryCache.get(key)
+		else:
+			start = default_timer()
+			found, result = self.queryCache.get(key)
+			self.instrumentation.record('QueryCache.get', default_timer() - start)
+			self.instrumentation.recordCacheLookup(func.__name__, found)
+		if not found:
 			result = func(self, *args, **kwargs)
-			self.queryCache[key] = result
-		return self.queryCache[key]
+			self.queryCache.put(key, result)
+		return result
 
 	return _cached
 
 # Handles all database operations
 class DB:
+	# backend is a key of DIALECTS, databaseFilename is only used by SQLite. If snapshotFolder is given, the DB
+	# is read-only and answers queries from the columnar snapshot in that folder instead of the database. With
+	# instrument, the @timed methods and cache lookups are recorded and summarized on exit.
+	def __init__(self, useTaxiIndex=USE_TAXI_INDEX, useEventIndex=USE_EVENT_INDEX, useWeatherTimeline=USE_WEATHER_TIMELINE, queryCacheFilename=QUERY_CACHE_FILENAME, snapshotFolder=None,
+			backend=DATABASE_BACKEND, databaseFilename=SQLITE_FILENAME, instrument=INSTRUMENT):
+		self.instrumentation = Instrumentation() if instrument else None
+		self.dialect = DIALECTS[backend]
+		self.databaseFilename = databaseFilename
+		self.useTaxiIndex = useTaxiIndex
+		self.useEventIndex = useEventIndex
+		self.useWeatherTimeline = useWeatherTimeline
+		self.eventIndex = None
+		self.weatherTimeline = None
+		self.snapshotFolder = snapshotFolder
+		self.snapshot = None
+		self.tweetIndex = None
+		self.taxiTweetIndex = None
+		self.taxiTweetTimes = None
+		self.TRideCube = None
+		self.queryCacheFilename = queryCacheFilename
+		self.queryCache = None
+		self.dataIdentity = None
+		self.pickupIndex = None
+		self.dropoffIndex = None
+
 	def __enter__(self):
+		if self.snapshotFolder != None:
+			self.openSnapshot()
+			return self
+
+		database.initialize(self.dialect.createDatabase(self.databaseFilename))
 		database.connect()
-		database.execute_sql('SET NAMES utf8mb4;')  # Necessary for some emojis
-		self.queryCache = None
-		with open('places.p', 'rb') as f:
-			self.TRideCache = pickle.load(f)
+		self.dialect.onConnect(database)
+		if self.useTaxiIndex:
+			self.buildTaxiIndex()
 		return self
 
 	def __exit__(self, excType, excValue, excTraceback):
+		if self.instrumentation != None:
+			self.instrumentation.dump(self.queryCache.getStats() if self.queryCache != None else None)
 		self.saveQueryCache()
 		print 'DB.__exit__', excType, excValue, excTraceback
-		database.close()
+		if self.snapshot == None:
+			database.close()
 
 	def saveQueryCache(self):
-		pass
-		# if self.queryCache != None:
-		# 	with open(PICKUPS_CACHE_FILENAME, 'wb') as f:
-		# 		pickle.dump(self.queryCache, f)
+		if self.queryCache != None:
+			print 'Query cache:', self.queryCache.getStats()
+			self.queryCache.close()
+			self.queryCache = None
 
+	# Opens the on-disk cache lazily. Entries are read incrementally as they are looked up.
+	# Results are kept apart per database, so databases and snapshots can share a cache file
 	def loadQueryCache(self):
-		try:
-			with open(PICKUPS_CACHE_FILENAME, 'rb') as f:
-				self.queryCache = pickle.load(f)
-		except IOError:
-			self.queryCache = {}
-		
+		self.queryCache = QueryCache(self.queryCacheFilename, database=self.getDatabaseName())
+
+	# Names the database or snapshot the DB answers from
+	def getDatabaseName(self):
+		if self.snapshotFolder != None:
+			return 'snapshot://%s' % os.path.abspath(self.snapshotFolder)
+		return self.dialect.getDatabaseName(self.databaseFilename)
+
+	# Drops every cached query result. Must be called after ingesting new data.
+	def invalidateQueryCache(self):
+		if self.queryCache == None:
+			self.loadQueryCache()
+		self.queryCache.invalidate()
+		self.dataIdentity = None
+
+	# A number bumped by invalidateQueryCache whenever the data changes, for keying anything derived from it
+	def getDataGeneration(self):
+		if self.queryCache == None:
+			self.loadQueryCache()
+		return self.queryCache.generation
+
+	# A short hash identifying the data the DB answers from, for keying anything derived from it on disk. For a
+	# database it covers which database it is, the ingestion ledger and the data generation, and for a snapshot
+	# its folder and the size and modification time of its files. Rows appended by appendTaxiDicts keep it.
+	def getDataIdentity(self):
+		if self.dataIdentity == None:
+			identity = hashlib.sha1()
+			if self.snapshot != None:
+				identity.update('%s\n' % self.getDatabaseName())
+				for folder, folderNames, filenames in sorted(os.walk(self.snapshotFolder)):
+					for filename in sorted(filenames):
+						stat = os.stat(os.path.join(folder, filename))
+						identity.update('%s %i %r\n' % (os.path.relpath(os.path.join(folder, filename), self.snapshotFolder), stat.st_size, stat.st_mtime))
+			else:
+				identity.update('%s %i\n' % (self.getDatabaseName(), self.getDataGeneration()))
+				for row in IngestedFile.select(IngestedFile.filename, IngestedFile.size, IngestedFile.checksum, IngestedFile.num_records, IngestedFile.is_complete).order_by(IngestedFile.filename).tuples():
+					identity.update('%r\n' % (row,))
+			self.dataIdentity = identity.hexdigest()[:16]
+		return self.dataIdentity
+
+	# Writes every table read by the query methods, plus the T ride aggregates, to a columnar snapshot
+	def exportSnapshot(self, folder):
+		writer = SnapshotWriter(folder)
+		for table, (model, columns) in sorted(SNAPSHOT_TABLES.iteritems()):
+			query = model.select(*[getattr(model, name) for name, kind in columns]).order_by(model.id)
+			writer.writeTable(table, columns, query.tuples().iterator(), query.count())
+
+		TRideRows = [(station, datetime.datetime.utcfromtimestamp(hour), origin, destination) for station, hour, origin, destination in self.getTRideCube().iterCounts()]
+		writer.writeTable('tride_hourly', TRIDE_HOURLY_COLUMNS, TRideRows, len(TRideRows))
+		writer.close()
+
+	# Opens a snapshot written by exportSnapshot and loads the in-memory indexes from it
+	def openSnapshot(self):
+		self.snapshot = Snapshot(self.snapshotFolder)
+
+		for table, indexName in (('taxipickup', 'pickupIndex'), ('taxidropoff', 'dropoffIndex')):
+			print 'Building %s index' % table
+			setattr(self, indexName, PointIndex(self.snapshot.getColumn(table, 'time'), self.snapshot.getCoordinates(table, 'latitude'), self.snapshot.getCoordinates(table, 'longitude')))
+
+		stations = self.snapshot.getVocabulary('tride_hourly', 'station')
+		columns = [self.snapshot.getColumn('tride_hourly', column) for column in ('time', 'origin', 'destination')]
+		self.TRideCube = TRideCube.fromCounts([stations[code] for code in self.snapshot.getColumn('tride_hourly', 'station')], *columns)
+
+	# Loads the geotagged tweets from the snapshot into memory. Only used in snapshot mode.
+	def getTweetIndexes(self):
+		if self.tweetIndex == None:
+			times = self.snapshot.getColumn('tweet', 'created_at')
+			latitudes = self.snapshot.getCoordinates('tweet', 'latitude')
+			longitudes = self.snapshot.getCoordinates('tweet', 'longitude')
+			mentionsTaxi = self.snapshot.getColumn('tweet', 'mentions_taxi') == 1
+			hasLocation = ~np.isnan(latitudes) & ~np.isnan(longitudes)
+			self.tweetIndex = PointIndex(times[hasLocation], latitudes[hasLocation], longitudes[hasLocation])
+			self.taxiTweetIndex = PointIndex(times[hasLocation & mentionsTaxi], latitudes[hasLocation & mentionsTaxi], longitudes[hasLocation & mentionsTaxi])
+			self.taxiTweetTimes = np.sort(times[mentionsTaxi])
+		return self.tweetIndex, self.taxiTweetIndex, self.taxiTweetTimes
+
 	# Simple utility function to create tables if they do not exist
 	def createTables(self):
 		TaxiPickup.create_table(fail_silently=True)
@@ -187,32 +624,182 @@ class DB:
 		TRide.create_table(fail_silently=True)
 		BusRide.create_table(fail_silently=True)
 		Stop.create_table(fail_silently=True)
+		IngestedFile.create_table(fail_silently=True)
+		self.addSpatialColumns()
+
+	# Returns the number of records of filename already ingested, or None if all of them are. A file that grew
+	# since it was completed (e.g. a month of tweets still being collected) resumes where it left off. A file
+	# that shrank or whose first bytes changed raises ValueError, since its rows can't be told apart from the
+	# others.
+	def startIngestion(self, filename):
+		name = os.path.basename(filename)
+		size = os.path.getsize(filename)
+		entry = IngestedFile.select().where(IngestedFile.filename == name).first()
+		if entry == None:
+			IngestedFile.create(filename=name, size=size, checksum=getFileChecksum(filename, INGESTION_CHECKSUM_BYTES), num_records=0, is_complete=False, updated_at=datetime.datetime.now())
+			return 0
+
+		if size < entry.size or getFileChecksum(filename, min(entry.size, INGESTION_CHECKSUM_BYTES)) != entry.checksum:
+			raise ValueError('%s changed since it was ingested, delete its rows and its ingestedfile entry to ingest it again' % filename)
+		if entry.is_complete and size == entry.size:
+			return None
+
+		entry.size = size
+		entry.checksum = getFileChecksum(filename, INGESTION_CHECKSUM_BYTES)
+		entry.is_complete = False
+		entry.updated_at = datetime.datetime.now()
+		entry.save()
+		return entry.num_records
+
+	# Adds records of filename with addRecords and records that the first numRecords records of the file are
+	# ingested, in one transaction so a crash never leaves the two out of step
+	def ingestBatch(self, filename, records, addRecords, numRecords):
+		with database.atomic():
+			addRecords(records)
+			IngestedFile.update(num_records=numRecords, updated_at=datetime.datetime.now()).where(IngestedFile.filename == os.path.basename(filename)).execute()
+		self.dataIdentity = None
+
+	def finishIngestion(self, filename):
+		IngestedFile.update(is_complete=True, updated_at=datetime.datetime.now()).where(IngestedFile.filename == os.path.basename(filename)).execute()
+		self.dataIdentity = None
+
+	# Ingests the records readRecords yields from the open file with addRecords, checkpointing every
+	# recordsPerCheckpoint records. readRecords must yield the same records in the same order on every run.
+	def ingestFile(self, filename, readRecords, addRecords, recordsPerCheckpoint=RECORDS_PER_CHECKPOINT):
+		numRecords = self.startIngestion(filename)
+		if numRecords == None:
+			print 'Skipping %s, already ingested' % filename
+			return
+		if numRecords > 0:
+			print 'Resuming %s after %i records' % (filename, numRecords)
+
+		with open(filename) as f:
+			for batch in chunked(itertools.islice(readRecords(f), numRecords, None), recordsPerCheckpoint):
+				numRecords += len(batch)
+				self.ingestBatch(filename, batch, addRecords, numRecords)
+		self.finishIngestion(filename)
+
+	# Migrates the SPATIAL_TABLES that lack their spatial column and index. Populating the column reads the
+	# whole table, later inserts fill it in as they go (see MySQLDialect.insertSQL).
+	def addSpatialColumns(self):
+		for table in SPATIAL_TABLES:
+			if table not in self.dialect.spatialTables and self.dialect.addSpatialColumn(database, table):
+				self.dialect.spatialTables.add(table)
 
 	def getDist(self, lat, lon, obj):
 		return fn.pow(fn.pow(obj.latitude - lat, 2) + fn.pow(obj.longitude - lon, 2), 0.5)
 
+	# The exact distance check, narrowed to the bounding box first where a spatial index can find it
 	def isClose(self, lat, lon, obj, dist):
-		return self.getDist(lat, lon, obj) < dist
-
-	# TODO: Use MySQL's Spatial Values to make this more efficient
+		isClose = self.getDist(lat, lon, obj) < dist
+		if obj._meta.db_table in self.dialect.spatialTables:
+			return self.dialect.withinBox(lat, lon, dist) & isClose
+		return isClose
+
+	# Loads every pickup and dropoff into memory once so the count queries below never hit MySQL
+	@timed
+	def buildTaxiIndex(self):
+		print 'Building taxi pickup index'
+		self.pickupIndex = PointIndex.fromQuery(TaxiPickup.select(TaxiPickup.time, TaxiPickup.latitude, TaxiPickup.longitude))
+		print 'Building taxi dropoff index'
+		self.dropoffIndex = PointIndex.fromQuery(TaxiDropoff.select(TaxiDropoff.time, TaxiDropoff.latitude, TaxiDropoff.longitude))
+
+	@timed
 	@cached
 	def getNumPickupsNearLocation(self, lat, lon, startTime, endTime):
-		return int(TaxiPickup.select().where(self.isClose(lat, lon, TaxiPickup, 0.00224946357) & TaxiPickup.time.between(startTime, endTime)).count())
+		if self.pickupIndex != None:
+			return self.pickupIndex.count(lat, lon, startTime, endTime, TAXI_DIST)
+		return int(TaxiPickup.select().where(self.isClose(lat, lon, TaxiPickup, TAXI_DIST) & TaxiPickup.time.between(startTime, endTime)).count())
 
-	# TODO: Use MySQL's Spatial Values to make this more efficient
+	@timed
 	@cached
 	def getNumDropoffsNearLocation(self, lat, lon, startTime, endTime):
-		return int(TaxiDropoff.select().where(self.isClose(lat, lon, TaxiDropoff, 0.00224946357) & TaxiDropoff.time.between(startTime, endTime)).count())
+		if self.dropoffIndex != None:
+			return self.dropoffIndex.count(lat, lon, startTime, endTime, TAXI_DIST)
+		return int(TaxiDropoff.select().where(self.isClose(lat, lon, TaxiDropoff, TAXI_DIST) & TaxiDropoff.time.between(startTime, endTime)).count())
+
+	# Epoch times of the pickups or dropoffs counted by the methods above, fetched in a single query
+	def getTaxiTimesNearLocation(self, model, index, lat, lon, startTime, endTime, dist=TAXI_DIST):
+		if index != None:
+			return index.getTimes(lat, lon, startTime, endTime, dist)
+		query = model.select(model.time).where(self.isClose(lat, lon, model, dist) & model.time.between(startTime, endTime))
+		return np.array([toEpochSeconds(time) for (time,) in query.tuples()], dtype=np.int64)
+
+	# Hourly pickup counts near a location for numHours hours from startTime. See binHourly for the format.
+	@timed
+	def getHourlyPickupsNearLocation(self, lat, lon, startTime, numHours):
+		endTime = startTime + datetime.timedelta(hours=numHours)
+		times = self.getTaxiTimesNearLocation(TaxiPickup, self.pickupIndex, lat, lon, startTime, endTime)
+		return binHourly(times, toEpochSeconds(startTime), numHours)
+
+	# Hourly dropoff counts near a location for numHours hours from startTime. See binHourly for the format.
+	@timed
+	def getHourlyDropoffsNearLocation(self, lat, lon, startTime, numHours):
+		endTime = startTime + datetime.timedelta(hours=numHours)
+		times = self.getTaxiTimesNearLocation(TaxiDropoff, self.dropoffIndex, lat, lon, startTime, endTime)
+		return binHourly(times, toEpochSeconds(startTime), numHours)
+
+	# Hourly pickup counts near each of locations, a list of (latitude, longitude), for numHours hours from
+	# startTime. See getHourlyCountMatrix for the format.
+	@timed
+	def getHourlyPickupMatrix(self, locations, startTime, numHours, dist=TAXI_DIST):
+		return self.getHourlyCountMatrix(TaxiPickup, TaxiPickup.time, self.pickupIndex, locations, startTime, numHours, dist)
+
+	# Hourly dropoff counts near each of locations. See getHourlyCountMatrix for the format.
+	@timed
+	def getHourlyDropoffMatrix(self, locations, startTime, numHours, dist=TAXI_DIST):
+		return self.getHourlyCountMatrix(TaxiDropoff, TaxiDropoff.time, self.dropoffIndex, locations, startTime, numHours, dist)
+
+	# Hourly geotagged tweet counts near each of locations. See getHourlyCountMatrix for the format.
+	@timed
+	def getHourlyTweetMatrix(self, locations, startTime, numHours, distInMeters=250):
+		tweetIndex = self.getTweetIndexes()[0] if self.snapshot != None else None
+		return self.getHourlyCountMatrix(Tweet, Tweet.created_at, tweetIndex, locations, startTime, numHours, self.metersToCoordDist(distInMeters))
+
+	# Counts the rows of model within dist of each location by hour, returning (bins, boundaries) as binHourly
+	# does with one row per location, so windowCounts gives every windowed count at once. With an index the
+	# times are binned per location. Otherwise the whole matrix comes from a single query: the locations are
+	# joined to the table as a derived table and the matches grouped by location and hour.
+	def getHourlyCountMatrix(self, model, timeField, index, locations, startTime, numHours, dist):
+		bins = np.zeros((len(locations), numHours), dtype=np.int64)
+		boundaries = np.zeros((len(locations), numHours + 1), dtype=np.int64)
+		endTime = startTime + datetime.timedelta(hours=numHours)
+		if index != None:
+			for i, (latitude, longitude) in enumerate(locations):
+				bins[i], boundaries[i] = binHourly(index.getTimes(latitude, longitude, startTime, endTime, dist), toEpochSeconds(startTime), numHours)
+			return bins, boundaries
+
+		placeholder = self.dialect.placeholder
+		hour = self.dialect.integerDivide('seconds', 3600)
+		table = model._meta.db_table
+		boxSQL = self.dialect.withinJoinBoxSQL('t', 'l') + ' AND ' if table in self.dialect.spatialTables else ''
+		locationsPerQuery = self.dialect.getRowsPerQuery(3, 8) or max(len(locations), 1)
+		for first in xrange(0, len(locations), locationsPerQuery):
+			chunk = locations[first:first + locationsPerQuery]
+			locationsSQL = ' UNION ALL '.join(['SELECT %s AS location_id, %s AS latitude, %s AS longitude' % (placeholder, placeholder, placeholder)] * len(chunk))
+			sql = ('SELECT location_id, %(hour)s AS hour, COUNT(*), SUM(seconds = %(hour)s * 3600) FROM ('
+				'SELECT l.location_id, %(seconds)s AS seconds FROM %(table)s AS t JOIN (%(locations)s) AS l '
+				'ON %(box)sPOW(POW(t.latitude - l.latitude, 2) + POW(t.longitude - l.longitude, 2), 0.5) < %(placeholder)s '
+				'WHERE t.%(time)s BETWEEN %(placeholder)s AND %(placeholder)s) AS matches GROUP BY location_id, hour') % {
+				'hour': hour, 'seconds': self.dialect.secondsSince('t.%s' % timeField.db_column), 'table': table, 'box': boxSQL,
+				'locations': locationsSQL, 'placeholder': placeholder, 'time': timeField.db_column}
+			params = [startTime] + [value for i, (latitude, longitude) in enumerate(chunk) for value in (first + i, latitude, longitude)]
+			params += [dist + BOX_PADDING] * boxSQL.count(placeholder) + [dist, startTime, endTime]
+			for locationId, hour, count, boundaryCount in database.execute_sql(sql, params).fetchall():
+				if int(hour) < numHours:
+					bins[int(locationId), int(hour)] += int(count)
+				boundaries[int(locationId), int(hour)] += int(boundaryCount)
+		return bins, boundaries
 
 	# Adds the taxi data to the db
 	def addTaxiDropoffs(self, dropoffDicts):
-		self.addTaxiDicts(dropoffDicts, 'taxidropoff', self.dropoffDictToSQLString)
+		self.addTaxiDicts(dropoffDicts, 'taxidropoff', self.dropoffDictToSQLRow)
 
 	# Adds the taxi data to the db
 	def addTaxiPickups(self, pickupDicts):
-		self.addTaxiDicts(pickupDicts, 'taxipickup', self.pickupDictToSQLString)
+		self.addTaxiDicts(pickupDicts, 'taxipickup', self.pickupDictToSQLRow)
 
-	def dropoffDictToSQLString(self, dropoffDict):
+	def dropoffDictToSQLRow(self, dropoffDict):
 		for format in ('%m/%d/%Y %H:%M', '%m/%d/%y %I:%M %p'):
 			try:
 				date = datetime.datetime.strptime(dropoffDict['DROPOFF_TIME'], format)
@@ -220,24 +807,57 @@ class DB:
 			except ValueError:
 				pass
 
-		string = ','.join((dropoffDict['ID'], '"%s"' % date.strftime('%Y-%m-%d %H:%M:%S'), '"%s"' % dropoffDict['DROPOFF_ADDRESS'], dropoffDict['DROPOFF_LONG'], dropoffDict['DROPOFF_LAT']))
-		return '(%s)' % string
+		return (dropoffDict['ID'], date.strftime('%Y-%m-%d %H:%M:%S'), dropoffDict['DROPOFF_ADDRESS'], dropoffDict['DROPOFF_LONG'], dropoffDict['DROPOFF_LAT'])
 
-	def pickupDictToSQLString(self, pickupDict):
-		string = ','.join((pickupDict['ID'], '"%s"' % pickupDict['DROPOFF_TIME'], '"%s"' % pickupDict['DROPOFF_ADDRESS'], pickupDict['DROPOFF_LONG'], pickupDict['DROPOFF_LAT']))
-		return '(%s)' % string
+	def pickupDictToSQLRow(self, pickupDict):
+		return (pickupDict['ID'], pickupDict['DROPOFF_TIME'], pickupDict['DROPOFF_ADDRESS'], pickupDict['DROPOFF_LONG'], pickupDict['DROPOFF_LAT'])
 
-	def addTaxiDicts(self, taxiDicts, tableName, dictToSQLString):
+	# Streams taxiDicts (any iterable, e.g. a csv.DictReader) into the table in fixed-size chunks, so memory
+	# use does not depend on the size of the input
+	def addTaxiDicts(self, taxiDicts, tableName, dictToSQLRow):
 		# Paginate so the queries don't get too long
-		index = 0
 		insertsPerQuery = 10000
-		while index < len(taxiDicts):
-			print 'Percent complete:', 100.0 * index / len(taxiDicts)
-
-			args = ','.join((dictToSQLString(taxiDict) for taxiDict in taxiDicts[index:index+insertsPerQuery] if taxiDict['ID'] != 'ID' and taxiDict['ID'] != 'TRIP_ID'))
-			database.execute_sql('INSERT INTO %s (trip_id, time, address, longitude, latitude) VALUES %s' % (tableName, args))
-
-			index += insertsPerQuery
+		numInserted = 0
+		start = time.time()
+		for chunk in chunked(taxiDicts, insertsPerQuery):
+			rows = [dictToSQLRow(taxiDict) for taxiDict in chunk if taxiDict['ID'] != 'ID' and taxiDict['ID'] != 'TRIP_ID']
+			self.insertRows(tableName, TAXI_FIELDS, rows)
+
+			numInserted += len(rows)
+			print 'Rows inserted: %i (%.0f rows/s)' % (numInserted, numInserted / max(time.time() - start, 1e-6))
+
+	# Adds pickups (tableName 'taxipickup') or dropoffs ('taxidropoff') to a DB in use, e.g. from a live feed.
+	# Unlike ingestion this keeps the data generation: the rows go into the in-memory index if there is one, and
+	# only the cached counts of that table are dropped. Returns the epoch times, latitudes and longitudes of the
+	# new rows.
+	def appendTaxiDicts(self, taxiDicts, tableName):
+		dictToSQLRow, indexName, countMethod = {
+			'taxipickup': (self.pickupDictToSQLRow, 'pickupIndex', 'getNumPickupsNearLocation'),
+			'taxidropoff': (self.dropoffDictToSQLRow, 'dropoffIndex', 'getNumDropoffsNearLocation'),
+		}[tableName]
+		rows = [dictToSQLRow(taxiDict) for taxiDict in taxiDicts if taxiDict['ID'] != 'ID' and taxiDict['ID'] != 'TRIP_ID']
+		self.insertRows(tableName, TAXI_FIELDS, rows)
+
+		times = np.array([toEpochSeconds(parseTaxiTime(row[1])) for row in rows], dtype=np.int64)
+		latitudes = np.array([float(row[4]) for row in rows], dtype=np.float64)
+		longitudes = np.array([float(row[3]) for row in rows], dtype=np.float64)
+		if getattr(self, indexName) != None:
+			getattr(self, indexName).add(times, latitudes, longitudes)
+		if self.queryCache == None:
+			self.loadQueryCache()
+		self.queryCache.invalidateMethods([countMethod])
+		return times, latitudes, longitudes
+
+	# The epoch seconds of the latest row of a taxi table, or None if it is empty
+	def getLatestTaxiSeconds(self, tableName):
+		model = {'taxipickup': TaxiPickup, 'taxidropoff': TaxiDropoff}[tableName]
+		if self.snapshot != None:
+			times = self.snapshot.getColumn(tableName, 'time')
+			return int(times.max()) if len(times) > 0 else None
+		latest = model.select(fn.MAX(model.time)).scalar()
+		if latest == None:
+			return None
+		return toEpochSeconds(parseTaxiTime(latest) if isinstance(latest, basestring) else latest)
 
 	# Adds the weather data to the db
 	def addWeather(self, weatherDict):
@@ -261,10 +881,59 @@ class DB:
 		# Write the new row to the database
 		weather.save()
 
-	@cached
+	def addWeathers(self, weatherDicts):
+		for weatherDict in weatherDicts:
+			self.addWeather(weatherDict)
+
+	# Loads the whole weather table into memory, or returns None if the timeline is disabled
+	def getWeatherTimeline(self):
+		if self.weatherTimeline == None and self.snapshot != None:
+			self.weatherTimeline = WeatherTimeline([Weather(**self.snapshot.getRow('weather', i)) for i in xrange(self.snapshot.getNumRows('weather'))])
+		elif self.weatherTimeline == None and self.useWeatherTimeline:
+			self.weatherTimeline = WeatherTimeline(Weather.select())
+		return self.weatherTimeline
+
+	# The nearest weather observation within 10 hours of time, with nulls in the WEATHER_DEFAULTS fields filled
+	# in as the timeline does. Lookups in the timeline are cheaper than the query cache, so only the SQL path is
+	# cached.
+	@timed
 	def getWeather(self, time):
+		if self.getWeatherTimeline() != None:
+			return self.getWeathers([time])[0]
+		return self.getWeatherFromDatabase(time)
+
+	@timed
+	@cached
+	def getWeatherFromDatabase(self, time):
 		halfAnHour = datetime.timedelta(hours=10)
-		return Weather.select().where(Weather.time.between(time - halfAnHour, time + halfAnHour)).order_by(fn.ABS(fn.TIMEDIFF(Weather.time, time)).asc()).limit(1).get()
+		return fillWeatherDefaults(Weather.select().where(Weather.time.between(time - halfAnHour, time + halfAnHour)).order_by(fn.ABS(self.dialect.timeDiff(Weather.time, time)).asc()).limit(1).get())
+
+	# Returns the timeline, or if it is disabled one covering just the given range, fetched in a single query
+	def getWeatherTimelineForRange(self, startTime, endTime):
+		timeline = self.getWeatherTimeline()
+		if timeline == None:
+			halfAnHour = datetime.timedelta(hours=10)
+			timeline = WeatherTimeline(Weather.select().where(Weather.time.between(startTime - halfAnHour, endTime + halfAnHour)))
+		return timeline
+
+	# Batch form of getWeather returning the nearest observation for each of the given (sorted) times
+	@timed
+	def getWeathers(self, times):
+		timeline = self.getWeatherTimelineForRange(times[0], times[-1])
+		nearest = timeline.getNearestIndices([toEpochSeconds(time) for time in times])
+		if np.any(nearest == -1):
+			raise Weather.DoesNotExist('Missing weather observations between %s and %s' % (times[0], times[-1]))
+		return [timeline.observations[i] for i in nearest]
+
+	# The given weather fields of the nearest observation for each of numHours hours from startTime, as a
+	# numHours x len(fields) float array. Nulls in precipm, windchilli and heatindexi are filled with 0.
+	@timed
+	def getHourlyWeather(self, startTime, numHours, fields):
+		timeline = self.getWeatherTimelineForRange(startTime, startTime + datetime.timedelta(hours=numHours))
+		weather = timeline.align(startTime, numHours, fields)
+		if weather is None:
+			raise Weather.DoesNotExist('Missing weather observations for %i hours from %s' % (numHours, startTime))
+		return weather
 
 	def parseTimeStr(self, timeStrList):
 		dateStr = timeStrList.pop(0)
@@ -286,17 +955,51 @@ class DB:
 		# 0.00224946357 = 250 meters
 		return distInMeters / 250 * 0.00224946357
 
+	# Loads the events with accurate times into memory, or returns None if the event index is disabled
+	def getEventIndex(self):
+		if self.eventIndex == None and self.snapshot != None:
+			print 'Building event index'
+			columns = dict((column, self.snapshot.getColumn('event', column)) for column in ('start_time', 'end_time', 'is_time_accurate'))
+			columns['latitude'] = self.snapshot.getCoordinates('event', 'latitude')
+			columns['longitude'] = self.snapshot.getCoordinates('event', 'longitude')
+			isAccurate = columns['is_time_accurate'] == 1
+			self.eventIndex = EventIndex(*[columns[column][isAccurate] for column in ('start_time', 'end_time', 'latitude', 'longitude')])
+		elif self.eventIndex == None and self.useEventIndex:
+			print 'Building event index'
+			self.eventIndex = EventIndex.fromQuery(Event.select(Event.start_time, Event.end_time, Event.latitude, Event.longitude).where(Event.is_time_accurate == 1))
+		return self.eventIndex
+
+	@timed
 	@cached
 	def afterNumEvents(self, lat, lon, time, maxHoursAfterEvent, distInMeters=250):
 		dist = self.metersToCoordDist(distInMeters)
 		earliestEndTime = time - datetime.timedelta(hours=maxHoursAfterEvent)
+		eventIndex = self.getEventIndex()
+		if eventIndex != None:
+			return eventIndex.countEnded(lat, lon, earliestEndTime, time, dist)
 		return int(Event.select().where(self.isClose(lat, lon, Event, dist) & (Event.is_time_accurate == 1) & Event.end_time.between(earliestEndTime, time)).count())
 
+	@timed
 	@cached
 	def duringNumEvents(self, lat, lon, time, distInMeters=250):
 		dist = self.metersToCoordDist(distInMeters)
+		eventIndex = self.getEventIndex()
+		if eventIndex != None:
+			return eventIndex.countDuring(lat, lon, time, dist)
 		return int(Event.select().where(self.isClose(lat, lon, Event, dist) & (Event.is_time_accurate == 1) & (Event.start_time < time) & (Event.end_time > time)).count())
 
+	# Epoch start and end times of the accurately timed events near a location in progress at some point
+	# between startTime and endTime, i.e. every event counted by the two methods above for a time in that range
+	@timed
+	def getEventsNearLocation(self, lat, lon, startTime, endTime, distInMeters=250):
+		dist = self.metersToCoordDist(distInMeters)
+		eventIndex = self.getEventIndex()
+		if eventIndex != None:
+			return eventIndex.getEvents(lat, lon, startTime, endTime, dist)
+		query = Event.select(Event.start_time, Event.end_time).where(self.isClose(lat, lon, Event, dist) & (Event.is_time_accurate == 1) & (Event.end_time >= startTime) & (Event.start_time <= endTime))
+		rows = [(toEpochSeconds(start), toEpochSeconds(end)) for start, end in query.tuples()]
+		return np.array([start for start, end in rows], dtype=np.int64), np.array([end for start, end in rows], dtype=np.int64)
+
 	# Infer the time
 	def inferTime(self, description):
 		return None
@@ -337,112 +1040,84 @@ class DB:
 		while index < len(eventDicts):
 			print 'Percent complete:', 100.0 * index / len(eventDicts)
 
-			args = [self.eventDictToSQLStrings(eventDict, fields) for eventDict in eventDicts[index:index+insertsPerQuery]]
-			args = [sqlString for sqlStrings in args for sqlString in sqlStrings]
-
-			toReplace = ','.join(['(%s)' % (','.join(['%s'] * len(fields)))] * (len(args) / len(fields)))
-			
-			database.execute_sql('INSERT INTO %s (%s) VALUES %s' % ('event', ','.join(fields), toReplace), args)
+			rows = [self.eventDictToSQLStrings(eventDict, fields) for eventDict in eventDicts[index:index+insertsPerQuery]]
+			self.insertRows('event', fields, rows)
 
 			index += insertsPerQuery
 
-	def tweetDictToSQLStrings(self, tweetDict):
-		html_parser = HTMLParser()
-		SQLDict = {}
-
-		# Populate the tweetDict. Use the get method to ensure no KeyErrors are raised
-		text = tweetDict.get('text')
-		if text == None:
-			SQLDict['text'] = None
-			SQLDict['mentions_taxi'] = False
-		else:
-			SQLDict['text'] = html_parser.unescape(text)
-			text = SQLDict['text'].lower()
-			SQLDict['mentions_taxi'] = 'taxi' in text or 'cab' in text
-
-		coords = tweetDict.get('coordinates')
-		if coords == None or coords == 'None':
-			SQLDict['longitude'] = None
-			SQLDict['latitude'] = None
-		else:
-			SQLDict['longitude'] = coords.get('coordinates')[0]
-			SQLDict['latitude'] = coords.get('coordinates')[1]
-
-		created_at = tweetDict.get('created_at')
-		if created_at == None:
-			SQLDict['created_at'] = None
-		else:
-			t = time.strptime(created_at.replace('+0000', ''), '%a %b %d %H:%M:%S %Y')
-			SQLDict['created_at'] = time.strftime('%Y-%m-%d %H:%M:%S', t)
-
-		SQLDict['favorited'] = tweetDict.get('favorited')
-
-		SQLDict['tweet_id'] = tweetDict.get('id')
-
-		place = tweetDict.get('place')
-		if place == None or place == 'None':
-			SQLDict['place_id'] = None
-		else:
-			SQLDict['place_id'] = place.get('id')
-
-		SQLDict['retweet_count'] = tweetDict.get('retweet_count')
-
-		SQLDict['source'] = tweetDict.get('source')
-
-		user = tweetDict.get('user')
-		if user == None:
-			SQLDict['user_id'] = None
-		else:
-			SQLDict['user_id'] = user.get('id')
-
-		return SQLDict
-
-	# Adds the tweet data to the db
+	# Adds the tweet data to the db. tweetDicts can be any iterable, it is consumed in fixed-size chunks.
 	def addTweets(self, tweetDicts):
 		# Paginate so the queries don't get too long
-		index = 0
 		insertsPerQuery = 10000
-		tweetStrings = [0] * insertsPerQuery
-		while len(tweetStrings) == insertsPerQuery:
-			tweetStrings = [self.tweetDictToSQLStrings(tweetDict) for tweetDict in (tweetDicts.next() for i in xrange(insertsPerQuery))]
-			fields = tweetStrings[0].keys()
-			flattenedTweetStrings = [sqlStrings[field] for sqlStrings in tweetStrings for field in fields]
-
-			toReplace = ','.join(['(%s)' % (','.join(['%s'] * len(fields)))] * (len(flattenedTweetStrings) / len(fields)))
-			
-			database.execute_sql('INSERT INTO %s (%s) VALUES %s' % ('tweet', ','.join(fields), toReplace), flattenedTweetStrings)
-
-			index += insertsPerQuery
-
+		for chunk in chunked(tweetDicts, insertsPerQuery):
+			self.addTweetRows([tweetDictToSQLRow(tweetDict) for tweetDict in chunk])
+
+	# Adds tweets already converted by tweetDictToSQLRow
+	def addTweetRows(self, tweetRows):
+		self.insertRows('tweet', TWEET_FIELDS, tweetRows)
+
+	# Inserts rows (tuples in the order of fields) in one transaction, with as few parameterized queries as the
+	# backend allows
+	def insertRows(self, table, fields, rows):
+		if len(rows) == 0:
+			return
+		rowsPerQuery = self.dialect.getRowsPerQuery(len(fields)) or len(rows)
+		with database.atomic():
+			for chunk in chunked(rows, rowsPerQuery):
+				database.execute_sql(self.dialect.insertSQL(table, fields, len(chunk)), [value for row in chunk for value in row])
+
+	@timed
 	@cached
 	def getNumTweetsNearLocation(self, latitude, longitude, startTime, endTime, distInMeters=250):
 		dist = self.metersToCoordDist(distInMeters)
+		if self.snapshot != None:
+			return self.getTweetIndexes()[0].count(latitude, longitude, startTime, endTime, dist)
 		return int(Tweet.select().where(self.isClose(latitude, longitude, Tweet, dist) & (Tweet.created_at.between(startTime, endTime))).count())
 
+	@timed
 	@cached
 	def getNumTweetsNearLocationMentioningTaxi(self, latitude, longitude, startTime, endTime, distInMeters=250):
 		dist = self.metersToCoordDist(distInMeters)
+		if self.snapshot != None:
+			return self.getTweetIndexes()[1].count(latitude, longitude, startTime, endTime, dist)
 		return int(Tweet.select().where(self.isClose(latitude, longitude, Tweet, dist) & (Tweet.mentions_taxi == 1) & (Tweet.created_at.between(startTime, endTime))).count())
 
+	@timed
 	@cached
 	def getNumTweetsMentioningTaxi(self, startTime, endTime):
+		if self.snapshot != None:
+			times = self.getTweetIndexes()[2]
+			return int(np.searchsorted(times, toEpochSeconds(endTime), side='right') - np.searchsorted(times, toEpochSeconds(startTime), side='left'))
 		return int(Tweet.select().where((Tweet.mentions_taxi == 1) & (Tweet.created_at.between(startTime, endTime))).count())
 
+	# Epoch times of the tweets counted by getNumTweetsNearLocation, or with mentionsTaxi by
+	# getNumTweetsNearLocationMentioningTaxi, fetched in a single query
+	@timed
+	def getTweetTimesNearLocation(self, latitude, longitude, startTime, endTime, distInMeters=250, mentionsTaxi=False):
+		dist = self.metersToCoordDist(distInMeters)
+		if self.snapshot != None:
+			return self.getTweetIndexes()[1 if mentionsTaxi else 0].getTimes(latitude, longitude, startTime, endTime, dist)
+		condition = self.isClose(latitude, longitude, Tweet, dist) & Tweet.created_at.between(startTime, endTime)
+		if mentionsTaxi:
+			condition &= Tweet.mentions_taxi == 1
+		return np.array([toEpochSeconds(time) for (time,) in Tweet.select(Tweet.created_at).where(condition).tuples()], dtype=np.int64)
+
+	# Epoch times of the tweets counted by getNumTweetsMentioningTaxi
+	@timed
+	def getTaxiTweetTimes(self, startTime, endTime):
+		if self.snapshot != None:
+			times = self.getTweetIndexes()[2]
+			return times[np.searchsorted(times, toEpochSeconds(startTime), side='left'):np.searchsorted(times, toEpochSeconds(endTime), side='right')]
+		query = Tweet.select(Tweet.created_at).where((Tweet.mentions_taxi == 1) & Tweet.created_at.between(startTime, endTime))
+		return np.array([toEpochSeconds(time) for (time,) in query.tuples()], dtype=np.int64)
+
 	def addDicts(self, table, dicts, dictToSQLString):
 		# Paginate so the queries don't get too long
-		index = 0
 		insertsPerQuery = 10000
-		dictStrings = [0] * insertsPerQuery
-		while len(dictStrings) == insertsPerQuery:
-			dictStrings = [dictToSQLString(objectDicts) for objectDicts in (dicts.next() for i in xrange(insertsPerQuery))]
+		for chunk in chunked(dicts, insertsPerQuery):
+			dictStrings = [dictToSQLString(objectDicts) for objectDicts in chunk]
 			fields = dictStrings[0].keys()
-			flattenedDictStrings = [sqlStrings[field] for sqlStrings in dictStrings for field in fields]
-
-			toReplace = ','.join(['(%s)' % (','.join(['%s'] * len(fields)))] * (len(flattenedDictStrings) / len(fields)))
-
-			database.execute_sql('INSERT INTO %s (%s) VALUES %s' % (table, ','.join(fields), toReplace), flattenedDictStrings)
-
-			index += insertsPerQuery
+			self.insertRows(table, fields, [[sqlStrings[field] for field in fields] for sqlStrings in dictStrings])
 
 	def busDictToSQLStrings(self, TDict):
 		SQLDict = {}
@@ -507,35 +1182,43 @@ class DB:
 	def addStops(self, stopDicts):
 		self.addDicts('stop', stopDicts, self.stopDictToSQLStrings)
 
+	@timed
 	@cached
 	def getXClosestStations(self, latitude, longitude, x, isStation):
+		if self.snapshot != None:
+			matches = np.flatnonzero(self.snapshot.getColumn('stop', 'is_station') == int(isStation))
+			dists = np.sqrt((self.snapshot.getCoordinates('stop', 'latitude')[matches] - latitude) ** 2 + (self.snapshot.getCoordinates('stop', 'longitude')[matches] - longitude) ** 2)
+			stations = self.snapshot.getVocabulary('stop', 'station')
+			return [stations[code] for code in self.snapshot.getColumn('stop', 'station')[matches[np.argsort(dists, kind='mergesort')[:x]]]]
 		return [stop.station for stop in Stop.select().where(Stop.is_station == isStation).order_by(self.getDist(latitude, longitude, Stop).asc()).limit(x)]
 
+	# Memory-maps the hourly T ride counts written by ParseData.parseTRides2 on first use
+	def getTRideCube(self):
+		if self.TRideCube == None:
+			self.TRideCube = TRideCube.load(TRIDE_CUBE_FILENAME)
+		return self.TRideCube
+
+	@timed
 	def getNumTRides(self, station, startTime, endTime, label):
-		currentTime = datetime.datetime(startTime.year, startTime.month, startTime.day, startTime.hour)
-		total = 0
-		while currentTime < endTime:
-			try:
-				total += self.TRideCache[station][currentTime][label]
-			except KeyError:
-				pass
-			currentTime += datetime.timedelta(hours=1)
-		return total
+		return self.getTRideCube().getNumRides(station, startTime, endTime, label)
 
-	@cached
+	# Not cached: a cube lookup is cheaper than a cache lookup
+	@timed
 	def getNumTRidesFromStation(self, station, startTime, endTime):
 		return self.getNumTRides(station, startTime, endTime, 'origin')
 		# return int(TRide.select().where((TRide.origin == station) & TRide.datetime.between(startTime, endTime)).count())
 
-	@cached
+	@timed
 	def getNumTRidesToStation(self, station, startTime, endTime):
 		return self.getNumTRides(station, startTime, endTime, 'destination')
 		# return int(TRide.select().where((TRide.destination == station) & TRide.datetime.between(startTime, endTime)).count())
 
+	@timed
 	@cached
 	def getNumTRidesFromXClosestStations(self, latitude, longitude, startTime, endTime, x):
 		return sum(self.getNumTRidesFromStation(station, startTime, endTime) for station in self.getXClosestStations(latitude, longitude, x, True))
 
+	@timed
 	@cached
 	def getNumTRidesToXClosestStations(self, latitude, longitude, startTime, endTime, x):
 		return sum(self.getNumTRidesToStation(station, startTime, endTime) for station in self.getXClosestStations(latitude, longitude, x, True))
@@ -0,0 +1,325 @@
+import bisect
+import calendar
+import datetime
+
+import numpy as np
+
+
+# 0.00224946357 = 250 meters
+DEFAULT_CELL_SIZE = 0.00224946357
+
+
+def toEpochSeconds(time):
+	return calendar.timegm(time.timetuple())
+
+def fromEpochSeconds(seconds):
+	return datetime.datetime.utcfromtimestamp(seconds)
+
+# Buckets epoch times into numHours hourly bins starting at startSeconds. Returns (bins, boundaries) where
+# bins[i] counts times in [hour i, hour i+1) and boundaries[i] counts times falling exactly on hour i, for
+# i in 0..numHours. The inclusive count for hours [a, b] is then sum(bins[a:b]) + boundaries[b].
+def binHourly(seconds, startSeconds, numHours):
+	seconds = np.asarray(seconds, dtype=np.int64)
+	offsets = seconds - startSeconds
+	offsets = offsets[(offsets >= 0) & (offsets <= numHours * 3600)]
+	hours = offsets // 3600
+	bins = np.bincount(hours[hours < numHours], minlength=numHours)
+	boundaries = np.bincount(hours[offsets % 3600 == 0], minlength=numHours + 1)
+	return bins, boundaries
+
+# Index of the nearest of sortedSeconds to each of seconds, preferring the earlier one on ties, or -1 where
+# the nearest is more than maxDistance seconds away
+def nearestIndices(sortedSeconds, seconds, maxDistance):
+	seconds = np.asarray(seconds, dtype=np.int64)
+	if len(sortedSeconds) == 0:
+		return np.zeros(len(seconds), dtype=np.int64) - 1
+	after = np.clip(np.searchsorted(sortedSeconds, seconds), 0, len(sortedSeconds) - 1)
+	before = np.clip(after - 1, 0, len(sortedSeconds) - 1)
+	useBefore = np.abs(seconds - sortedSeconds[before]) <= np.abs(sortedSeconds[after] - seconds)
+	nearest = np.where(useBefore, before, after)
+	return np.where(np.abs(sortedSeconds[nearest] - seconds) <= maxDistance, nearest, -1)
+
+# Inclusive counts over the window [startHours, endHours] relative to each of numHours consecutive hours,
+# where hour 0 sits at index offset of the bins returned by binHourly. bins and boundaries may also be
+# matrices with the hours along the last axis, like those of DB.getHourlyCountMatrix.
+def windowCounts(bins, boundaries, offset, startHours, endHours, numHours):
+	bins = np.asarray(bins)
+	cumulative = np.concatenate((np.zeros(bins.shape[:-1] + (1,), dtype=np.int64), np.cumsum(bins, axis=-1)), axis=-1)
+	starts = np.arange(numHours) + offset + startHours
+	ends = np.arange(numHours) + offset + endHours
+	return cumulative[..., ends] - cumulative[..., starts] + np.asarray(boundaries)[..., ends]
+
+
+# Values used in place of nulls in the weather fields the feature generators read
+WEATHER_DEFAULTS = {'precipm': 0.0, 'windchilli': 0.0, 'heatindexi': 0.0}
+
+# Fills the WEATHER_DEFAULTS fields of a weather observation that are null. Returns the observation.
+def fillWeatherDefaults(observation, defaults=WEATHER_DEFAULTS):
+	for field, default in defaults.iteritems():
+		if getattr(observation, field) == None:
+			setattr(observation, field, default)
+	return observation
+
+# Observations further than this from the requested time are not used (matches DB.getWeather)
+WEATHER_MAX_DISTANCE = 10 * 3600
+
+
+# The weather observations held in memory, sorted by time, with a float array per field built on first use.
+# Weather does not depend on location, so one timeline serves every POI. Nulls in WEATHER_DEFAULTS fields
+# are filled in on load.
+class WeatherTimeline:
+	def __init__(self, observations, defaults=WEATHER_DEFAULTS):
+		self.observations = sorted(observations, key=lambda observation: observation.time)
+		for observation in self.observations:
+			fillWeatherDefaults(observation, defaults)
+		self.times = np.array([toEpochSeconds(observation.time) for observation in self.observations], dtype=np.int64)
+		self.columns = {}
+
+	def __len__(self):
+		return len(self.observations)
+
+	# Field values as a float array, with NaN for nulls
+	def getColumn(self, field):
+		if field not in self.columns:
+			values = [getattr(observation, field) for observation in self.observations]
+			self.columns[field] = np.array([np.nan if value == None else float(value) for value in values], dtype=np.float64)
+		return self.columns[field]
+
+	# Index of the nearest observation to each of the given epoch times, or -1 where there is none within
+	# WEATHER_MAX_DISTANCE. Ties go to the earlier observation.
+	def getNearestIndices(self, seconds):
+		return nearestIndices(self.times, seconds, WEATHER_MAX_DISTANCE)
+
+	# Returns a numHours x len(fields) array of the nearest observation's fields for each hour from startTime,
+	# or None if some hour has no observation in range
+	def align(self, startTime, numHours, fields):
+		nearest = self.getNearestIndices(toEpochSeconds(startTime) + 3600 * np.arange(numHours, dtype=np.int64))
+		if np.any(nearest == -1):
+			return None
+		return np.column_stack([self.getColumn(field)[nearest] for field in fields]).reshape(numHours, len(fields))
+
+
+# In-memory index over timestamped points answering "how many points within dist of (lat, lon) between
+# startTime and endTime". Points are hashed into a square grid of cellSize degrees, and the points in each
+# cell are stored contiguously and sorted by time so the time filter is a pair of binary searches.
+class PointIndex:
+	def __init__(self, times, latitudes, longitudes, cellSize=DEFAULT_CELL_SIZE):
+		self.cellSize = cellSize
+
+		times = np.asarray(times, dtype=np.int64)
+		latitudes = np.asarray(latitudes, dtype=np.float64)
+		longitudes = np.asarray(longitudes, dtype=np.float64)
+
+		cellXs = np.floor(latitudes / cellSize).astype(np.int64)
+		cellYs = np.floor(longitudes / cellSize).astype(np.int64)
+
+		# Sort by cell, then by time within each cell
+		order = np.lexsort((times, cellYs, cellXs))
+		self.times = times[order]
+		self.latitudes = latitudes[order]
+		self.longitudes = longitudes[order]
+		self.buildCells(cellXs[order], cellYs[order])
+
+	# Maps each cell to its [start, end) slice of the sorted arrays
+	def buildCells(self, cellXs, cellYs):
+		self.cells = {}
+		if len(self.times) > 0:
+			boundaries = np.flatnonzero((cellXs[1:] != cellXs[:-1]) | (cellYs[1:] != cellYs[:-1])) + 1
+			starts = np.concatenate(([0], boundaries))
+			ends = np.concatenate((boundaries, [len(self.times)]))
+			for start, end in zip(starts, ends):
+				self.cells[(int(cellXs[start]), int(cellYs[start]))] = (int(start), int(end))
+
+	def __len__(self):
+		return len(self.times)
+
+	# Adds points to the index. Each new point is inserted at its place in the cell and time order, so adding a
+	# small batch costs a copy of the arrays rather than a sort of the whole index.
+	def add(self, times, latitudes, longitudes):
+		times = np.asarray(times, dtype=np.int64)
+		latitudes = np.asarray(latitudes, dtype=np.float64)
+		longitudes = np.asarray(longitudes, dtype=np.float64)
+		if len(times) == 0:
+			return
+
+		# Points inserted at the same position keep their order, so sort them like the index first
+		cellXs = np.floor(latitudes / self.cellSize).astype(np.int64)
+		cellYs = np.floor(longitudes / self.cellSize).astype(np.int64)
+		order = np.lexsort((times, cellYs, cellXs))
+		times, latitudes, longitudes, cellXs, cellYs = times[order], latitudes[order], longitudes[order], cellXs[order], cellYs[order]
+
+		# A point goes after the earlier points of its cell, or for a new cell before the next cell in order
+		cells = sorted(self.cells)
+		positions = np.zeros(len(times), dtype=np.int64)
+		for i in xrange(len(times)):
+			cell = (int(cellXs[i]), int(cellYs[i]))
+			if cell in self.cells:
+				start, end = self.cells[cell]
+				positions[i] = start + np.searchsorted(self.times[start:end], times[i], side='right')
+			else:
+				nextCell = bisect.bisect_right(cells, cell)
+				positions[i] = self.cells[cells[nextCell]][0] if nextCell < len(cells) else len(self.times)
+
+		self.times = np.insert(self.times, positions, times)
+		self.latitudes = np.insert(self.latitudes, positions, latitudes)
+		self.longitudes = np.insert(self.longitudes, positions, longitudes)
+		self.buildCells(np.floor(self.latitudes / self.cellSize).astype(np.int64), np.floor(self.longitudes / self.cellSize).astype(np.int64))
+
+	# Builds the index from a query yielding (time, latitude, longitude) rows
+	@classmethod
+	def fromQuery(cls, query, cellSize=DEFAULT_CELL_SIZE):
+		times, latitudes, longitudes = [], [], []
+		for time, latitude, longitude in query.tuples().iterator():
+			if time == None or latitude == None or longitude == None:
+				continue
+			times.append(toEpochSeconds(time))
+			latitudes.append(float(latitude))
+			longitudes.append(float(longitude))
+		return cls(times, latitudes, longitudes, cellSize)
+
+	# Yields the [start, end) slices of the cells overlapping the square around (lat, lon)
+	def getCellSlices(self, lat, lon, dist):
+		minX, maxX = int(np.floor((lat - dist) / self.cellSize)), int(np.floor((lat + dist) / self.cellSize))
+		minY, maxY = int(np.floor((lon - dist) / self.cellSize)), int(np.floor((lon + dist) / self.cellSize))
+		for cellX in xrange(minX, maxX + 1):
+			for cellY in xrange(minY, maxY + 1):
+				cell = self.cells.get((cellX, cellY))
+				if cell != None:
+					yield cell
+
+	# Yields the [low, high) slices of the sorted arrays with startSeconds <= time <= endSeconds in the cells
+	# near (lat, lon), along with a mask of the points in each slice strictly within dist
+	def getNearSlices(self, lat, lon, startTime, endTime, dist):
+		startSeconds, endSeconds = toEpochSeconds(startTime), toEpochSeconds(endTime)
+		for start, end in self.getCellSlices(lat, lon, dist):
+			cellTimes = self.times[start:end]
+			low = start + np.searchsorted(cellTimes, startSeconds, side='left')
+			high = start + np.searchsorted(cellTimes, endSeconds, side='right')
+			if low < high:
+				dists = np.sqrt((self.latitudes[low:high] - lat) ** 2 + (self.longitudes[low:high] - lon) ** 2)
+				yield low, high, dists < dist
+
+	# Number of points strictly within dist of (lat, lon) with startTime <= time <= endTime. Both ends are
+	# inclusive to match the SQL BETWEEN used by the DB queries.
+	def count(self, lat, lon, startTime, endTime, dist):
+		return sum(int(np.count_nonzero(mask)) for low, high, mask in self.getNearSlices(lat, lon, startTime, endTime, dist))
+
+	# Epoch times of the points counted by count()
+	def getTimes(self, lat, lon, startTime, endTime, dist):
+		times = [self.times[low:high][mask] for low, high, mask in self.getNearSlices(lat, lon, startTime, endTime, dist)]
+		if len(times) == 0:
+			return np.zeros(0, dtype=np.int64)
+		return np.concatenate(times)
+
+
+# Static centered interval tree over (start, end, value) tuples answering "which intervals have
+# start < t < end"
+class IntervalTree:
+	def __init__(self, intervals):
+		self.left = None
+		self.right = None
+		if len(intervals) == 0:
+			self.center = None
+			self.byStart = []
+			self.byEnd = []
+			return
+
+		endpoints = sorted([interval[0] for interval in intervals] + [interval[1] for interval in intervals])
+		self.center = endpoints[len(endpoints) // 2]
+
+		# Intervals containing the center stay at this node, the rest go to the children
+		here = [interval for interval in intervals if interval[0] <= self.center <= interval[1]]
+		left = [interval for interval in intervals if interval[1] < self.center]
+		right = [interval for interval in intervals if interval[0] > self.center]
+		self.byStart = sorted(here, key=lambda interval: interval[0])
+		self.byEnd = sorted(here, key=lambda interval: interval[1], reverse=True)
+		if len(left) > 0:
+			self.left = IntervalTree(left)
+		if len(right) > 0:
+			self.right = IntervalTree(right)
+
+	def stab(self, t):
+		node = self
+		while node != None and node.center != None:
+			if t < node.center:
+				# Every interval here ends at or after the center, so only the start needs checking
+				for interval in node.byStart:
+					if interval[0] >= t:
+						break
+					yield interval
+				node = node.left
+			elif t > node.center:
+				for interval in node.byEnd:
+					if interval[1] <= t:
+						break
+					yield interval
+				node = node.right
+			else:
+				for interval in node.byStart:
+					if interval[0] < t < interval[1]:
+						yield interval
+				node = None
+
+
+# In-memory index over events with a location and a [start, end] time span. Answers both "events near P
+# that ended in a time range" (a PointIndex over the end times) and "events near P in progress at t" (one
+# interval tree per grid cell).
+class EventIndex:
+	def __init__(self, startTimes, endTimes, latitudes, longitudes, cellSize=DEFAULT_CELL_SIZE):
+		self.cellSize = cellSize
+		self.ends = PointIndex(endTimes, latitudes, longitudes, cellSize)
+
+		self.cellIntervals = {}
+		for startTime, endTime, latitude, longitude in zip(startTimes, endTimes, latitudes, longitudes):
+			cell = (int(np.floor(latitude / cellSize)), int(np.floor(longitude / cellSize)))
+			self.cellIntervals.setdefault(cell, []).append((int(startTime), int(endTime), (float(latitude), float(longitude))))
+		self.cellTrees = dict((cell, IntervalTree(intervals)) for cell, intervals in self.cellIntervals.iteritems())
+
+	def __len__(self):
+		return len(self.ends)
+
+	# Builds the index from a query yielding (start_time, end_time, latitude, longitude) rows
+	@classmethod
+	def fromQuery(cls, query, cellSize=DEFAULT_CELL_SIZE):
+		startTimes, endTimes, latitudes, longitudes = [], [], [], []
+		for startTime, endTime, latitude, longitude in query.tuples().iterator():
+			startTimes.append(toEpochSeconds(startTime))
+			endTimes.append(toEpochSeconds(endTime))
+			latitudes.append(float(latitude))
+			longitudes.append(float(longitude))
+		return cls(startTimes, endTimes, latitudes, longitudes, cellSize)
+
+	# Number of events strictly within dist of (lat, lon) with startTime <= end time <= endTime
+	def countEnded(self, lat, lon, startTime, endTime, dist):
+		return self.ends.count(lat, lon, startTime, endTime, dist)
+
+	# Number of events strictly within dist of (lat, lon) with start time < time < end time
+	def countDuring(self, lat, lon, time, dist):
+		seconds = toEpochSeconds(time)
+		minX, maxX = int(np.floor((lat - dist) / self.cellSize)), int(np.floor((lat + dist) / self.cellSize))
+		minY, maxY = int(np.floor((lon - dist) / self.cellSize)), int(np.floor((lon + dist) / self.cellSize))
+		total = 0
+		for cellX in xrange(minX, maxX + 1):
+			for cellY in xrange(minY, maxY + 1):
+				tree = self.cellTrees.get((cellX, cellY))
+				if tree == None:
+					continue
+				for startSeconds, endSeconds, (latitude, longitude) in tree.stab(seconds):
+					if np.sqrt((latitude - lat) ** 2 + (longitude - lon) ** 2) < dist:
+						total += 1
+		return total
+
+	# Start and end epoch times of the events strictly within dist of (lat, lon) with end time >= startTime
+	# and start time <= endTime
+	def getEvents(self, lat, lon, startTime, endTime, dist):
+		startSeconds, endSeconds = toEpochSeconds(startTime), toEpochSeconds(endTime)
+		minX, maxX = int(np.floor((lat - dist) / self.cellSize)), int(np.floor((lat + dist) / self.cellSize))
+		minY, maxY = int(np.floor((lon - dist) / self.cellSize)), int(np.floor((lon + dist) / self.cellSize))
+		starts, ends = [], []
+		for cellX in xrange(minX, maxX + 1):
+			for cellY in xrange(minY, maxY + 1):
+				for eventStart, eventEnd, (latitude, longitude) in self.cellIntervals.get((cellX, cellY), []):
+					if eventEnd >= startSeconds and eventStart <= endSeconds and np.sqrt((latitude - lat) ** 2 + (longitude - lon) ** 2) < dist:
+						starts.append(eventStart)
+						ends.append(eventEnd)
+		return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
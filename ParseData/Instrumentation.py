@@ -0,0 +1,106 @@
+import os
+import json
+import math
+import time
+
+
+# Set BIGDATA_INSTRUMENT=1 to record every DB query method, or pass instrument=True to DB
+INSTRUMENT = os.environ.get('BIGDATA_INSTRUMENT', '') not in ('', '0')
+
+# Summaries are appended to this file as one JSON object per line, so parallel processes can share it
+INSTRUMENTATION_FILENAME = os.environ.get('BIGDATA_INSTRUMENT_FILE', 'instrumentation.jsonl')
+
+# Latencies are counted in logarithmic buckets, BUCKETS_PER_DECADE per power of 10 from MIN_LATENCY seconds
+# up, so percentiles are within about 6% however many calls are recorded
+MIN_LATENCY = 1e-7
+BUCKETS_PER_DECADE = 20
+NUM_BUCKETS = 10 * BUCKETS_PER_DECADE
+
+PERCENTILES = [50, 90, 99]
+
+
+# Latency statistics for a single method
+class Timer:
+	def __init__(self):
+		self.calls = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = [0] * NUM_BUCKETS
+
+	def record(self, seconds):
+		self.calls += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+		bucket = int(math.log10(max(seconds, MIN_LATENCY) / MIN_LATENCY) * BUCKETS_PER_DECADE)
+		self.buckets[min(bucket, NUM_BUCKETS - 1)] += 1
+
+	# Upper edge of the bucket holding the given percentile, capped at the slowest call
+	def getPercentile(self, percentile):
+		rank = percentile / 100.0 * self.calls
+		seen = 0
+		for bucket, count in enumerate(self.buckets):
+			seen += count
+			if seen >= rank and count > 0:
+				return min(MIN_LATENCY * 10 ** ((bucket + 1.0) / BUCKETS_PER_DECADE), self.max)
+		return self.max
+
+	def getSummary(self):
+		summary = {
+			'calls': self.calls,
+			'total': self.total,
+			'mean': self.total / self.calls if self.calls > 0 else 0.0,
+			'max': self.max,
+		}
+		for percentile in PERCENTILES:
+			summary['p%i' % percentile] = self.getPercentile(percentile)
+		return summary
+
+
+# Per-method call counts and latencies, plus query cache hits and misses per cached method
+class Instrumentation:
+	def __init__(self):
+		self.timers = {}
+		self.cacheHits = {}
+		self.cacheMisses = {}
+		self.start = time.time()
+
+	def record(self, name, seconds):
+		if name not in self.timers:
+			self.timers[name] = Timer()
+		self.timers[name].record(seconds)
+
+	def recordCacheLookup(self, name, found):
+		counts = self.cacheHits if found else self.cacheMisses
+		counts[name] = counts.get(name, 0) + 1
+
+	# cacheStats are the QueryCache totals (including evictions), if a cache was used
+	def getSummary(self, cacheStats=None):
+		methods = dict((name, timer.getSummary()) for name, timer in self.timers.iteritems())
+		for name in set(self.cacheHits) | set(self.cacheMisses):
+			summary = methods.setdefault(name, {})
+			summary['cacheHits'] = self.cacheHits.get(name, 0)
+			summary['cacheMisses'] = self.cacheMisses.get(name, 0)
+			summary['cacheHitRate'] = float(summary['cacheHits']) / (summary['cacheHits'] + summary['cacheMisses'])
+		return {
+			'pid': os.getpid(),
+			'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+			'elapsed': time.time() - self.start,
+			'methods': methods,
+			'cache': cacheStats,
+		}
+
+	# Formats the methods of a summary as a table sorted by total time, in milliseconds
+	def formatTable(self, summary):
+		columns = ['calls', 'total', 'mean'] + ['p%i' % percentile for percentile in PERCENTILES] + ['max']
+		lines = ['%-40s %10s %12s %10s %10s %10s %10s %10s %8s' % tuple(['method'] + columns + ['hit rate'])]
+		for name, stats in sorted(summary['methods'].iteritems(), key=lambda item: -item[1].get('total', 0.0)):
+			values = [stats.get('calls', 0)] + [1000 * stats.get(column, 0.0) for column in columns[1:]]
+			hitRate = '%7.1f%%' % (100 * stats['cacheHitRate']) if 'cacheHitRate' in stats else ''
+			lines.append('%-40s %10i %12.1f %10.3f %10.3f %10.3f %10.3f %10.3f %8s' % tuple([name] + values + [hitRate]))
+		return '\n'.join(lines)
+
+	def dump(self, cacheStats=None, filename=INSTRUMENTATION_FILENAME):
+		summary = self.getSummary(cacheStats)
+		print self.formatTable(summary)
+		with open(filename, 'a') as f:
+			f.write(json.dumps(summary, sort_keys=True) + '\n')
@@ -1,180 +1,263 @@
 import csv
 import os
+import glob
 import json
 import time
-import cPickle as pickle
+import Queue
 import datetime
+import itertools
+import traceback
+import threading
+import multiprocessing
 
-from Database import DB
+from Database import DB, chunked, tweetDictToSQLRow
 from Config import DATA_FOLDER
+from RptReader import RptReader
+from TRideCube import TRideCube, TRIDE_CUBE_FILENAME
+from Index import toEpochSeconds
 
 
 PICKUPS_FILENAME = os.path.join(DATA_FOLDER, 'pickups_train.csv')
 DROPOFFS_FILENAME = os.path.join(DATA_FOLDER, 'dropoffs.csv')
 WEATHER_FILENAME = os.path.join(DATA_FOLDER, 'wunderground.json')
 EVENTS_FILENAME = os.path.join(DATA_FOLDER, 'events.csv')
-TWEETS_FILENAMES = [os.path.join(DATA_FOLDER, '2012_%02i.json' % month) for month in xrange(4, 13)]
+# Every month present, so newly added months are picked up by the next run
+TWEETS_FILENAMES = sorted(glob.glob(os.path.join(DATA_FOLDER, '[0-9][0-9][0-9][0-9]_[0-9][0-9].json')))
 BUS_FILENAMES = [os.path.join(DATA_FOLDER, 'mbta', 'AFC_%s2012.rpt' % month) for month in ('May', 'June')]
 T_FILENAMES = [os.path.join(DATA_FOLDER, 'mbta', 'ODRail_%s2012.rpt' % month) for month in ('May', 'June')]
 STOPS_FILENAME = os.path.join(DATA_FOLDER, 'mbta', 'Stops.rpt')
 
+# Parallel tweet ingestion settings
+NUM_TWEET_WORKERS = max(multiprocessing.cpu_count() - 1, 1)
+TWEET_LINES_PER_CHUNK = 5000
+TWEET_QUEUE_SIZE = 16  # Max chunks waiting at each stage, which bounds memory use
+TWEET_POLL_SECONDS = 10  # How often the writer checks the workers are still alive while it waits for rows
+
+
+# Every parse function goes through DB.ingestFile, so re-running one skips the files already ingested and
+# resumes a partially ingested one from its last checkpoint rather than inserting duplicates
 
 def parsePickups(db):
 	print 'Parsing Taxi Pickups'
-	with open(PICKUPS_FILENAME) as f:
-		db.addTaxiPickups(list(csv.DictReader(f, fieldnames=['ID', 'DROPOFF_TIME', 'DROPOFF_ADDRESS', 'DROPOFF_LONG', 'DROPOFF_LAT'])))
+	db.ingestFile(PICKUPS_FILENAME, lambda f: csv.DictReader(f, fieldnames=['ID', 'DROPOFF_TIME', 'DROPOFF_ADDRESS', 'DROPOFF_LONG', 'DROPOFF_LAT']), db.addTaxiPickups)
+	db.invalidateQueryCache()
 
 def parseDropoffs(db):
 	print 'Parsing Taxi Dropoffs'
-	with open(DROPOFFS_FILENAME) as f:
-		db.addTaxiDropoffs(list(csv.DictReader(f)))
+	db.ingestFile(DROPOFFS_FILENAME, csv.DictReader, db.addTaxiDropoffs)
+	db.invalidateQueryCache()
+
+def readObservations(f):
+	for response in json.load(f):
+		for observation in response['history']['observations']:
+			yield observation
 
 def parseWeather(db):
 	print 'Parsing Weather'
-	with open(WEATHER_FILENAME) as f:
-		for response in json.load(f):
-			for observation in response['history']['observations']:
-				db.addWeather(observation)
+	db.ingestFile(WEATHER_FILENAME, readObservations, db.addWeathers)
+	db.invalidateQueryCache()
+
+def readEvents(f):
+	events = []
+	for row in csv.DictReader(f, fieldnames=['event_id', 'name', 'time', 'address', 'type', 'description', 'extra1', 'extra2'], quoting=csv.QUOTE_NONE, delimiter='\t'):
+		if row['extra1'] != None:
+			row['latitude'] = row['type']
+			row['longitude'] = row['description']
+			row['type'] = row['extra1']
+			row['description'] = row['extra2']
+			events.append(row)
+			break
+		addressList = row['address'].split(' ')
+		row['latitude'] = addressList[-2]
+		row['longitude'] = addressList[-1]
+		row['address'] = ' '.join(addressList[:-2])
+		events.append(row)
+
+	for row in csv.DictReader(f, fieldnames=['event_id', 'name', 'time', 'address', 'latitude', 'longitude', 'type', 'description'], quoting=csv.QUOTE_NONE, delimiter='\t'):
+		events.append(row)
+	return events
 
 def parseEvents(db):
 	print 'Parsing Events'
-	with open(EVENTS_FILENAME) as f:
-		events = []
-		for row in csv.DictReader(f, fieldnames=['event_id', 'name', 'time', 'address', 'type', 'description', 'extra1', 'extra2'], quoting=csv.QUOTE_NONE, delimiter='\t'):
-			if row['extra1'] != None:
-				row['latitude'] = row['type']
-				row['longitude'] = row['description']
-				row['type'] = row['extra1']
-				row['description'] = row['extra2']
-				events.append(row)
-				break
-			addressList = row['address'].split(' ')
-			row['latitude'] = addressList[-2]
-			row['longitude'] = addressList[-1]
-			row['address'] = ' '.join(addressList[:-2])
-			events.append(row)
+	db.ingestFile(EVENTS_FILENAME, readEvents, db.addEvents)
+	db.invalidateQueryCache()
 
-		for row in csv.DictReader(f, fieldnames=['event_id', 'name', 'time', 'address', 'latitude', 'longitude', 'type', 'description'], quoting=csv.QUOTE_NONE, delimiter='\t'):
-			events.append(row)
-
-		db.addEvents(events)
+# The records of a tweet file are its lines, blank ones included, so both tweet parsers count them the same
+def addTweetLines(db, lines):
+	db.addTweets(json.loads(line.strip()) for line in lines if line.strip() != '')
 
 def parseTweets(db):
 	print 'Parsing Tweets'
 	for tweetFilename in TWEETS_FILENAMES:
+		print 'Parsing %s' % tweetFilename
+		db.ingestFile(tweetFilename, lambda f: f, lambda lines: addTweetLines(db, lines))
+	db.invalidateQueryCache()
+
+# Worker process for parseTweetsParallel: decodes and converts chunks of JSON lines until it gets None.
+# Chunks keep their sequence number, file and line count so the writer can checkpoint them in order. A worker
+# always ends with None, after an ('error', traceback) marker if it failed, so the writer never waits on it.
+def decodeTweets(lineQueue, rowQueue):
+	try:
+		while True:
+			chunk = lineQueue.get()
+			if chunk == None:
+				break
+			sequence, filename, numLines, lines = chunk
+			rows = None if lines == None else [tweetDictToSQLRow(json.loads(line)) for line in lines if line.strip() != '']
+			rowQueue.put((sequence, filename, numLines, rows))
+	except Exception:
+		rowQueue.put(('error', traceback.format_exc()))
+	finally:
+		rowQueue.put(None)
+
+# Reads the tweet files in chunks of lines, skipping the lines already ingested, and hands them to the
+# workers. The end of each file is marked by a chunk without lines. Then tells each worker to stop.
+def readTweetLines(progress, lineQueue, numWorkers):
+	sequence = 0
+	for tweetFilename, numLines in progress:
 		print 'Parsing %s' % tweetFilename
 		with open(tweetFilename) as f:
-			tweets = (json.loads(line.strip()) for line in f if line != '\n')
-			db.addTweets(tweets)
-
-def parseLine(fieldIndices, line):
-	parsedLine = []
-	lastIndex = 0
-	for fieldIndex in fieldIndices[1:] + [len(line)]:
-		parsedLine.append(line[lastIndex:fieldIndex].strip())
-		lastIndex = fieldIndex
-
-	return parsedLine
+			for lines in chunked(itertools.islice(f, numLines, None), TWEET_LINES_PER_CHUNK):
+				numLines += len(lines)
+				lineQueue.put((sequence, tweetFilename, numLines, lines))
+				sequence += 1
+		lineQueue.put((sequence, tweetFilename, numLines, None))
+		sequence += 1
+	for i in xrange(numWorkers):
+		lineQueue.put(None)
+
+# Same as parseTweets, but JSON decoding and conversion happen in numWorkers processes. A thread reads the
+# files into a bounded queue of line chunks, the workers turn them into rows on a second bounded queue, and
+# this process is the single writer that inserts them. Chunks can come back out of order, so the writer
+# holds them until the ones before have been inserted and every checkpoint covers a prefix of its file. If a
+# worker fails or dies, the others are stopped and the error is raised; the chunks inserted so far stay
+# checkpointed, so a re-run resumes after them.
+def parseTweetsParallel(db, numWorkers=NUM_TWEET_WORKERS):
+	print 'Parsing Tweets'
+	progress = []
+	for tweetFilename in TWEETS_FILENAMES:
+		numLines = db.startIngestion(tweetFilename)
+		if numLines == None:
+			print 'Skipping %s, already ingested' % tweetFilename
+		else:
+			progress.append((tweetFilename, numLines))
+
+	lineQueue = multiprocessing.Queue(TWEET_QUEUE_SIZE)
+	rowQueue = multiprocessing.Queue(TWEET_QUEUE_SIZE)
+
+	workers = [multiprocessing.Process(target=decodeTweets, args=(lineQueue, rowQueue)) for i in xrange(numWorkers)]
+	for worker in workers:
+		worker.daemon = True
+		worker.start()
+	reader = threading.Thread(target=readTweetLines, args=(progress, lineQueue, numWorkers))
+	reader.daemon = True
+	reader.start()
+
+	numInserted = 0
+	numFinished = 0
+	pending = {}
+	nextSequence = 0
+	start = time.time()
+	try:
+		while numFinished < numWorkers:
+			try:
+				chunk = rowQueue.get(timeout=TWEET_POLL_SECONDS)
+			except Queue.Empty:
+				# Workers flush their rows before exiting, so nothing more can come once they are all gone
+				if not any(worker.is_alive() for worker in workers):
+					raise RuntimeError('Tweet workers exited before finishing')
+				continue
+			if chunk == None:
+				numFinished += 1
+				continue
+			if chunk[0] == 'error':
+				raise RuntimeError('Decoding tweets failed in a worker:\n%s' % chunk[1])
+			pending[chunk[0]] = chunk
+			while nextSequence in pending:
+				sequence, filename, numLines, rows = pending.pop(nextSequence)
+				nextSequence += 1
+				if rows == None:
+					db.finishIngestion(filename)
+					continue
+				db.ingestBatch(filename, rows, db.addTweetRows, numLines)
+				numInserted += len(rows)
+				print 'Tweets inserted: %i (%.0f tweets/s)' % (numInserted, numInserted / max(time.time() - start, 1e-6))
+	except:
+		# The reader thread may be blocked on the full line queue, so it is abandoned rather than joined
+		for worker in workers:
+			worker.terminate()
+		lineQueue.cancel_join_thread()
+		raise
+
+	reader.join()
+	for worker in workers:
+		worker.join()
+	db.invalidateQueryCache()
+
+# Columns of the ODRail reports read by DB.TDictToSQLStrings. The two months use different column names.
+T_COLUMNS = ['Origin', 'Destination', 'ScheduleDate', 'EntryDateTime', 'OrderDate', 'CreateDate']
+
+def readTRides(f):
+	reader = RptReader(f)
+	reader.selectColumns([column for column in T_COLUMNS if column in reader.fieldNames])
+	return reader.iterDicts()
 
 def parseTRides(db):
 	print 'Parsing T Rides'
 	for TFilename in T_FILENAMES:
 		print 'Parsing %s' % TFilename
-		with open(TFilename) as f:
-			header = f.readline()[3:]
-			separator = f.readline()
-
-			# Find the length of each field by parsing the separator line
-			fieldIndices = []
-			index = 0
-			while index != -1:
-				fieldIndices.append(index+1)
-				index = separator.find(' ', index+1)
-
-			fieldNames = parseLine(fieldIndices, header)
-
-			TRides = (dict(zip(fieldNames, parseLine(fieldIndices, line))) for line in f)
-			db.addTRides(TRides)
+		db.ingestFile(TFilename, readTRides, db.addTRides)
+	db.invalidateQueryCache()
 
+# Counts the T rides leaving and arriving at each station per hour and saves them as a TRideCube
 def parseTRides2(db):
 	print 'Parsing T Rides'
-	places = {}
+	counts = {'origin': {}, 'destination': {}}
 	for TFilename in T_FILENAMES:
 		print 'Parsing %s' % TFilename
 		with open(TFilename) as f:
-			header = f.readline()[3:]
-			separator = f.readline()
-
-			# Find the length of each field by parsing the separator line
-			fieldIndices = []
-			index = 0
-			while index != -1:
-				fieldIndices.append(index+1)
-				index = separator.find(' ', index+1)
-
-			fieldNames = parseLine(fieldIndices, header)
-			for line in f:
-				if line == '' or line =='\n':
-					break
-
-				SQLDict = db.TDictToSQLStrings(dict(zip(fieldNames, parseLine(fieldIndices, line))))
-				for label in 'origin', 'destination':
-					place = SQLDict[label]
-					if place not in places:
-						places[place] = {}
-					try:
-						timeObj = datetime.datetime.strptime(SQLDict['datetime'][:13], '%Y-%m-%d %H')
-					except ValueError:
-						print line
-						raise
-					if timeObj not in places[place]:
-						places[place][timeObj] = {}
-						places[place][timeObj]['origin'] = 0
-						places[place][timeObj]['destination'] = 0
-
-					places[place][timeObj][label] += 1
-
-	with open('places.p', 'wb') as f:
-		pickle.dump(places, f)
+			reader = RptReader(f)
+			timeColumn = 'EntryDateTime' if 'EntryDateTime' in reader.fieldNames else 'CreateDate'
+			reader.selectColumns(['Origin', 'Destination', timeColumn])
+			for origin, destination, timeStr in reader:
+				# Only the hour matters, so count by the hour prefix and parse each distinct one at the end
+				hourStr = timeStr[:13]
+				originKey = (origin, hourStr)
+				destinationKey = (destination, hourStr)
+				counts['origin'][originKey] = counts['origin'].get(originKey, 0) + 1
+				counts['destination'][destinationKey] = counts['destination'].get(destinationKey, 0) + 1
+
+	hours = {}
+	stations, hourSeconds, origins, destinations = [], [], [], []
+	for label in 'origin', 'destination':
+		for (place, hourStr), count in counts[label].iteritems():
+			if hourStr not in hours:
+				try:
+					hours[hourStr] = toEpochSeconds(datetime.datetime.strptime(hourStr, '%Y-%m-%d %H'))
+				except ValueError:
+					print place, hourStr
+					raise
+			stations.append(place)
+			hourSeconds.append(hours[hourStr])
+			origins.append(count if label == 'origin' else 0)
+			destinations.append(count if label == 'destination' else 0)
+
+	TRideCube.fromCounts(stations, hourSeconds, origins, destinations).save(TRIDE_CUBE_FILENAME)
+	db.invalidateQueryCache()
 
 
 def parseBusRides(db):
 	print 'Parsing Bus Rides'
 	for busFilename in BUS_FILENAMES:
 		print 'Parsing %s' % busFilename
-		with open(busFilename) as f:
-			header = f.readline()[3:]
-			separator = f.readline()
-
-			# Find the length of each field by parsing the separator line
-			fieldIndices = []
-			index = 0
-			while index != -1:
-				fieldIndices.append(index+1)
-				index = separator.find(' ', index+1)
-
-			fieldNames = parseLine(fieldIndices, header)
-
-			busRides = (dict(zip(fieldNames, parseLine(fieldIndices, line))) for line in f)
-			db.addBusRides(busRides)
+		db.ingestFile(busFilename, lambda f: RptReader(f, ['ScheduleDate', 'CREATEDATE', 'RouteStation']).iterDicts(), db.addBusRides)
+	db.invalidateQueryCache()
 
 def parseStops(db):
 	print 'Parsing Stops'
-	with open(STOPS_FILENAME) as f:
-		header = f.readline()[3:]
-		separator = f.readline()
-
-		# Find the length of each field by parsing the separator line
-		fieldIndices = []
-		index = 0
-		while index != -1:
-			fieldIndices.append(index+1)
-			index = separator.find(' ', index+1)
-
-		fieldNames = parseLine(fieldIndices, header)
-
-		stops = (dict(zip(fieldNames, parseLine(fieldIndices, line))) for line in f)
-		db.addStops(stops)
+	columns = ['locID', 'isStation', 'Direction', 'nextLocID', 'Notes', 'Longitude', 'Latitude', 'nextStn', 'prevStn', 'Station', 'SortOrder', 'Line', 'CircuitNumber', 'Heading', 'LocType']
+	db.ingestFile(STOPS_FILENAME, lambda f: RptReader(f, columns).iterDicts(), db.addStops)
+	db.invalidateQueryCache()
 
 if __name__ == '__main__':
 	start = time.clock()
@@ -0,0 +1,140 @@
+import sqlite3
+import cPickle as pickle
+from collections import OrderedDict
+
+
+QUERY_CACHE_FILENAME = 'query_cache.db'
+
+# Bump whenever a cached query changes meaning so old results are never served
+QUERY_CACHE_VERSION = 2
+
+MAX_MEMORY_ENTRIES = 200000
+
+# Number of writes buffered in memory before they are flushed to disk in one short transaction
+WRITES_PER_COMMIT = 1000
+
+# Seconds to wait on a lock held by another process sharing the cache file
+LOCK_TIMEOUT = 60
+
+
+# Two-tier cache for DB query results: an LRU dict in memory in front of a SQLite file on disk. Entries are
+# namespaced by QUERY_CACHE_VERSION, a data generation that is bumped by invalidate() after re-ingestion, and
+# the name of the database they were computed from, so stale results or another database's results are
+# never served. Each database sharing the file has its own generation.
+class QueryCache:
+	def __init__(self, filename=QUERY_CACHE_FILENAME, version=QUERY_CACHE_VERSION, maxMemoryEntries=MAX_MEMORY_ENTRIES, database=''):
+		self.version = version
+		self.database = database
+		self.maxMemoryEntries = maxMemoryEntries
+		self.memory = OrderedDict()
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.pendingWrites = []
+
+		# Worker processes share the file: in WAL mode readers never wait on the writer, and writes only hold
+		# the lock while a buffer of them is flushed
+		self.connection = sqlite3.connect(filename, timeout=LOCK_TIMEOUT)
+		self.connection.text_factory = str
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value BLOB, PRIMARY KEY (namespace, key))')
+
+		row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (self.getGenerationKey(),)).fetchone()
+		self.generation = 0 if row == None else int(row[0])
+		self.namespace = self.getNamespace()
+
+		# Drop anything left over from older versions, or from older generations of this database, only taking the
+		# write lock if there is any
+		versionPrefix = '%s.' % self.version
+		databaseSuffix = '|%s' % self.database
+		staleSQL = 'namespace != ? AND (substr(namespace, 1, ?) != ? OR substr(namespace, -?) = ?)'
+		params = (self.namespace, len(versionPrefix), versionPrefix, len(databaseSuffix), databaseSuffix)
+		if self.connection.execute('SELECT 1 FROM entries WHERE %s LIMIT 1' % staleSQL, params).fetchone() != None:
+			self.connection.execute('DELETE FROM entries WHERE %s' % staleSQL, params)
+			self.connection.commit()
+
+	def getGenerationKey(self):
+		return 'generation|%s' % self.database
+
+	def getNamespace(self):
+		return '%s.%s|%s' % (self.version, self.generation, self.database)
+
+	def serializeKey(self, key):
+		return repr(key)
+
+	# Returns a (found, value) tuple
+	def get(self, key):
+		serializedKey = self.serializeKey(key)
+		if serializedKey in self.memory:
+			self.hits += 1
+			value = self.memory.pop(serializedKey)
+			self.memory[serializedKey] = value
+			return True, value
+
+		row = self.connection.execute('SELECT value FROM entries WHERE namespace = ? AND key = ?', (self.namespace, serializedKey)).fetchone()
+		if row == None:
+			self.misses += 1
+			return False, None
+
+		self.hits += 1
+		value = pickle.loads(str(row[0]))
+		self.remember(serializedKey, value)
+		return True, value
+
+	def put(self, key, value):
+		serializedKey = self.serializeKey(key)
+		self.remember(serializedKey, value)
+		self.pendingWrites.append((self.namespace, serializedKey, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+		if len(self.pendingWrites) >= WRITES_PER_COMMIT:
+			self.commit()
+
+	# Adds to the in-memory tier, evicting the least recently used entries past maxMemoryEntries
+	def remember(self, serializedKey, value):
+		self.memory[serializedKey] = value
+		while len(self.memory) > self.maxMemoryEntries:
+			self.memory.popitem(last=False)
+			self.evictions += 1
+
+	# Drops every cached result of this database. Call after the underlying tables change.
+	def invalidate(self):
+		self.generation += 1
+		self.namespace = self.getNamespace()
+		self.memory.clear()
+		self.pendingWrites = []
+		self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (self.getGenerationKey(), str(self.generation)))
+		databaseSuffix = '|%s' % self.database
+		self.connection.execute('DELETE FROM entries WHERE substr(namespace, -?) = ?', (len(databaseSuffix), databaseSuffix))
+		self.connection.commit()
+
+	# Drops the cached results of the named methods only, keeping the generation. For tables appended to while
+	# in use, where the other queries stay valid. Other processes sharing the file keep their in-memory tier.
+	def invalidateMethods(self, names):
+		for name in names:
+			prefix = '(%r, ' % name
+			for serializedKey in [serializedKey for serializedKey in self.memory if serializedKey.startswith(prefix)]:
+				del self.memory[serializedKey]
+			self.pendingWrites = [write for write in self.pendingWrites if not write[1].startswith(prefix)]
+			self.connection.execute('DELETE FROM entries WHERE namespace = ? AND substr(key, 1, ?) = ?', (self.namespace, len(prefix), prefix))
+		self.commit()
+
+	def commit(self):
+		if len(self.pendingWrites) > 0:
+			self.connection.executemany('INSERT OR REPLACE INTO entries (namespace, key, value) VALUES (?, ?, ?)', self.pendingWrites)
+		self.connection.commit()
+		self.pendingWrites = []
+
+	def close(self):
+		self.commit()
+		self.connection.close()
+
+	def getStats(self):
+		lookups = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'hitRate': float(self.hits) / lookups if lookups > 0 else 0.0,
+			'memoryEntries': len(self.memory),
+		}
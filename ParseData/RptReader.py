@@ -0,0 +1,43 @@
+# Reads the fixed-width .rpt reports exported from SQL Server (the MBTA AFC, ODRail and Stops files). The
+# column layout is worked out once from the separator line under the header and compiled into slices, and
+# only the requested columns are extracted from each row. Iteration stops at the blank line that precedes
+# the trailing "(N rows affected)" summary.
+class RptReader:
+	def __init__(self, f, columns=None):
+		self.f = f
+		header = f.readline()[3:]  # Skip the byte order mark
+		separator = f.readline()
+
+		# Each field ends at a space in the separator line
+		fieldIndices = []
+		index = 0
+		while index != -1:
+			fieldIndices.append(index+1)
+			index = separator.find(' ', index+1)
+		starts = [0] + fieldIndices[1:]
+		ends = fieldIndices[1:] + [None]
+		slices = [slice(start, end) for start, end in zip(starts, ends)]
+
+		self.fieldSlices = slices
+		self.fieldNames = [header[fieldSlice].strip() for fieldSlice in slices]
+
+		self.selectColumns(columns if columns != None else self.fieldNames)
+
+	# Restricts the rows to the given columns, which must be in fieldNames
+	def selectColumns(self, columns):
+		self.columns = list(columns)
+		self.slices = [self.fieldSlices[self.fieldNames.index(column)] for column in self.columns]
+
+	# Yields a tuple of stripped strings per row, in the order of the requested columns
+	def __iter__(self):
+		slices = self.slices
+		for line in self.f:
+			if line == '\n' or line == '\r\n' or line == '':
+				return
+			yield tuple([line[fieldSlice].strip() for fieldSlice in slices])
+
+	# Yields a dict per row keyed by the requested columns, for code that expects the old parseLine dicts
+	def iterDicts(self):
+		columns = self.columns
+		for row in self:
+			yield dict(zip(columns, row))
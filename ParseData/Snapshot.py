@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+
+import numpy as np
+
+from Index import toEpochSeconds, fromEpochSeconds
+from Config import DATA_FOLDER
+
+
+SNAPSHOT_FOLDER = os.path.join(DATA_FOLDER, 'snapshot')
+META_FILENAME = 'meta.json'
+
+# Sentinels for nulls in columns without a natural one (floats use NaN)
+NULL_TIME = np.iinfo(np.int64).min
+NULL_INT = np.iinfo(np.int64).min
+NULL_BOOL = -1
+NULL_STRING = -1
+NULL_COORD = np.iinfo(np.int32).min
+
+# Column kinds and their on-disk dtypes. Strings are dictionary-encoded as int32 codes into a vocabulary.
+# Coordinates are DECIMAL(9, 6) in MySQL, so they are stored exactly as int32 microdegrees rather than as
+# float32, which would move points across the distance thresholds.
+DTYPES = {
+	'time': np.int64,     # Epoch seconds
+	'coord': np.int32,    # Microdegrees
+	'float': np.float32,
+	'int': np.int64,
+	'bool': np.int8,
+	'string': np.int32,
+}
+
+
+# Writes tables as one .npy file per column plus a meta.json holding the row counts, column kinds and string
+# vocabularies
+class SnapshotWriter:
+	def __init__(self, folder=SNAPSHOT_FOLDER):
+		self.folder = folder
+		self.meta = {}
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+	# rows yields tuples in the order of columns, a list of (name, kind) pairs. maxRows only sizes the
+	# files, any rows past it are an error.
+	def writeTable(self, table, columns, rows, maxRows):
+		tableFolder = os.path.join(self.folder, table)
+		if not os.path.isdir(tableFolder):
+			os.makedirs(tableFolder)
+
+		arrays = [np.lib.format.open_memmap(os.path.join(tableFolder, '%s.npy' % name), mode='w+', dtype=DTYPES[kind], shape=(maxRows,)) for name, kind in columns]
+		vocabularies = [{} for column in columns]
+		encoders = [getattr(self, 'encode%s' % kind.capitalize()) for name, kind in columns]
+
+		numRows = 0
+		for row in rows:
+			if numRows % 1000000 == 0:
+				print 'Exporting %s: %i rows' % (table, numRows)
+			for array, encode, vocabulary, value in zip(arrays, encoders, vocabularies, row):
+				array[numRows] = encode(value, vocabulary)
+			numRows += 1
+
+		for array in arrays:
+			array.flush()
+
+		self.meta[table] = {
+			'numRows': numRows,
+			'columns': columns,
+			'vocabularies': dict((name, sorted(vocabulary, key=vocabulary.get)) for (name, kind), vocabulary in zip(columns, vocabularies) if kind == 'string'),
+		}
+
+	def encodeTime(self, value, vocabulary):
+		return NULL_TIME if value == None else toEpochSeconds(value)
+
+	def encodeCoord(self, value, vocabulary):
+		return NULL_COORD if value == None else int(round(float(value) * 1000000))
+
+	def encodeFloat(self, value, vocabulary):
+		return np.nan if value == None else float(value)
+
+	def encodeInt(self, value, vocabulary):
+		return NULL_INT if value == None else int(value)
+
+	def encodeBool(self, value, vocabulary):
+		return NULL_BOOL if value == None else int(bool(value))
+
+	def encodeString(self, value, vocabulary):
+		if value == None:
+			return NULL_STRING
+		if value not in vocabulary:
+			vocabulary[value] = len(vocabulary)
+		return vocabulary[value]
+
+	def close(self):
+		with open(os.path.join(self.folder, META_FILENAME), 'w') as f:
+			json.dump(self.meta, f)
+
+
+# Read-only view of a snapshot. Columns are memory-mapped, so opening one costs nothing until it is read.
+class Snapshot:
+	def __init__(self, folder=SNAPSHOT_FOLDER):
+		self.folder = folder
+		with open(os.path.join(folder, META_FILENAME)) as f:
+			self.meta = json.load(f)
+		self.columns = {}
+
+	def hasTable(self, table):
+		return table in self.meta
+
+	def getNumRows(self, table):
+		return self.meta[table]['numRows']
+
+	def getColumn(self, table, column):
+		if (table, column) not in self.columns:
+			array = np.load(os.path.join(self.folder, table, '%s.npy' % column), mmap_mode='r')
+			self.columns[(table, column)] = array[:self.getNumRows(table)]
+		return self.columns[(table, column)]
+
+	# Decodes a coord column to float64 degrees, with NaN for nulls
+	def getCoordinates(self, table, column):
+		microdegrees = self.getColumn(table, column)
+		return np.where(microdegrees == NULL_COORD, np.nan, microdegrees / 1000000.0)
+
+	def getVocabulary(self, table, column):
+		return self.meta[table]['vocabularies'][column]
+
+	# Returns a dict of Python values for a single row, with nulls as None
+	def getRow(self, table, index):
+		row = {}
+		for column, kind in self.meta[table]['columns']:
+			value = self.getColumn(table, column)[index]
+			if kind == 'time':
+				row[column] = None if value == NULL_TIME else fromEpochSeconds(int(value))
+			elif kind == 'coord':
+				row[column] = None if value == NULL_COORD else value / 1000000.0
+			elif kind == 'float':
+				row[column] = None if np.isnan(value) else float(value)
+			elif kind == 'int':
+				row[column] = None if value == NULL_INT else int(value)
+			elif kind == 'bool':
+				row[column] = None if value == NULL_BOOL else bool(value)
+			else:
+				row[column] = None if value == NULL_STRING else self.getVocabulary(table, column)[value]
+		return row
+
+
+if __name__ == '__main__':
+	from Database import DB
+
+	folder = sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_FOLDER
+	with DB() as db:
+		db.exportSnapshot(folder)
@@ -0,0 +1,102 @@
+import sys
+import json
+import cPickle as pickle
+
+import numpy as np
+
+from Index import toEpochSeconds
+
+
+TRIDE_CUBE_FILENAME = 'trides.npy'
+
+DIRECTIONS = {'origin': 0, 'destination': 1}
+
+
+# T ride counts as a dense [station, hour, direction] array. The counts are stored as cumulative sums along
+# the hour axis (with a leading zero), so the number of rides in any range of hours is a single difference.
+# The array is saved as a .npy file next to a .json file holding the station names and the first hour, and
+# is memory-mapped on load.
+class TRideCube:
+	def __init__(self, stations, startSeconds, cumulative):
+		self.stations = list(stations)
+		self.stationIds = dict((station, i) for i, station in enumerate(self.stations))
+		self.startSeconds = int(startSeconds)
+		self.cumulative = cumulative
+
+	def getNumHours(self):
+		return self.cumulative.shape[1] - 1
+
+	# Builds the cube from one entry per (station, hour) with the number of rides leaving and arriving
+	@classmethod
+	def fromCounts(cls, stations, hourSeconds, origins, destinations):
+		names = sorted(set(stations))
+		if len(names) == 0:
+			return cls([], 0, np.zeros((0, 1, 2), dtype=np.int32))
+		nameIds = dict((name, i) for i, name in enumerate(names))
+		stationIds = np.array([nameIds[station] for station in stations], dtype=np.int64)
+		hours = np.asarray(hourSeconds, dtype=np.int64) // 3600
+		startHour = hours.min()
+
+		counts = np.zeros((len(names), hours.max() - startHour + 1, 2), dtype=np.int64)
+		np.add.at(counts, (stationIds, hours - startHour, DIRECTIONS['origin']), np.asarray(origins, dtype=np.int64))
+		np.add.at(counts, (stationIds, hours - startHour, DIRECTIONS['destination']), np.asarray(destinations, dtype=np.int64))
+
+		cumulative = np.zeros((len(names), counts.shape[1] + 1, 2), dtype=np.int32)
+		cumulative[:, 1:, :] = np.cumsum(counts, axis=1)
+		return cls(names, startHour * 3600, cumulative)
+
+	# Converts the nested station -> datetime -> {'origin', 'destination'} dicts formerly pickled to places.p
+	@classmethod
+	def fromPlaces(cls, places):
+		entries = [(station, toEpochSeconds(hour), counts['origin'], counts['destination']) for station, hours in places.iteritems() for hour, counts in hours.iteritems()]
+		return cls.fromCounts(*zip(*entries)) if len(entries) > 0 else cls.fromCounts([], [], [], [])
+
+	# Yields (station, hour epoch seconds, origin count, destination count) for every non-empty cell
+	def iterCounts(self):
+		counts = np.diff(self.cumulative, axis=1)
+		for stationId, hour in zip(*np.nonzero(counts.sum(axis=2))):
+			yield self.stations[stationId], self.startSeconds + 3600 * int(hour), int(counts[stationId, hour, 0]), int(counts[stationId, hour, 1])
+
+	def save(self, filename=TRIDE_CUBE_FILENAME):
+		np.save(filename, self.cumulative)
+		with open(filename + '.json', 'w') as f:
+			json.dump({'stations': self.stations, 'startSeconds': self.startSeconds}, f)
+
+	@classmethod
+	def load(cls, filename=TRIDE_CUBE_FILENAME):
+		with open(filename + '.json') as f:
+			meta = json.load(f)
+		return cls(meta['stations'], meta['startSeconds'], np.load(filename, mmap_mode='r'))
+
+	# Number of rides from (label 'origin') or to (label 'destination') station in the hours starting from
+	# the hour containing startTime up to, but excluding, the first hour at or after endTime
+	def getNumRides(self, station, startTime, endTime, label):
+		stationId = self.stationIds.get(station)
+		if stationId == None:
+			return 0
+		startHour = toEpochSeconds(startTime) // 3600 - self.startSeconds // 3600
+		endHour = -(-toEpochSeconds(endTime) // 3600) - self.startSeconds // 3600
+		startHour = min(max(startHour, 0), self.getNumHours())
+		endHour = min(max(endHour, 0), self.getNumHours())
+		if endHour <= startHour:
+			return 0
+		direction = DIRECTIONS[label]
+		return int(self.cumulative[stationId, endHour, direction] - self.cumulative[stationId, startHour, direction])
+
+	# getNumRides for arrays of start and end epoch times
+	def getNumRidesArray(self, station, startSeconds, endSeconds, label):
+		startSeconds = np.asarray(startSeconds, dtype=np.int64)
+		stationId = self.stationIds.get(station)
+		if stationId == None:
+			return np.zeros(len(startSeconds), dtype=np.int64)
+		startHours = np.clip(startSeconds // 3600 - self.startSeconds // 3600, 0, self.getNumHours())
+		endHours = np.clip(-(-np.asarray(endSeconds, dtype=np.int64) // 3600) - self.startSeconds // 3600, 0, self.getNumHours())
+		cumulative = np.asarray(self.cumulative[stationId, :, DIRECTIONS[label]], dtype=np.int64)
+		return np.where(endHours > startHours, cumulative[endHours] - cumulative[startHours], 0)
+
+
+if __name__ == '__main__':
+	# Converts an existing places.p to the cube format
+	placesFilename = sys.argv[1] if len(sys.argv) > 1 else 'places.p'
+	with open(placesFilename, 'rb') as f:
+		TRideCube.fromPlaces(pickle.load(f)).save()
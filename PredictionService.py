@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import Queue
+import urlparse
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+
+import numpy as np
+
+import SVM
+from ParseData.Database import DB
+from ParseData.Index import toEpochSeconds
+from ParseData.TRideCube import TRIDE_CUBE_FILENAME
+from Features import evaluateFeatures
+from Lib import getPointsOfInterest, parseTestTime, ALL_FEATURES, START_TIME, END_TIME
+
+
+# Serves predictions for (latitude, longitude, start time) requests from fitted pipelines kept in memory.
+# Requests arriving together are batched: a single thread answers them with one feature evaluation and one
+# predict call per POI, which also keeps every DB access on that thread.
+
+DEFAULT_PORT = 8765
+
+# How long the batching thread waits for more requests after the first one, and the most it batches
+BATCH_SECONDS = 0.002
+MAX_BATCH_SIZE = 1000
+
+# Feature vectors kept in memory, least recently used first out
+MAX_CACHED_FEATURES = 100000
+
+
+class PredictionRequest:
+	def __init__(self, latitude, longitude, time):
+		self.location = (latitude, longitude)
+		self.time = time
+		self.prediction = None
+		self.error = None
+		self.done = threading.Event()
+
+
+# The fitted pipelines of every POI, the feature vectors computed so far and the batching thread. The DB is
+# opened with the taxi index and its weather timeline and T ride cube are loaded up front, so answering a
+# request never waits on the database.
+class PredictionService:
+	def __init__(self, db, POIs, generatePipeline=SVM.GENERATE_PIPELINE, startTime=START_TIME, endTime=END_TIME):
+		self.db = db
+		self.features = OrderedDict()
+		self.requests = Queue.Queue()
+
+		db.getWeatherTimeline()
+		if db.TRideCube == None and os.path.exists(TRIDE_CUBE_FILENAME):
+			db.getTRideCube()
+
+		self.pipelines = dict(((POI['LAT'], POI['LONG']), SVM.fitPipeline(db, POI['LAT'], POI['LONG'], generatePipeline, startTime, endTime)) for POI in POIs)
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# Predicts the number of pickups in the 2 hours from time at a POI. Safe to call from any thread.
+	def predict(self, latitude, longitude, time):
+		request = PredictionRequest(latitude, longitude, time)
+		self.requests.put(request)
+		request.done.wait()
+		if request.error != None:
+			raise request.error
+		return request.prediction
+
+	# Takes the requests waiting, or arriving within BATCH_SECONDS of the first one, and answers them together
+	def run(self):
+		while True:
+			batch = [self.requests.get()]
+			deadline = time.time() + BATCH_SECONDS
+			while len(batch) < MAX_BATCH_SIZE:
+				try:
+					batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+				except Queue.Empty:
+					break
+			self.predictBatch(batch)
+
+	def predictBatch(self, batch):
+		requestsByLocation = {}
+		for request in batch:
+			requestsByLocation.setdefault(request.location, []).append(request)
+
+		for location, requests in requestsByLocation.iteritems():
+			try:
+				if location not in self.pipelines:
+					raise KeyError('No model for location %s, %s' % location)
+				x = self.getFeatures(location, [request.time for request in requests])
+				predictions = np.maximum(np.asarray(self.pipelines[location].predict(x), dtype=np.float64).reshape(len(requests)), 0)
+				for request, prediction in zip(requests, predictions):
+					request.prediction = float(prediction)
+			except Exception as e:
+				for request in requests:
+					request.error = e
+			for request in requests:
+				request.done.set()
+
+	# The feature vectors for times at a location, evaluating the ones not cached in a single batch
+	def getFeatures(self, location, times):
+		keys = [(location, toEpochSeconds(time)) for time in times]
+		missing = sorted(set(i for i, key in enumerate(keys) if key not in self.features), key=lambda i: times[i])
+		if len(missing) > 0:
+			values = evaluateFeatures(self.db, ALL_FEATURES, location[0], location[1], [times[i] for i in missing])
+			for i, value in zip(missing, values):
+				self.features[keys[i]] = value
+		x = []
+		for key in keys:
+			value = self.features.pop(key)
+			self.features[key] = value
+			x.append(value)
+		while len(self.features) > MAX_CACHED_FEATURES:
+			self.features.popitem(last=False)
+		return np.array(x)
+
+
+# Answers GET /predict?lat=..&lon=..&start=YYYY-MM-DD+HH:MM, and POST /predict with a JSON object (or list of
+# objects) with lat, lon and start. Responds with {"prediction": ...} (or a list of them).
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		url = urlparse.urlparse(self.path)
+		query = dict((name, values[0]) for name, values in urlparse.parse_qs(url.query).iteritems())
+		self.respond(url.path, query)
+
+	def do_POST(self):
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+		except ValueError as e:
+			return self.sendJSON(400, {'error': 'Invalid JSON: %s' % e})
+		self.respond(urlparse.urlparse(self.path).path, body)
+
+	def respond(self, path, body):
+		if path != '/predict':
+			return self.sendJSON(404, {'error': 'Not found'})
+		try:
+			queries = body if isinstance(body, list) else [body]
+			requests = [(float(query['lat']), float(query['lon']), parseTestTime(query['start'])) for query in queries]
+		except (KeyError, ValueError, TypeError) as e:
+			return self.sendJSON(400, {'error': 'Expected lat, lon and start: %s' % e})
+
+		# Submitted together so a POSTed list is answered in a single batch
+		pending = [PredictionRequest(*request) for request in requests]
+		for request in pending:
+			self.server.service.requests.put(request)
+		responses = []
+		for request in pending:
+			request.done.wait()
+			responses.append({'prediction': request.prediction} if request.error == None else {'error': str(request.error)})
+		status = 200 if all('error' not in response for response in responses) else 400
+		self.sendJSON(status, responses if isinstance(body, list) else responses[0])
+
+	def sendJSON(self, status, value):
+		data = json.dumps(value)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	# Unix socket clients have no address
+	def address_string(self):
+		return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Bursts of concurrent clients are the point of batching, and the default backlog of 5 makes the connections
+# beyond it wait a second for a retry
+REQUEST_QUEUE_SIZE = 128
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	request_queue_size = REQUEST_QUEUE_SIZE
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+	request_queue_size = REQUEST_QUEUE_SIZE
+
+	# BaseHTTPRequestHandler expects the server_name and server_port an HTTPServer sets
+	def server_bind(self):
+		SocketServer.UnixStreamServer.server_bind(self)
+		self.server_name = 'localhost'
+		self.server_port = 0
+
+def createServer(service, port=DEFAULT_PORT, socketFilename=None, verbose=False):
+	if socketFilename != None:
+		if os.path.exists(socketFilename):
+			os.remove(socketFilename)
+		server = ThreadingUnixHTTPServer(socketFilename, PredictionHandler)
+	else:
+		server = ThreadingHTTPServer(('127.0.0.1', port), PredictionHandler)
+	server.service = service
+	server.verbose = verbose
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve pickup predictions for the POIs over HTTP on localhost or a Unix socket')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+	parser.add_argument('--socket', help='Listen on this Unix socket instead of a TCP port')
+	parser.add_argument('--verbose', action='store_true', help='Log every request')
+	args = parser.parse_args()
+
+	with DB(useTaxiIndex=True) as db:
+		service = PredictionService(db, getPointsOfInterest())
+		server = createServer(service, args.port, args.socket, args.verbose)
+		print 'Serving predictions on %s' % (args.socket if args.socket != None else 'http://127.0.0.1:%i/predict' % args.port)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
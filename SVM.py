@@ -1,4 +1,8 @@
 import time
+import multiprocessing
+import multiprocessing.util
+
+import numpy as np
 
 from sklearn import svm, preprocessing, gaussian_process, neighbors, cross_decomposition, ensemble
 from sklearn.tree import DecisionTreeRegressor
@@ -6,15 +10,25 @@ from sklearn.pipeline import Pipeline
 from sklearn.feature_selection import SelectPercentile, f_regression, SelectKBest
 
 from ParseData.Database import DB
-from Lib import loadData, loadTestDataset, getPointsOfInterest, generateAllFeatures, TEST_DATASET_FINAL_FILENAME, TEST_DATASET_INITIAL_FILENAME
+from ModelCache import ModelCache, getFingerprint
+from Lib import loadDataBatched, loadFeatures, loadTestDataset, groupTestDataset, getPointsOfInterest, generateAllFeatures, START_TIME, END_TIME, TEST_DATASET_FINAL_FILENAME, TEST_DATASET_INITIAL_FILENAME
 
 
 OUTPUT_FILENAME = 'out.txt'
 
 FINAL = False
 
+# Number of worker processes used to train and predict the POIs in parallel
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+# Threads used by the forests. Set to 1 in worker processes, where the POIs already use every core.
+NUM_JOBS = -1
+
 K_BEST_FEATURES = 10
 
+# Reuse fitted pipelines from the model cache when their training data and parameters are unchanged
+USE_MODEL_CACHE = True
+
 # Various machine learning methods
 def generateSVRPipeline(x):
 	selector = SelectKBest(f_regression, k=K_BEST_FEATURES)
@@ -52,13 +66,13 @@ def generatePLSRegressionPipeline(x):
 
 def generateRandomForestPipeline(x):
 	scaler = preprocessing.StandardScaler().fit(x)
-	rf = ensemble.RandomForestRegressor(n_estimators=100, min_samples_split=1, n_jobs=-1)
+	rf = ensemble.RandomForestRegressor(n_estimators=100, min_samples_split=1, n_jobs=NUM_JOBS)
 
 	return Pipeline([('scaler', scaler), ('rf', rf)])
 
 def generateExtraTreesPipeline(x):
 	scaler = preprocessing.StandardScaler().fit(x)
-	et = ensemble.ExtraTreesRegressor(n_estimators=100, n_jobs=-1)
+	et = ensemble.ExtraTreesRegressor(n_estimators=100, n_jobs=NUM_JOBS)
 
 	return Pipeline([('scaler', scaler), ('et', et)])
 
@@ -81,73 +95,111 @@ GENERATE_PIPELINE = generateRandomForestPipeline
 
 
 # Fitting and predicting
-def fitPipeline(db, latitude, longitude, generatePipeline):
+def fitPipeline(db, latitude, longitude, generatePipeline, startTime=START_TIME, endTime=END_TIME):
 	print 'Loading Data'
-	x, y = loadData(db, latitude, longitude, generateAllFeatures)
+	x, y = loadDataBatched(db, latitude, longitude, startTime, endTime)
+	return fitPipelineOnData(latitude, longitude, generatePipeline, x, y)
 
+# Fits a pipeline for the location on the given training data, or loads it from the model cache
+def fitPipelineOnData(latitude, longitude, generatePipeline, x, y):
 	print 'Generating pipeline'
 	pipeline = generatePipeline(x)
 
+	if USE_MODEL_CACHE:
+		modelCache = ModelCache()
+		fingerprint = getFingerprint(x, y, generatePipeline, pipeline)
+		cachedPipeline = modelCache.load(latitude, longitude, fingerprint)
+		if cachedPipeline != None:
+			print 'Loaded fitted pipeline', fingerprint
+			return cachedPipeline
+
 	print 'Training SVR'
 	start = time.clock()
 	pipeline.fit(x, y)
 	print 'Total Training time:', time.clock() - start
+
+	if USE_MODEL_CACHE:
+		modelCache.save(latitude, longitude, fingerprint, pipeline)
 	return pipeline
 
-def predict(db, pipeline, latitude, longitude, testDataset):
+# Predicts the given test samples, all at the location (latitude, longitude), with a single predict call.
+# Returns arrays of the sample ids and their predictions, with negative predictions clamped to 0, and the
+# number of negative predictions.
+def predict(db, pipeline, latitude, longitude, samples):
 	print 'Begin Prediction'
 
 	print 'Generating input vectors'
-	inputVectors = {sample['id']: generateAllFeatures(db, latitude, longitude, sample['start']) for sample in testDataset if sample['lat'] == latitude and sample['long'] == longitude}
+	ids = np.array([sample['id'] for sample in samples], dtype=np.int64)
+	inputVectors = loadFeatures(db, latitude, longitude, generateAllFeatures, [sample['start'] for sample in samples], withLabels=False)[0]
 
 	print 'Predicting', inputVectors
 	try:
-		predictions = pipeline.predict(inputVectors.values())
+		predictions = np.asarray(pipeline.predict(inputVectors), dtype=np.float64).reshape(len(samples))
 	except ValueError:
-		predictions = [0] * len(inputVectors)
+		predictions = np.zeros(len(samples))
 
 	# Ensure we don't predict any negative values
-	finalPredictions = []
-	numNegatives = 0
-	for prediction in predictions:
-		finalPrediction = 0
-		if prediction > 0:
-			finalPrediction = prediction
-		elif prediction < 0:
-			numNegatives += 1
-		finalPredictions.append(finalPrediction)
-
-	return zip(inputVectors.keys(), finalPredictions), numNegatives
+	numNegatives = int(np.count_nonzero(predictions < 0))
+	return ids, np.maximum(predictions, 0), numNegatives
+
+def fitAndPredictPOI(db, POI, samples):
+	print 'POI', POI
+	pipeline = fitPipeline(db, POI['LAT'], POI['LONG'], GENERATE_PIPELINE)
+	return predict(db, pipeline, POI['LAT'], POI['LONG'], samples)
+
+# The DB of a worker process, opened once by initWorker for all of the POIs it is given and closed on exit
+WORKER_DB = None
+
+def initWorker():
+	global WORKER_DB, NUM_JOBS
+	NUM_JOBS = 1
+	WORKER_DB = DB()
+	WORKER_DB.__enter__()
+	multiprocessing.util.Finalize(None, WORKER_DB.__exit__, args=(None, None, None), exitpriority=10)
+
+# Fits a single POI and predicts its test samples. Runs in a worker process.
+def fitAndPredictWorkerPOI(args):
+	POI, samples = args
+	return fitAndPredictPOI(WORKER_DB, POI, samples)
+
+# Fans the POIs out over numProcesses worker processes, each given only the test samples at its POI. The POIs
+# are independent, so the results are simply merged by id. Returns an array of the predictions indexed by id,
+# with NaN for samples not at any POI, and the total number of negative predictions.
+def predictAllPOIs(testDataset, numProcesses=NUM_PROCESSES):
+	samplesByLocation = groupTestDataset(testDataset)
+	tasks = [(POI, samplesByLocation.get((POI['LAT'], POI['LONG']), [])) for POI in getPointsOfInterest()]
+	if numProcesses == 1:
+		with DB() as db:
+			results = [fitAndPredictPOI(db, POI, samples) for POI, samples in tasks]
+	else:
+		pool = multiprocessing.Pool(numProcesses, initWorker)
+		try:
+			results = pool.map(fitAndPredictWorkerPOI, tasks, chunksize=1)
+		finally:
+			pool.close()
+			pool.join()
+
+	predictions = np.empty(max(sample['id'] for sample in testDataset) + 1 if len(testDataset) > 0 else 0)
+	predictions.fill(np.nan)
+	for ids, POIPredictions, POINegatives in results:
+		predictions[ids] = POIPredictions
+	numNegatives = sum(POINegatives for ids, POIPredictions, POINegatives in results)
+	return predictions, numNegatives
 
 
 if __name__ == '__main__':
 	test_dataset_filename = TEST_DATASET_FINAL_FILENAME if FINAL else TEST_DATASET_INITIAL_FILENAME
 	testDataset = loadTestDataset(test_dataset_filename)
 
-	predictions = []
-	start = time.clock()
-	numNegatives = 0
-	with DB() as db:
-		for POI in getPointsOfInterest():
-			print 'POI', POI
-			pipeline = fitPipeline(db, POI['LAT'], POI['LONG'], GENERATE_PIPELINE)
-			POIPredictions, POINegatives = predict(db, pipeline, POI['LAT'], POI['LONG'], testDataset)
-			predictions.extend(POIPredictions)
-			numNegatives += POINegatives
+	start = time.time()
+	predictions, numNegatives = predictAllPOIs(testDataset)
 
 	print 'Predicted a negative number of taxi pickups %i times' % numNegatives
 
-	print 'All predictions took %s seconds' % (time.clock() - start)
+	print 'All predictions took %s seconds' % (time.time() - start)
 	print 'Writing output'
-	idList = [False] * len(testDataset)
-	outputList = []
-	for locID, prediction in predictions:
-		outputList.append((locID, '%i %i' % (locID, prediction)))
-		idList[locID] = True
-	outputList.sort()
-
-	with open(OUTPUT_FILENAME, 'w') as f:
-		f.write('\n'.join([out[1] for out in outputList]))
+	ids = np.flatnonzero(~np.isnan(predictions))
+	np.savetxt(OUTPUT_FILENAME, np.column_stack((ids, predictions[ids])), fmt='%i %i')
 
-	if not all(idList):
+	if len(ids) < len(testDataset):
 		print 'ERROR: MISSING PREDICTIONS'
@@ -0,0 +1,55 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+import Lib
+from ParseData.Database import DB, TaxiPickup
+
+
+# Like Plots.generateHour and Plots.generateNumPickupsBefore, which Plots can't be imported for without matplotlib
+def generateHour(db, latitude, longitude, time):
+	return time.hour
+
+def generateNumPickupsBefore(db, latitude, longitude, time):
+	return db.getNumPickupsNearLocation(latitude, longitude, time - datetime.timedelta(hours=2), time - datetime.timedelta(hours=1))
+
+def generateHourAndWeekday(db, latitude, longitude, time):
+	return (time.hour, time.weekday())
+
+
+class TestLoadData(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.removedTimes = Lib.REMOVED_TIMES
+		Lib.REMOVED_TIMES = Lib.RemovedTimes([])
+		self.startTime = datetime.datetime(2012, 5, 1, 3)
+		self.endTime = self.startTime + datetime.timedelta(hours=6)
+
+		self.db = DB(backend='sqlite', databaseFilename=os.path.join(self.folder, 'data.db'), queryCacheFilename=':memory:', useTaxiIndex=False)
+		self.db.__enter__()
+		self.db.createTables()
+		TaxiPickup.insert_many([{'trip_id': i, 'time': self.startTime + datetime.timedelta(minutes=20 * i), 'address': 'x', 'latitude': 42.355, 'longitude': -71.055} for i in xrange(12)]).execute()
+
+	def tearDown(self):
+		self.db.__exit__(None, None, None)
+		Lib.REMOVED_TIMES = self.removedTimes
+		shutil.rmtree(self.folder)
+
+	# Generators of a single number give a plain number per hour, which Plots.plot scatters
+	def testSingleNumberGenerators(self):
+		times = [self.startTime + datetime.timedelta(hours=hour) for hour in xrange(6)]
+		labels = [self.db.getNumPickupsNearLocation(42.355, -71.055, time, time + datetime.timedelta(hours=2)) for time in times]
+		for generateX in (generateHour, generateNumPickupsBefore):
+			x, y = Lib.loadData(self.db, 42.355, -71.055, generateX, self.startTime, self.endTime)
+			self.assertEqual(x, [generateX(self.db, 42.355, -71.055, time) for time in times])
+			self.assertEqual(y, labels)
+
+	def testVectorGenerators(self):
+		x, y = Lib.loadData(self.db, 42.355, -71.055, generateHourAndWeekday, self.startTime, self.endTime)
+		self.assertEqual(x, [(hour, 1) for hour in xrange(3, 9)])
+
+
+if __name__ == '__main__':
+	unittest.main()
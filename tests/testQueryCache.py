@@ -0,0 +1,54 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from ParseData.Database import DB, TaxiPickup
+
+
+class TestQueryCache(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.cacheFilename = os.path.join(self.folder, 'query_cache.db')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def openDB(self, name):
+		return DB(backend='sqlite', databaseFilename=os.path.join(self.folder, name), queryCacheFilename=self.cacheFilename, useTaxiIndex=False)
+
+	# Two databases sharing a cache file each get their own answers, before and after either is reopened
+	def testDatabasesSharingACacheFile(self):
+		startTime = datetime.datetime(2012, 5, 1)
+		endTime = startTime + datetime.timedelta(hours=2)
+		with self.openDB('a.db') as db:
+			db.createTables()
+			TaxiPickup.insert_many([{'trip_id': i, 'time': startTime + datetime.timedelta(minutes=i), 'address': 'x', 'latitude': 42.355, 'longitude': -71.055} for i in xrange(5)]).execute()
+			self.assertEqual(db.getNumPickupsNearLocation(42.355, -71.055, startTime, endTime), 5)
+		with self.openDB('b.db') as db:
+			db.createTables()
+			self.assertEqual(db.getNumPickupsNearLocation(42.355, -71.055, startTime, endTime), 0)
+		with self.openDB('a.db') as db:
+			self.assertEqual(db.getNumPickupsNearLocation(42.355, -71.055, startTime, endTime), 5)
+			self.assertEqual(db.queryCache.hits, 1)
+
+	# Invalidating one database's results keeps the other's
+	def testInvalidateKeepsOtherDatabases(self):
+		with self.openDB('a.db') as db:
+			db.createTables()
+			db.loadQueryCache()
+			db.queryCache.put(('method', 1), 'a')
+		with self.openDB('b.db') as db:
+			db.createTables()
+			db.loadQueryCache()
+			db.queryCache.put(('method', 1), 'b')
+			db.invalidateQueryCache()
+			self.assertEqual(db.queryCache.get(('method', 1)), (False, None))
+		with self.openDB('a.db') as db:
+			db.loadQueryCache()
+			self.assertEqual(db.queryCache.get(('method', 1)), (True, 'a'))
+
+
+if __name__ == '__main__':
+	unittest.main()